@@ -1,18 +1,44 @@
-import json
+import asyncio
+import logging
+import os
+import time
 from dotenv import load_dotenv
 import chainlit as cl
-from movie_functions import get_now_playing_movies, get_showtimes, get_current_datetime, get_location_by_ip, buy_ticket, get_reviews
+from movie_functions import get_current_datetime, get_location_by_ip
+from http_client import UpstreamError
 import litellm
 from prompts import SYSTEM_PROMPT, RAG_PROMPT
-import re
-import random
-from typing import Dict
+from typing import Optional
 from tools import tools
+from tool_registry import TOOL_REGISTRY
+from tool_executor import execute_tool_calls, run_in_pool
+from streaming import VisibleOutput, stream_completion
+from history import ConversationHistory, KIND_CONTEXT, KIND_TURN_CONTEXT
+from prompt_layout import PromptLayout
+from model_router import FAST, FULL, ModelRouter, register_latency_gauges
+from session_store import CURRENT_SESSION, CURRENT_STORE, session_store_from_env
+from review_index import retrieve_review_context
+from prefetch import start_prefetcher, observe_tool_calls
+from timing import TurnTimings, timed
+from metrics import REGISTRY, TURN_ERRORS, Gauges, Histogram, render_metrics
+from completion_cache import completion_cache
+import review_gate
+from review_gate import GATE_DECISIONS
+from chainlit.server import app as chainlit_server
+from fastapi import Response
 load_dotenv(override=True)
 
+# DEBUG logs every tool call, tool result and model response, and turns on
+# litellm's verbose output; INFO and above keep console I/O off the hot path
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 from langsmith import traceable
 litellm.success_callback = ["langsmith"] 
-litellm.set_verbose=True
+litellm.set_verbose = LOG_LEVEL == "DEBUG"
+# Providers that do not support stream_options simply don't get it
+litellm.drop_params = True
 
 # Choose one of these model configurations by uncommenting it:
 
@@ -32,7 +58,69 @@ gen_kwargs = {
     "max_tokens": 500
 }
 
-PENDING_PURCHASES: Dict[str, dict] = {}
+# Ask for token usage on the last chunk of streamed completions
+stream_kwargs = {
+    "stream": True,
+    "stream_options": {"include_usage": True},
+}
+
+# Histories and per-session values live here rather than in cl.user_session,
+# so any worker can serve any turn of a session
+SESSION_STORE = session_store_from_env()
+
+def _is_gate_decision(response) -> bool:
+    try:
+        return review_gate.parse_reply(response.choices[0].message.content) is not None
+    except (AttributeError, IndexError):
+        return False
+
+# The review gate runs at temperature 0 and is asked the same questions
+# across many sessions, so its decisions are cached. REVIEW_GATE_CACHE is
+# "exact" (key on the whole gate input), "approximate" (key on the
+# normalized user messages only) or "off".
+REVIEW_GATE_CACHE = os.getenv("REVIEW_GATE_CACHE", "exact")
+GATE_CACHE = completion_cache(
+    "review_gate",
+    ttl=60 * 60,
+    max_entries=4096,
+    approximate=REVIEW_GATE_CACHE == "approximate",
+    validate=_is_gate_decision,
+)
+
+# Models each routing tier may use, in order of preference. Add another
+# deployment of the same model (e.g. "azure/<deployment>") to a tier to
+# hedge slow completions onto it; with one model per tier, hedges are a
+# second request to the same model. LLM_HEDGING=0 turns hedging off.
+MODEL_TIERS = {
+    FULL: [model],
+    FAST: [smol_model],
+}
+ROUTER = ModelRouter(MODEL_TIERS, hedging=os.getenv("LLM_HEDGING", "1") != "0")
+register_latency_gauges(ROUTER)
+
+# Tools and history laid out so the provider can cache the prompt prefix,
+# per model since only some providers take cache breakpoints
+PROMPT_LAYOUTS = {name: PromptLayout(name, tools) for name in ROUTER.models}
+PROMPT_LAYOUT = PROMPT_LAYOUTS[model]
+
+# Completions per turn, counting the first; each one after the first follows
+# a round of tool calls
+MAX_COMPLETIONS_PER_TURN = 4
+
+# Background lookup filling the location cache for resolve_turn_context
+_location_warmup: Optional[asyncio.Future] = None
+
+# How often the speculative main completion had to be discarded because the
+# review gate asked for reviews
+SPECULATION_STATS = {"turns": 0, "wasted": 0}
+REGISTRY.register(Gauges(
+    "movie_speculative_completions_total", "Speculative main completions, by outcome (started or wasted).",
+    lambda: [({"outcome": "started"}, SPECULATION_STATS["turns"]),
+             ({"outcome": "wasted"}, SPECULATION_STATS["wasted"])],
+    kind="counter"))
+
+FIRST_TOKEN_SECONDS = REGISTRY.register(Histogram(
+    "movie_first_token_seconds", "Time from receiving a user message to the first token the user can see."))
 
 def extract_tag_content(text: str, tag_name: str) -> str | None:
     """
@@ -55,150 +143,268 @@ def extract_tag_content(text: str, tag_name: str) -> str | None:
     match = re.search(pattern, text, re.DOTALL)
     return match.group(1) if match else None
 
-# TODO: this is unused during development, but we should keep it for future use
-def remove_thought_process(text: str, is_suppressing: bool) -> tuple[str, bool]:
-    # Check if we have an opening tag in this chunk
-    has_opening = "<thought_process>" in text
-    has_closing = "</thought_process>" in text
-    cleaned_text = text
-    
-    # If we're not dealing with any tags or not suppressing, return the text as is
-    if not has_opening and not has_closing and not is_suppressing:
-        return (text, False)
-    
-    # If we have an opening tag but no closing tag, we're suppressing the tags,return only before the opening tag   
-    if has_opening and not has_closing:
-        return (text.split("<thought_process>")[0], True)
-    
-    # if we have a closing tag, keep everything after it
-    if has_closing:
-        parts = text.split("</thought_process>")
-        return (parts[-1], False)  # Return everything after the last closing tag
-    
-    # If we're currently suppressing and no closing tag found
-    if is_suppressing:
-        return ("", True)
-        
-    # Default case
-    return (text, False)
-
-
 @traceable
 @cl.on_chat_start
-def on_chat_start():    
-    message_history = [{"role": "system", "content": SYSTEM_PROMPT}]
-    cl.user_session.set("message_history", message_history)
-    cl.user_session.set("pending_purchase", None)
+async def on_chat_start():
+    # Warms the movie caches in the background; only the first session starts it
+    start_prefetcher()
+    # So the first turn's context already has the location
+    warm_location()
+    session_id = cl.user_session.get("id")
+    await SESSION_STORE.save(session_id, new_history())
+
+def new_history() -> ConversationHistory:
+    return ConversationHistory(SYSTEM_PROMPT, model=model)
 
 @cl.on_message
 @traceable
 async def on_message(message: cl.Message):
+    turn_started = time.perf_counter()
     try:
-        message_history = cl.user_session.get("message_history", [])
-        message_history.append({"role": "user", "content": message.content})
-        
+        session_id = cl.user_session.get("id")
+        # Seat holds made by buy_ticket belong to this session, and are
+        # remembered in its store
+        CURRENT_SESSION.set(session_id)
+        CURRENT_STORE.set(SESSION_STORE)
+        history = await SESSION_STORE.load(session_id, new_history)
+
         response_message = cl.Message(content="")
         await response_message.send()
 
-        context_message = get_review_context(message_history)
-        if context_message:
-            print("Update with review context:", context_message)
-            message_history.append(context_message)
+        await run_turn(history, message.content, response_message.stream_token, turn_started)
+
+        await response_message.update()
+        # After the reply is out, so the user never waits on the write
+        await SESSION_STORE.save(session_id, history)
+
+    except Exception:
+        TURN_ERRORS.inc()
+        logger.exception("An error occurred in on_message")
+        await cl.Message(content="An error occurred while processing your request.").send()
+
+async def run_turn(history: ConversationHistory, user_content: str, on_token,
+                   turn_started: Optional[float] = None, timings: Optional[TurnTimings] = None) -> str:
+    """
+    Answer one user message, independent of Chainlit.
+
+    Args:
+        history: The session's conversation, updated in place
+        user_content: The user's message
+        on_token: Async callback receiving the visible response as it streams
+        turn_started: perf_counter() when the message arrived, for first-token latency
+        timings: Collects per-stage durations, e.g. for the benchmarks
+
+    Returns:
+        The visible assistant response
+    """
+    turn_started = turn_started or time.perf_counter()
+    # Appended rather than swapped in per turn, so earlier prompts stay a prefix
+    history.append({"role": "user", "content": resolve_turn_context()}, kind=KIND_TURN_CONTEXT)
+    history.append({"role": "user", "content": user_content})
+    output = VisibleOutput(on_token, turn_started)
+
+    with timed(timings, "first_completion"):
+        stream = await speculative_completion(history, timings)
+        content, tool_calls = await stream_completion(stream, output)
+
+    # Chained calls (location -> showtimes) need more than one tool round
+    completions = 1
+    while tool_calls:
+        logger.debug("Received tool calls: %s", tool_calls)
+        history.append({"role": "assistant", "content": content or None, "tool_calls": tool_calls})
+        observe_tool_calls(tool_calls)
+
+        tool_messages = await execute_tool_calls(tool_calls, TOOL_REGISTRY, timings)
+        history.extend(tool_messages)
+
+        completions += 1
+        last_round = completions >= MAX_COMPLETIONS_PER_TURN
+        with timed(timings, "followup_completion"):
+            # The last allowed completion has to answer in text
+            stream = await main_completion(history, tool_choice="none" if last_round else None)
+            content, tool_calls = await stream_completion(stream, output)
+        if last_round and tool_calls:
+            logger.warning("Ignoring tool calls after %d completions: %s", completions, tool_calls)
+            tool_calls = []
+
+    if not output.text:
+        logger.warning("Response content is empty")
+    logger.debug("Assistant response: %s", content)
+
+    await output.close()
+    if output.first_token_latency is not None:
+        FIRST_TOKEN_SECONDS.observe(output.first_token_latency)
+        if timings is not None:
+            timings.record("first_token", output.first_token_latency)
+        logger.debug("Time to first visible token: %.3fs", output.first_token_latency)
+
+    response = output.text
+    history.append({"role": "assistant", "content": response})
+    history.maybe_summarize(smol_model)
+    return response
 
-        response = litellm.completion(
-            model=model,
-            messages=message_history,
-            tools=tools,
-            stream=False,
+async def speculative_completion(history: ConversationHistory, timings: Optional[TurnTimings] = None):
+    """
+    Decide whether the turn needs reviews, then open the main completion.
+
+    Most messages are settled by the local review_gate classifier, and the
+    main completion starts straight away with or without review context.
+    For ambiguous messages the model-backed gate and the main completion
+    run at the same time. If the gate decides reviews are needed, that
+    speculative call is cancelled and the completion is reissued with the
+    review context appended to history.
+
+    Returns:
+        The streamed main completion. Nothing from a speculative stream is
+        read until the gate has decided to keep it.
+    """
+    with timed(timings, "gate_local"):
+        review_context = review_gate.classify(history.messages, history.kinds)
+
+    if review_context is not None:
+        GATE_DECISIONS.inc(tier="local", fetch=review_context["fetch_reviews"])
+        if review_context["fetch_reviews"]:
+            await add_review_context(history, review_context.get("movie"))
+        return await main_completion(history)
+
+    speculative_task = asyncio.create_task(main_completion(history))
+    SPECULATION_STATS["turns"] += 1
+
+    try:
+        with timed(timings, "gate"):
+            review_context = await evaluate_review_need(history.gate_view())
+    except Exception as e:
+        logger.warning("Review evaluation failed, keeping speculative response: %s", e)
+        review_context = {}
+
+    if not review_context.get("fetch_reviews", False):
+        return await speculative_task
+
+    _discard(speculative_task)
+    SPECULATION_STATS["wasted"] += 1
+    logger.debug("Speculative completion discarded (waste ratio %.2f)", speculation_waste_ratio())
+
+    await add_review_context(history, review_context.get("movie"))
+    return await main_completion(history)
+
+async def main_completion(history: ConversationHistory, tool_choice: Optional[str] = None):
+    """
+    Open the streamed main completion on the model ROUTER picks for this
+    point in the turn, hedged if it is slow to start.
+    """
+    extra = {"tool_choice": tool_choice} if tool_choice else {}
+
+    def start(model_name: str):
+        messages, layout_tools = PROMPT_LAYOUTS[model_name].request(history)
+        return litellm.acompletion(
+            model=model_name,
+            messages=messages,
+            tools=layout_tools,
+            **stream_kwargs,
             **gen_kwargs,
+            **extra,
         )
-        
-        assistant_message = response.choices[0].message
-        tool_calls = getattr(assistant_message, 'tool_calls', None)
-        print("Received tool calls:", tool_calls)
-
-        if tool_calls:
-            available_functions = {
-                "get_now_playing": get_now_playing_movies,
-                "get_showtimes": get_showtimes,
-                "get_current_datetime": get_current_datetime,
-                "get_location_by_ip": get_location_by_ip,
-                "pick_random_movie": lambda: {"selected_movie": random.choice(get_now_playing_movies()["now_playing_movies"])},
-                "buy_ticket": buy_ticket,
-                "get_reviews": get_reviews,
-            }
-            
-            message_history.append(assistant_message)
-
-            for tool_call in tool_calls:
-                print("Handling tool call:", tool_call)
-                function_name = tool_call.function.name
-                function_to_call = available_functions.get(function_name)
-
-                if function_to_call:
-                    function_args = json.loads(tool_call.function.arguments)
-                    print(f"Calling function '{function_name}' with arguments:", function_args)
-                    result = function_to_call(**function_args)
-                    print(f"Function '{function_name}' returned:", result)
-                    
-                    message_history.append({
-                        "role": "tool",
-                        "name": function_name,
-                        "content": result,
-                        "tool_call_id": tool_call.id 
-                    })
-                    
-            second_response = litellm.completion(
-                model=model,
-                messages=message_history,
-                tools=tools,
-                stream=False,
-                **gen_kwargs,
-            )
-
-            second_response_content = second_response.choices[0].message.content
-            if second_response_content is not None:
-                await response_message.stream_token(second_response_content)
-            else:
-                print("Warning: Second response content is None")
-
-        else:
-            cleaned_response = assistant_message.content
-            print("Assistant response:", cleaned_response)
-            await response_message.stream_token(cleaned_response)
 
-        await response_message.update()
-        message_history.append({"role": "assistant", "content": response_message.content})
-        cl.user_session.set("message_history", message_history)
-        
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        print(f"An error occurred in on_message: {e}")
-        await cl.Message(content="An error occurred while processing your request.").send()
+    return await ROUTER.complete(ROUTER.route(history), start)
+
+def resolve_turn_context() -> str:
+    """
+    The date, time and, when already cached, the location for this turn.
+
+    This saves the model a tool round trip for facts that never need it.
+    It is appended as a user message, not a system one, so the system prompt
+    stays the only system message (see PromptLayout). The location lookup is
+    a blocking HTTP call, so a miss is filled in the background and used
+    from the next turn on.
+    """
+    context = f"Turn context: the current date and time is {get_current_datetime()}."
+    remaining = get_location_by_ip.remaining_ttl()
+    if remaining is not None and remaining > 0:
+        location = get_location_by_ip()
+        if location != "Location unavailable":
+            context += f" The user's approximate location is {location}."
+    else:
+        warm_location()
+    return context
+
+
+def warm_location() -> None:
+    """Fill the location cache in the background, unless a lookup is already running."""
+    global _location_warmup
+    if _location_warmup is None or _location_warmup.done():
+        _location_warmup = asyncio.ensure_future(run_in_pool(get_location_by_ip))
+        _location_warmup.add_done_callback(_log_warmup_failure)
+
+def _log_warmup_failure(future: asyncio.Future):
+    # e.g. ipapi rate limited; the next turn tries again
+    if not future.cancelled() and future.exception() is not None:
+        logger.info("Location lookup failed: %s", future.exception())
+
+async def add_review_context(history: ConversationHistory, movie: Optional[str]):
+    question = review_gate.last_user_message(history.messages, history.kinds)
+    context_message = await get_review_context(movie, question)
+    logger.debug("Update with review context: %s", context_message)
+    history.append(context_message, kind=KIND_CONTEXT)
 
-def get_review_context(message_history: list[dict]):
-    # Evaluation for fetching movie reviews
-    stripped_message_history = [msg for msg in message_history if msg["role"] != "system"]
-    review_evaluation_response = litellm.completion(
+def _discard(task: asyncio.Task):
+    """Cancel a task whose result is no longer needed, without leaving its error unretrieved."""
+    task.cancel()
+    task.add_done_callback(_close_discarded)
+
+def _close_discarded(task: asyncio.Task):
+    if task.cancelled() or task.exception():
+        return
+    # The stream was already open; close it so the connection is released
+    close = getattr(task.result(), "aclose", None)
+    if close:
+        asyncio.ensure_future(close())
+
+def speculation_waste_ratio() -> float:
+    """Fraction of turns whose speculative main completion was thrown away."""
+    if not SPECULATION_STATS["turns"]:
+        return 0.0
+    return SPECULATION_STATS["wasted"] / SPECULATION_STATS["turns"]
+
+async def evaluate_review_need(gate_history: list[dict]) -> dict:
+    # Evaluation for fetching movie reviews, over a compact text-only view
+    # of the conversation
+    completion = litellm.acompletion if REVIEW_GATE_CACHE == "off" else GATE_CACHE.acompletion
+    review_evaluation_response = await completion(
         model=smol_model,
-        messages=stripped_message_history + [{"role": "system", "content": RAG_PROMPT}],
+        messages=gate_history + [{"role": "system", "content": RAG_PROMPT}],
+        response_format={"type": "json_object"},
         stream=False,
         **gen_kwargs
     )
     
-    review_context = review_evaluation_response.choices[0].message.content
-    review_context = json.loads(review_context)
-    print("Review Evaluation Result:", review_context)
-    
-    if review_context.get("fetch_reviews", False):
-      reviews = get_reviews(review_context.get("movie"))
-      reviews = f"Reviews for {review_context.get('movie')}:\n\n{reviews}"
-      context_message = {"role": "user", "content": f"Function call return for get_reviews: {reviews}"}
-    else:
-      context_message = None
-    
-    return context_message
+    reply = review_evaluation_response.choices[0].message.content
+    review_context = review_gate.parse_reply(reply)
+    if review_context is None:
+        GATE_DECISIONS.inc(tier="model", fetch="unreadable")
+        logger.warning("Unreadable review gate reply, not fetching reviews: %r", reply)
+        return review_gate.decision(None, False, "unreadable gate reply")
+    GATE_DECISIONS.inc(tier="model", fetch=review_context["fetch_reviews"])
+    logger.debug("Review Evaluation Result: %s", review_context)
+    return review_context
+
+async def get_review_context(movie: str, question: str) -> dict:
+    # Only the passages relevant to the question, not every full review
+    try:
+        reviews = await run_in_pool(retrieve_review_context, movie, question)
+        reviews = f"Reviews for {movie}:\n\n{reviews}"
+    except UpstreamError as e:
+        # e.g. TMDb rate limited: answer without reviews rather than fail the turn
+        logger.warning("Review context for %s unavailable: %s", movie, e)
+        reviews = f"Reviews for {movie} are temporarily unavailable."
+    return {"role": "user", "content": f"Function call return for get_reviews: {reviews}"}
     
+async def metrics_endpoint():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# Served next to the Chainlit UI. Chainlit registers a catch-all route for its
+# frontend, so /metrics has to come before it.
+chainlit_server.add_api_route("/metrics", metrics_endpoint, methods=["GET"], include_in_schema=False)
+chainlit_server.router.routes.insert(0, chainlit_server.router.routes.pop())
+
 if __name__ == "__main__":
     cl.main()
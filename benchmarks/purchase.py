@@ -0,0 +1,128 @@
+"""
+Load test for the ticket purchase engine.
+
+Simulates an on-sale rush: many buyers hit a few showtimes at once. Each
+buyer holds 1-4 seats, sometimes retries the hold (as an LLM retrying a
+tool call would), and confirms, sometimes twice. Holds run on a thread
+pool, like sync tool calls, so the shard locks see real contention;
+confirms go through the payment queue on the event loop.
+
+Reports confirmed purchases per second, hold and confirm latency
+percentiles, and checks that no seat was sold twice.
+
+Usage:
+    python -m benchmarks.purchase --buyers 2000 --showtimes 4
+    python -m benchmarks.purchase --buyers 2000 --showtimes 4 --shards 1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from benchmarks.run import RESULTS_DIR, summarize
+from purchases import LocalPaymentService, PaymentQueue, PurchaseEngine, PurchaseError
+
+
+async def buyer(engine: PurchaseEngine, pool: ThreadPoolExecutor, number: int, showtimes: int,
+                retry_rate: float, latencies: Dict[str, List[float]], outcomes: Dict[str, int]) -> None:
+    loop = asyncio.get_running_loop()
+    showtime = random.randrange(showtimes)
+    quantity = random.randint(1, 4)
+    key = f"buyer-{number}"
+
+    def hold():
+        return engine.hold("Cinema 0", "Wicked", f"7:30pm #{showtime}", quantity, key, idempotency_key=key)
+
+    started = time.perf_counter()
+    try:
+        attempts = 2 if random.random() < retry_rate else 1
+        holds = await asyncio.gather(*(loop.run_in_executor(pool, hold) for _ in range(attempts)))
+    except PurchaseError:
+        outcomes["sold_out"] += 1
+        return
+    latencies["hold"].append(time.perf_counter() - started)
+    if len({hold.hold_id for hold in holds}) != 1:
+        outcomes["duplicate_holds"] += 1
+
+    started = time.perf_counter()
+    try:
+        attempts = 2 if random.random() < retry_rate else 1
+        purchases = await asyncio.gather(*(engine.confirm(holds[0].hold_id, key) for _ in range(attempts)))
+    except PurchaseError:
+        outcomes["payment_failed"] += 1
+        return
+    latencies["confirm"].append(time.perf_counter() - started)
+    if len({purchase.purchase_id for purchase in purchases}) != 1:
+        outcomes["duplicate_purchases"] += 1
+    outcomes["confirmed"] += 1
+    outcomes["seats"] += len(purchases[0].seats)
+
+
+async def run_purchase_benchmark(args) -> dict:
+    service = LocalPaymentService(args.payment_latency, args.failure_rate)
+    engine = PurchaseEngine(PaymentQueue(service, workers=args.payment_workers, max_pending=args.buyers),
+                            shards=args.shards)
+    latencies: Dict[str, List[float]] = {"hold": [], "confirm": []}
+    outcomes = dict.fromkeys(
+        ("confirmed", "seats", "sold_out", "payment_failed", "duplicate_holds", "duplicate_purchases"), 0)
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            buyer(engine, pool, number, args.showtimes, args.retry_rate, latencies, outcomes)
+            for number in range(args.buyers)
+        ))
+        duration = time.perf_counter() - started
+
+    stats = engine.stats()
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": vars(args),
+        "duration_seconds": duration,
+        "confirmed_per_second": outcomes["confirmed"] / duration if duration else 0.0,
+        "outcomes": outcomes,
+        "latency": {step: summarize(values) for step, values in latencies.items()},
+        "engine": stats,
+        "charges": service.charges,
+        # Every seat the buyers paid for is sold exactly once, and charged once
+        "consistent": stats["seats_sold"] == outcomes["seats"] and service.charges == outcomes["confirmed"],
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buyers", type=int, default=2000, help="concurrent buyers")
+    parser.add_argument("--showtimes", type=int, default=4, help="showtimes they compete for (240 seats each)")
+    parser.add_argument("--threads", type=int, default=16, help="threads placing holds")
+    parser.add_argument("--shards", type=int, default=64, help="lock shards in the engine")
+    parser.add_argument("--payment-workers", type=int, default=32, help="payments charged at once")
+    parser.add_argument("--payment-latency", type=float, default=0.02, help="seconds per charge")
+    parser.add_argument("--failure-rate", type=float, default=0.02, help="fraction of charges declined")
+    parser.add_argument("--retry-rate", type=float, default=0.2, help="fraction of holds and confirms sent twice")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/purchase-<timestamp>.json)")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run_purchase_benchmark(args))
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = args.output or os.path.join(RESULTS_DIR, "purchase-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(f"\n{result['outcomes']['confirmed']} purchases in {result['duration_seconds']:.2f}s "
+          f"({result['confirmed_per_second']:.0f}/s), consistent: {result['consistent']}")
+    for step, stats in result["latency"].items():
+        print(f"{step:<10}{stats['count']:>7}  p50 {stats['p50'] * 1000:7.1f} ms  p95 {stats['p95'] * 1000:7.1f} ms"
+              f"  p99 {stats['p99'] * 1000:7.1f} ms")
+    print("outcomes:", result["outcomes"])
+    print("engine:", result["engine"])
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Tail latency with and without hedged LLM requests.
+
+Runs benchmarks.run twice against a stub LLM whose responses are
+occasionally slow (--llm-tail-rate of them take --llm-tail-latency longer),
+once with hedging off and once with it on. Both runs see the same slow
+responses, picked by a seeded random generator. Each run is a separate
+process, so neither inherits the other's caches or latency statistics.
+
+Reports turn and first-token p50/p95/p99 for both, how many completions
+were hedged, and whether both runs gave exactly the same answers: the
+stub answers deterministically, so hedging must not change them.
+
+Usage:
+    python -m benchmarks.routing --sessions 10 --rounds 3
+    python -m benchmarks.routing --llm-tail-rate 0.1 --llm-tail-latency 2
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+from benchmarks.run import RESULTS_DIR
+
+
+def run(args, hedging: bool, output: str) -> dict:
+    command = [
+        sys.executable, "-m", "benchmarks.run",
+        "--sessions", str(args.sessions), "--rounds", str(args.rounds),
+        "--llm-tail-rate", str(args.llm_tail_rate), "--llm-tail-latency", str(args.llm_tail_latency),
+        "--output", output,
+    ] + ([] if hedging else ["--no-hedging"])
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    with open(output) as f:
+        return json.load(f)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent chat sessions")
+    parser.add_argument("--rounds", type=int, default=3, help="scenarios each session plays")
+    parser.add_argument("--llm-tail-rate", type=float, default=0.05, help="fraction of LLM responses that are slow")
+    parser.add_argument("--llm-tail-latency", type=float, default=2.0, help="extra seconds for slow LLM responses")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/routing-<timestamp>.json)")
+    args = parser.parse_args(argv)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    runs = {
+        "unhedged": run(args, False, os.path.join(RESULTS_DIR, f"routing-{stamp}-unhedged.json")),
+        "hedged": run(args, True, os.path.join(RESULTS_DIR, f"routing-{stamp}-hedged.json")),
+    }
+    result = {
+        "config": vars(args),
+        "runs": {
+            name: {
+                "errors": len(data["errors"]),
+                "turn": data["stages"]["turn"],
+                "first_token": data["stages"].get("first_token"),
+                "routing": data["routing"],
+                "answers_digest": data["answers_digest"],
+            }
+            for name, data in runs.items()
+        },
+        "same_answers": runs["unhedged"]["answers_digest"] == runs["hedged"]["answers_digest"],
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"routing-{stamp}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(f"{'':<12}{'stage':<14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, data in result["runs"].items():
+        for stage in ("turn", "first_token"):
+            stats = data[stage]
+            if stats:
+                print(f"{name:<12}{stage:<14}{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}"
+                      f"{stats['p99'] * 1000:>10.1f}")
+    routing = result["runs"]["hedged"]["routing"]
+    print(f"\nhedged {routing['hedged']} of {routing['completions']} completions, "
+          f"hedge answered first {routing['hedge_wins']} times")
+    print("same answers:", result["same_answers"])
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
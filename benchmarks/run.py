@@ -0,0 +1,228 @@
+"""
+Offline load test for the movie assistant.
+
+Starts the local stubs, points the app at them, and replays the scripted
+conversations in scenarios.py through app.run_turn (the logic behind
+on_message) with N concurrent sessions. Reports throughput, per-stage
+latency percentiles, cache hit rates, prompt-cache reuse and peak RSS, and
+writes them to a JSON file so runs can be compared.
+
+After every turn the session's next prompt is checked against the previous
+one: "extended" means the previous prompt is a byte-for-byte prefix of it,
+so the provider's prompt cache can be reused. answers_digest hashes every
+visible answer, so two runs can be checked for giving the same answers.
+
+Usage:
+    python -m benchmarks.run --sessions 20 --rounds 3
+    python -m benchmarks.run --sessions 20 --baseline benchmarks/results/<earlier run>.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from benchmarks.scenarios import SCENARIOS, check_scripts
+from benchmarks.stubs import Stubs
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile, q in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), round(q / 100 * len(ordered) + 0.5)))
+    return ordered[rank - 1]
+
+
+def summarize(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def configure_environment(stubs: Stubs, shared_cache: bool) -> Dict[str, str]:
+    environment = stubs.environment()
+    environment.update({
+        "API_CACHE_DB": os.path.join(RESULTS_DIR, "bench_cache.sqlite3") if shared_cache else "",
+        "PREFETCH_ENABLED": "0",
+        # Count quotas in memory, not against the real ones on disk
+        "RATE_LIMIT_DB": "",
+        "LANGCHAIN_TRACING_V2": "false",
+        "LANGSMITH_TRACING": "false",
+        "LITELLM_LOCAL_MODEL_COST_MAP": "True",
+    })
+    os.environ.update(environment)
+    return environment
+
+
+async def run_session(app, session: int, rounds: int, stages: Dict[str, List[float]], errors: List[str],
+                      prefixes: Dict[str, int], answers: Dict[str, str]) -> int:
+    from history import ConversationHistory
+    from prompt_layout import shared_prefix
+    from prompts import SYSTEM_PROMPT
+    from timing import TurnTimings
+
+    async def discard(token: str):
+        pass
+
+    names = list(SCENARIOS)
+    turns = 0
+    for round_number in range(rounds):
+        scenario = SCENARIOS[names[(session + round_number) % len(names)]]
+        history = ConversationHistory(SYSTEM_PROMPT, model=app.model)
+        previous_prompt = None
+        for number, turn in enumerate(scenario):
+            timings = TurnTimings()
+            started = time.perf_counter()
+            try:
+                answer = await app.run_turn(history, turn["user"], discard, started, timings)
+            except Exception as e:
+                errors.append(f"session {session}: {turn['user']!r}: {e}")
+                continue
+            timings.record("turn", time.perf_counter() - started)
+            answers[f"{session}/{round_number}/{number}"] = answer
+            for stage, durations in timings.as_dict().items():
+                stages.setdefault(stage, []).extend(durations)
+            turns += 1
+
+            prompt, _ = app.PROMPT_LAYOUT.request(history)
+            if previous_prompt is not None:
+                extended = shared_prefix(previous_prompt, prompt) == len(previous_prompt)
+                prefixes["extended" if extended else "rewritten"] += 1
+            previous_prompt = prompt
+    return turns
+
+
+async def run_benchmark(args) -> dict:
+    stubs = Stubs(args.llm_latency, args.token_interval, args.api_latency,
+                  args.llm_tail_rate, args.llm_tail_latency).start()
+    environment = configure_environment(stubs, args.shared_cache)
+
+    import litellm
+    import app
+    from cache import clear_cache, get_cache_stats, get_flight_stats
+    from completion_cache import get_completion_cache_stats
+    from http_client import pool_stats
+    from prefetch import PREFETCHER
+    from rate_limit import RATE_LIMITS
+
+    # Importing app loads .env over the environment; point it back at the stubs
+    os.environ.update(environment)
+    litellm.success_callback = []
+    litellm.set_verbose = False
+    app.ROUTER.hedging = not args.no_hedging
+    clear_cache()
+    for turns in SCENARIOS.values():
+        stubs.llm.add_script(turns)
+    check_scripts(SCENARIOS, app.TOOL_REGISTRY)
+
+    stages: Dict[str, List[float]] = {}
+    errors: List[str] = []
+    prefixes = {"extended": 0, "rewritten": 0}
+    answers: Dict[str, str] = {}
+    started = time.perf_counter()
+    turns = await asyncio.gather(*(
+        run_session(app, session, args.rounds, stages, errors, prefixes, answers)
+        for session in range(args.sessions)
+    ))
+    duration = time.perf_counter() - started
+    stubs.stop()
+
+    completed = sum(turns)
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": vars(args),
+        "turns": completed,
+        "errors": errors,
+        "duration_seconds": duration,
+        "throughput_turns_per_second": completed / duration if duration else 0.0,
+        "stages": {stage: summarize(values) for stage, values in sorted(stages.items())},
+        "cache": get_cache_stats(),
+        "flights": get_flight_stats(),
+        "completion_caches": get_completion_cache_stats(),
+        "http": pool_stats(),
+        "rate_limits": RATE_LIMITS.stats(),
+        "prefetch": PREFETCHER.stats(),
+        "speculation_waste_ratio": app.speculation_waste_ratio(),
+        "upstream_requests": stubs.request_counts(),
+        "llm_tokens": stubs.llm_tokens(),
+        "prompt_prefix": prefixes,
+        "routing": app.ROUTER.stats(),
+        "answers_digest": hashlib.blake2b(json.dumps(sorted(answers.items())).encode(), digest_size=16).hexdigest(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def print_report(result: dict, baseline: dict = None) -> None:
+    print(f"\n{result['turns']} turns in {result['duration_seconds']:.2f}s "
+          f"({result['throughput_turns_per_second']:.2f} turns/s), "
+          f"{len(result['errors'])} errors, peak RSS {result['peak_rss_mb']:.1f} MB")
+    print(f"{'stage':<28}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, stats in result["stages"].items():
+        line = (f"{stage:<28}{stats['count']:>6}{stats['p50'] * 1000:>10.1f}"
+                f"{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}")
+        previous = (baseline or {}).get("stages", {}).get(stage)
+        if previous and previous["p95"]:
+            line += f"   p95 {100 * (stats['p95'] / previous['p95'] - 1):+.0f}% vs baseline"
+        print(line)
+    print("cache hit rates:", {name: round(stats["hit_rate"], 2) for name, stats in result["cache"].items()})
+    print("upstream requests:", result["upstream_requests"])
+    tokens = result["llm_tokens"]
+    print(f"prompt tokens: {tokens['prompt']}, "
+          f"{100 * tokens['prompt_cached'] / tokens['prompt'] if tokens['prompt'] else 0:.0f}% cached; "
+          f"prompt prefix between turns: {result['prompt_prefix']}")
+    for error in result["errors"][:5]:
+        print("error:", error)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent chat sessions")
+    parser.add_argument("--rounds", type=int, default=2, help="scenarios each session plays")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds before each LLM response")
+    parser.add_argument("--token-interval", type=float, default=0.005, help="seconds between streamed chunks")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="seconds per TMDb/SerpAPI/ipapi request")
+    parser.add_argument("--llm-tail-rate", type=float, default=0.0, help="fraction of LLM responses that are slow")
+    parser.add_argument("--llm-tail-latency", type=float, default=1.0, help="extra seconds for slow LLM responses")
+    parser.add_argument("--no-hedging", action="store_true", help="don't hedge slow main completions")
+    parser.add_argument("--shared-cache", action="store_true", help="use the SQLite shared cache")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", help="earlier result file to compare p95 latencies against")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run_benchmark(args))
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = args.output or os.path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2, default=str)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Scripted conversations for the benchmarks.
+
+Each turn is what the user says, plus what StubLLM answers:
+  - tool_calls: tools the main completion calls, as {"name", "arguments"}
+  - reviews_for: movie the review gate asks reviews for, if any
+  - reply: the final streamed answer, thought process included
+"""
+from typing import Dict, List
+
+from tool_registry import ToolRegistry
+
+
+def _reply(text: str) -> str:
+    return f"<thought_process>Scripted reasoning for the benchmark.</thought_process>\n{text}"
+
+
+SCENARIOS: Dict[str, List[dict]] = {
+    "now_playing_and_showtimes": [
+        {
+            "user": "What movies are playing right now?",
+            "tool_calls": [{"name": "get_now_playing", "arguments": {}}],
+            "reply": _reply("Dune: Part Two, Inside Out 2, Gladiator II, Wicked and Moana 2 are playing."),
+        },
+        {
+            "user": "Where is Wicked playing near me?",
+            # The location comes from the turn context
+            "tool_calls": [{"name": "get_showtimes", "arguments": {"title": "Wicked", "location": "Austin, TX"}}],
+            "reply": _reply("Wicked is showing at Cinema 0, 1 and 2 today, with IMAX at 6:45pm."),
+        },
+        {
+            "user": "And tomorrow for Moana 2?",
+            "tool_calls": [{"name": "get_showtimes", "arguments": {"title": "Moana 2", "location": "Austin, TX"}}],
+            "reply": _reply("Tomorrow Moana 2 plays at 1:00pm, 4:15pm and 7:30pm."),
+        },
+        {
+            "user": "What else is on tonight near me?",
+            # One bulk call instead of a get_showtimes round per movie
+            "tool_calls": [{"name": "get_showtimes_bulk",
+                            "arguments": {"titles": ["Dune: Part Two", "Inside Out 2", "Gladiator II"],
+                                          "locations": ["Austin, TX"]}}],
+            "reply": _reply("Tonight there is Dune: Part Two at 7:30pm, Inside Out 2 at 6:45pm and Gladiator II at 10:00pm."),
+        },
+    ],
+    "reviews": [
+        {
+            "user": "Is Dune: Part Two worth seeing?",
+            "reviews_for": "Dune: Part Two",
+            "reply": _reply("Critics love the cinematography and sound, though some say the middle drags."),
+        },
+        {
+            "user": "What do people say about Gladiator II?",
+            "tool_calls": [{"name": "get_reviews", "arguments": {"movie_title": "Gladiator II"}}],
+            "reply": _reply("Reviews praise the performances and the set pieces."),
+        },
+    ],
+    "chit_chat": [
+        {"user": "Who directed the original Alien?", "reply": _reply("Ridley Scott directed Alien (1979).")},
+        {
+            "user": "Pick something for me to watch tonight.",
+            "tool_calls": [{"name": "pick_random_movie", "arguments": {}}],
+            "reply": _reply("How about Inside Out 2?"),
+        },
+    ],
+}
+
+
+def check_scripts(scenarios: Dict[str, List[dict]], registry: ToolRegistry) -> None:
+    """Fail fast if a script calls a tool the app does not provide, or with arguments it rejects."""
+    for name, turns in scenarios.items():
+        for turn in turns:
+            for call in turn.get("tool_calls") or []:
+                spec = registry.get(call["name"])
+                if spec is None:
+                    raise ValueError(f"Scenario {name!r} calls unknown tool {call['name']!r}")
+                spec.validate(call["arguments"])
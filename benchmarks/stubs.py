@@ -0,0 +1,391 @@
+"""
+Local stand-ins for every upstream the app talks to.
+
+Each stub is a small HTTP server on a free localhost port with a fixed,
+configurable latency per request:
+
+- StubLLM: an OpenAI-compatible /v1/chat/completions endpoint that plays
+  back scripted turns, streamed or not, and reports prompt-cache hits the
+  way OpenAI's automatic prefix caching does. A fraction of its responses
+  can be made slow, like a provider's latency tail
+- StubTMDb: now_playing, search/movie and movie/{id}/reviews
+- StubSerpAPI: search.json showtimes results
+- StubIpapi: ipapi.co location lookups
+"""
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from prompts import RAG_PROMPT, SUMMARY_PROMPT
+
+# Movies served by StubTMDb and StubSerpAPI
+MOVIES: List[dict] = [
+    {"id": 1001, "title": "Dune: Part Two", "release_date": "2024-02-27",
+     "overview": "Paul Atreides unites with the Fremen while on a path of revenge."},
+    {"id": 1002, "title": "Inside Out 2", "release_date": "2024-06-11",
+     "overview": "Riley's mind headquarters is undergoing a sudden demolition to make room for new emotions."},
+    {"id": 1003, "title": "Gladiator II", "release_date": "2024-11-13",
+     "overview": "Lucius is forced to enter the Colosseum after his home is conquered."},
+    {"id": 1004, "title": "Wicked", "release_date": "2024-11-20",
+     "overview": "Elphaba and Galinda forge an unlikely friendship in the Land of Oz."},
+    {"id": 1005, "title": "Moana 2", "release_date": "2024-11-21",
+     "overview": "Moana journeys to the far seas of Oceania after an unexpected call from her ancestors."},
+]
+
+# OpenAI only caches prompts of at least this many tokens, in CACHE_INCREMENT steps
+CACHE_MIN_TOKENS = 1024
+CACHE_INCREMENT = 128
+
+REVIEW_TEXT = (
+    "The cinematography is stunning and the score carries the big set pieces. "
+    "Some of the middle act drags, and a few characters get little to do. "
+    "The performances are strong across the board, especially the lead.\n\n"
+    "Pacing aside, it is one of the better theatrical experiences of the year. "
+    "See it on the biggest screen you can find; the sound design alone is worth it."
+)
+
+
+class StubServer(ThreadingHTTPServer):
+    """A ThreadingHTTPServer on 127.0.0.1 that serves from a daemon thread."""
+
+    daemon_threads = True
+
+    def __init__(self, handler, latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def handle_error(self, request, client_address) -> None:
+        # Clients hang up on streams they no longer need, e.g. the losing
+        # request of a hedged completion
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _begin(self) -> None:
+        self.server.count()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def send_json(self, data, status: int = 200) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def query(self) -> Dict[str, str]:
+        return {key: values[0] for key, values in parse_qs(urlsplit(self.path).query).items()}
+
+
+class TMDbHandler(StubHandler):
+    def do_GET(self):
+        self._begin()
+        path = urlsplit(self.path).path
+        if path.endswith("/movie/now_playing"):
+            return self.send_json({"page": 1, "results": MOVIES})
+        if path.endswith("/search/movie"):
+            query = self.query().get("query", "").lower()
+            results = [movie for movie in MOVIES if query and query in movie["title"].lower()]
+            return self.send_json({"page": 1, "results": results})
+        match = re.search(r"/movie/(\d+)/reviews$", path)
+        if match:
+            movie_id = int(match.group(1))
+            reviews = [
+                {
+                    "author": f"critic{n}",
+                    "author_details": {"rating": 5 + (movie_id + n) % 5},
+                    "content": REVIEW_TEXT,
+                    "created_at": "2024-11-01T00:00:00.000Z",
+                    "url": f"https://www.themoviedb.org/review/{movie_id}-{n}",
+                }
+                for n in range(6)
+            ]
+            return self.send_json({"id": movie_id, "page": 1, "results": reviews})
+        self.send_json({"status_message": "not found"}, status=404)
+
+
+class SerpAPIHandler(StubHandler):
+    def do_GET(self):
+        self._begin()
+        location = self.query().get("location", "Unknown")
+        days = []
+        for day, date in (("Today", "Nov 22"), ("Tomorrow", "Nov 23")):
+            theaters = [
+                {
+                    "name": f"Cinema {n} {location}",
+                    "address": f"{100 + n} Main St",
+                    "distance": f"{n + 1}.0 mi",
+                    "showing": [
+                        {"time": ["1:00pm", "4:15pm", "7:30pm"], "type": "Standard"},
+                        {"time": ["6:45pm", "10:00pm"], "type": "IMAX"},
+                    ],
+                }
+                for n in range(3)
+            ]
+            days.append({"day": day, "date": date, "theaters": theaters})
+        self.send_json({"search_metadata": {"status": "Success"}, "showtimes": days})
+
+
+class IpapiHandler(StubHandler):
+    def do_GET(self):
+        self._begin()
+        self.send_json({"ip": "127.0.0.1", "city": "Austin", "region": "Texas", "country_name": "United States"})
+
+
+class LLMHandler(StubHandler):
+    """
+    OpenAI-compatible chat completions, answered from StubLLM.scripts.
+
+    Requests are classified from their messages:
+      - review gate: the last message is the RAG_PROMPT system message
+      - summary: the first message is the SUMMARY_PROMPT system message
+      - main completion: everything else. If tool results follow the last
+        user message, or the turn has no tool calls, the scripted reply is
+        returned; otherwise the scripted tool calls are.
+    """
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        self._begin()
+        tail = self.server.tail_delay()
+        if tail:
+            time.sleep(tail)
+        messages = request.get("messages") or []
+        turn = self.server.script_for(messages)
+        request["usage"] = self.server.prompt_usage(request)
+
+        if messages and messages[-1].get("role") == "system" and messages[-1].get("content") == RAG_PROMPT:
+            movie = turn.get("reviews_for")
+            content = json.dumps({"movie": movie, "fetch_reviews": bool(movie), "rationale": "scripted"})
+            return self.send_json(_completion(request, content))
+        if messages and messages[0].get("content") == SUMMARY_PROMPT:
+            return self.send_json(_completion(request, "The user asked about movies now playing."))
+
+        last_role = messages[-1].get("role") if messages else "user"
+        tool_calls = turn.get("tool_calls") or []
+        if tool_calls and last_role == "user" and not _is_context(messages[-1]):
+            content, calls = turn.get("preamble", ""), tool_calls
+        else:
+            content, calls = turn.get("reply", "Here you go."), []
+
+        if request.get("stream"):
+            return self.send_stream(request, content, calls)
+        self.send_json(_completion(request, content, calls))
+
+    def send_stream(self, request: dict, content: str, tool_calls: List[dict]) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        chunks = [{"role": "assistant", "content": ""}]
+        chunks += [{"content": word} for word in re.findall(r"\S+\s*", content)]
+        for index, call in enumerate(tool_calls):
+            arguments = json.dumps(call.get("arguments") or {})
+            chunks.append({"tool_calls": [{"index": index, "id": f"call_{index}", "type": "function",
+                                           "function": {"name": call["name"], "arguments": ""}}]})
+            # Arguments arrive in pieces, as they do from the real API
+            for start in range(0, len(arguments), 16):
+                chunks.append({"tool_calls": [{"index": index, "function": {"arguments": arguments[start:start + 16]}}]})
+
+        for delta in chunks:
+            self._write_event(_chunk(request, delta))
+            if self.server.token_interval:
+                time.sleep(self.server.token_interval)
+        self._write_event(_chunk(request, {}, "tool_calls" if tool_calls else "stop"))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            usage_chunk = _chunk(request, {})
+            usage_chunk["choices"] = []
+            usage_chunk["usage"] = _completion(request, content)["usage"]
+            self._write_event(usage_chunk)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _write_event(self, data: dict) -> None:
+        self.wfile.write(f"data: {json.dumps(data)}\n\n".encode())
+        self.wfile.flush()
+
+
+def _is_context(message: dict) -> bool:
+    return str(message.get("content") or "").startswith("Function call return for")
+
+
+def _completion(request: dict, content: str, tool_calls: Optional[List[dict]] = None) -> dict:
+    message = {"role": "assistant", "content": content or None}
+    if tool_calls:
+        message["tool_calls"] = [
+            {"id": f"call_{index}", "type": "function",
+             "function": {"name": call["name"], "arguments": json.dumps(call.get("arguments") or {})}}
+            for index, call in enumerate(tool_calls)
+        ]
+    completion_tokens = max(1, len(content.split()))
+    prompt_tokens, cached_tokens = request.get("usage", (100, 0))
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "stub"),
+        "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens,
+                  "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+    }
+
+
+def _chunk(request: dict, delta: dict, finish_reason: Optional[str] = None) -> dict:
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": request.get("model", "stub"),
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+class StubLLM(StubServer):
+    """
+    Scripted OpenAI-compatible LLM.
+
+    Args:
+        latency: Seconds before the first byte of every response
+        token_interval: Seconds between streamed chunks
+        tail_rate: Fraction of responses delayed by tail_latency more
+        tail_latency: Extra seconds for the slow responses
+        seed: Seed for picking the slow responses, so runs are comparable
+    """
+
+    def __init__(self, latency: float = 0.0, token_interval: float = 0.0, tail_rate: float = 0.0,
+                 tail_latency: float = 0.0, seed: int = 0):
+        super().__init__(LLMHandler, latency)
+        self.token_interval = token_interval
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self._random = random.Random(seed)
+        # user message -> scripted turn (see scenarios.py)
+        self.scripts: Dict[str, dict] = {}
+        # Hashes of every prompt prefix seen, at message boundaries
+        self._prefixes: set = set()
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def add_script(self, turns: List[dict]) -> None:
+        for turn in turns:
+            self.scripts[turn["user"]] = turn
+
+    def prompt_usage(self, request: dict) -> tuple:
+        """
+        (prompt tokens, cached prompt tokens) for a request, at 4 bytes a token.
+
+        The cached part is the longest prefix, tools first and then whole
+        messages, that an earlier request started with.
+        """
+        parts = [json.dumps(request.get("tools") or [])] + [json.dumps(m) for m in request.get("messages") or []]
+        digest = hashlib.blake2b(digest_size=16)
+        size = cached = 0
+        with self._lock:
+            for part in parts:
+                digest.update(part.encode())
+                size += len(part)
+                key = digest.hexdigest()
+                if key in self._prefixes:
+                    cached = size
+                else:
+                    self._prefixes.add(key)
+            prompt_tokens = size // 4
+            cached_tokens = cached // 4 // CACHE_INCREMENT * CACHE_INCREMENT if prompt_tokens >= CACHE_MIN_TOKENS else 0
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+        return prompt_tokens, cached_tokens
+
+    def tail_delay(self) -> float:
+        """Extra seconds for this response: tail_latency for tail_rate of them, otherwise 0."""
+        if not self.tail_rate:
+            return 0.0
+        with self._lock:
+            return self.tail_latency if self._random.random() < self.tail_rate else 0.0
+
+    def script_for(self, messages: List[dict]) -> dict:
+        for message in reversed(messages):
+            if message.get("role") == "user" and not _is_context(message):
+                return self.scripts.get(message.get("content"), {})
+        return {}
+
+
+class Stubs:
+    """Starts every stub and exposes the environment that points the app at them."""
+
+    def __init__(self, llm_latency: float = 0.05, token_interval: float = 0.0, api_latency: float = 0.02,
+                 llm_tail_rate: float = 0.0, llm_tail_latency: float = 0.0):
+        self.llm = StubLLM(llm_latency, token_interval, llm_tail_rate, llm_tail_latency)
+        self.tmdb = StubServer(TMDbHandler, api_latency)
+        self.serpapi = StubServer(SerpAPIHandler, api_latency)
+        self.ipapi = StubServer(IpapiHandler, api_latency)
+
+    def start(self) -> "Stubs":
+        for server in (self.llm, self.tmdb, self.serpapi, self.ipapi):
+            server.start()
+        return self
+
+    def stop(self) -> None:
+        for server in (self.llm, self.tmdb, self.serpapi, self.ipapi):
+            server.stop()
+
+    def environment(self) -> Dict[str, str]:
+        return {
+            "OPENAI_API_BASE": f"{self.llm.url}/v1",
+            "OPENAI_API_KEY": "sk-stub",
+            "TMDB_API_BASE": f"{self.tmdb.url}/3",
+            "TMDB_API_ACCESS_TOKEN": "stub",
+            "SERPAPI_SEARCH_URL": f"{self.serpapi.url}/search.json",
+            "SERP_API_KEY": "stub",
+            "IPAPI_BASE": self.ipapi.url,
+        }
+
+    def llm_tokens(self) -> Dict[str, int]:
+        return {"prompt": self.llm.prompt_tokens, "prompt_cached": self.llm.cached_tokens}
+
+    def request_counts(self) -> Dict[str, int]:
+        return {
+            "llm": self.llm.requests,
+            "tmdb": self.tmdb.requests,
+            "serpapi": self.serpapi.requests,
+            "ipapi": self.ipapi.requests,
+        }
@@ -0,0 +1,453 @@
+import inspect
+import logging
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from cache_keys import make_cache_key, register_canonicalizer
+from cache_store import CacheBackend, SQLiteCacheBackend
+from metrics import REGISTRY, Gauges
+from rate_limit import background_priority
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Global cache registry
+# Structure: {
+#   'function_name': FunctionCache({'canonical args digest': CacheEntry})
+# }
+# Each memoized function owns its own LRU region, so bounds, TTLs and
+# clear_cache_for_function never touch another function's entries.
+_CACHE: Dict[str, "FunctionCache"] = {}
+
+# Optional shared store behind the in-process regions (L2). The regions act
+# as a local L1 in front of it. Configured from the environment on first use,
+# so a .env loaded after import is still honoured.
+_BACKEND: Optional[CacheBackend] = None
+_BACKEND_CONFIGURED = False
+_BACKEND_LOCK = threading.Lock()
+
+
+def set_cache_backend(backend: Optional[CacheBackend]) -> None:
+    """Install (or with None, remove) the shared cache backend."""
+    global _BACKEND, _BACKEND_CONFIGURED
+    if _BACKEND is not None and _BACKEND is not backend:
+        _BACKEND.close()
+    _BACKEND = backend
+    _BACKEND_CONFIGURED = True
+
+
+def _backend() -> Optional[CacheBackend]:
+    if not _BACKEND_CONFIGURED:
+        with _BACKEND_LOCK:
+            if not _BACKEND_CONFIGURED:
+                configure_cache_from_env()
+    return _BACKEND
+
+
+def configure_cache_from_env() -> None:
+    """
+    Set up the shared on-disk cache from the API_CACHE_DB environment variable.
+
+    Defaults to .cache/api_cache.sqlite3. Set API_CACHE_DB to an empty string
+    to keep the cache in-process only.
+    """
+    path = os.getenv("API_CACHE_DB", ".cache/api_cache.sqlite3")
+    if not path:
+        set_cache_backend(None)
+        return
+    try:
+        set_cache_backend(SQLiteCacheBackend(path))
+    except Exception as e:
+        logger.warning("Shared cache unavailable, using in-process cache only: %s", e)
+        set_cache_backend(None)
+
+
+# Upstream calls currently running, keyed on the shared cache key
+_FLIGHTS = SingleFlight()
+
+# Background refreshes for stale-while-revalidate entries
+_REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cache-refresh")
+
+# (function name, age in seconds) of stale-if-error results served in the
+# current track_stale() block
+_STALE_SERVED: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("stale_served", default=None)
+
+
+@contextmanager
+def track_stale() -> Iterator[List[Tuple[str, float]]]:
+    """
+    Collect the stale results served in this block because a refresh failed.
+
+    Yields:
+        A list that fills with (function name, age in seconds) pairs
+    """
+    served: List[Tuple[str, float]] = []
+    token = _STALE_SERVED.set(served)
+    try:
+        yield served
+    finally:
+        _STALE_SERVED.reset(token)
+
+
+def _sizeof(value: Any) -> int:
+    """Approximate size in bytes of a cached value."""
+    if isinstance(value, (str, bytes)):
+        return sys.getsizeof(value)
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+class CacheEntry:
+    __slots__ = ("value", "expires_at", "size")
+
+    def __init__(self, value: Any, expires_at: Optional[float], size: int):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+
+    def is_expired(self, now: float, grace: float = 0.0) -> bool:
+        return self.expires_at is not None and now >= self.expires_at + grace
+
+
+class FunctionCache:
+    """
+    A bounded LRU region holding one function's cached results.
+
+    Args:
+        name: Name of the memoized function
+        ttl: Seconds an entry stays fresh, or None to never expire
+        max_entries: Maximum number of entries before LRU eviction
+        max_bytes: Maximum approximate total size of values before LRU eviction
+        stale_ttl: Seconds past expiry an entry may still be served as stale
+    """
+
+    def __init__(self, name: str, ttl: Optional[float] = None,
+                 max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+                 stale_ttl: float = 0.0):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.shared_hits = 0
+        self.stale_hits = 0
+        self.stale_errors = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[bool, Any, bool]:
+        """Return (found, value, is_stale) for key, counting the hit or miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.is_expired(now, self.stale_ttl):
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None, False
+            self.entries.move_to_end(key)
+            if entry.is_expired(now):
+                self.stale_hits += 1
+                return True, entry.value, True
+            self.hits += 1
+            return True, entry.value, False
+
+    def peek(self, key: str) -> tuple[bool, Any]:
+        """Return (found, value) for a fresh entry without touching counters or LRU order."""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.is_expired(time.monotonic()):
+                return False, None
+            return True, entry.value
+
+    def remaining(self, key: str) -> Optional[float]:
+        """Seconds until key's entry goes stale (negative once stale), or None if absent."""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at is None:
+                return float("inf")
+            return entry.expires_at - time.monotonic()
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """Store value; ttl overrides the region's TTL, e.g. for the remaining life of an L2 entry."""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        size = _sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Larger than the whole region; caching it would evict everything
+            return
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = CacheEntry(value, expires_at, size)
+            self.total_bytes += size
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "shared_hits": self.shared_hits,
+            "stale_hits": self.stale_hits,
+            "stale_errors": self.stale_errors,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _remove(self, key: str) -> None:
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry.size
+
+    def _evict(self) -> None:
+        while self.entries and (
+            (self.max_entries is not None and len(self.entries) > self.max_entries)
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            _, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry.size
+            self.evictions += 1
+
+
+def cache_region(name: str, ttl: Optional[float] = None, max_entries: Optional[int] = 256,
+                 max_bytes: Optional[int] = None, stale_ttl: float = 0.0) -> FunctionCache:
+    """The named region, created on first use, for caches that don't wrap a function."""
+    return _CACHE.setdefault(name, FunctionCache(
+        name, ttl=ttl, max_entries=max_entries, max_bytes=max_bytes, stale_ttl=stale_ttl,
+    ))
+
+
+def memoize_api_call(ttl: Optional[float] = None, max_entries: Optional[int] = 256,
+                     max_bytes: Optional[int] = None, enabled: bool = True,
+                     stale_while_revalidate: float = 0.0, stale_if_error: float = 0.0,
+                     canonicalize: Optional[Dict[str, Callable[[Any], Any]]] = None):
+    """
+    Decorator to memoize API calls
+
+    Concurrent misses for the same key, from threads or from asyncio tasks
+    running the function in a thread pool, share a single upstream call.
+
+    Args:
+        ttl: Seconds a cached result stays fresh, or None to keep it until evicted
+        max_entries: Maximum cached results for this function (LRU eviction)
+        max_bytes: Maximum approximate size of this function's cached results
+        enabled: Set to False for functions whose results must never be cached
+        stale_while_revalidate: Seconds past ttl during which the expired
+            result is still returned while one background call refreshes it
+        stale_if_error: Seconds past ttl during which the expired result is
+            returned if refreshing it raises, e.g. when the upstream is rate
+            limited. Callers see these in track_stale().
+        canonicalize: Per-parameter canonicalizers for building cache keys,
+            e.g. {"movie_title": normalize_title}
+    """
+    def decorator(func: Callable) -> Callable:
+        if not enabled:
+            return func
+
+        for parameter, canonicalizer in (canonicalize or {}).items():
+            register_canonicalizer(func.__name__, parameter, canonicalizer)
+        try:
+            signature = inspect.signature(func)
+        except (TypeError, ValueError):
+            signature = None
+
+        region = cache_region(func.__name__, ttl=ttl, max_entries=max_entries,
+                              max_bytes=max_bytes, stale_ttl=max(stale_while_revalidate, stale_if_error))
+
+        def load(cache_key: str, shared_key: str, args, kwargs):
+            # A flight that landed just before this one may have filled L1
+            found, value = region.peek(cache_key)
+            if found:
+                return value
+
+            found, value, expires_at = _backend_get(shared_key)
+            if found:
+                region.shared_hits += 1
+                remaining = expires_at - time.time() if expires_at is not None else None
+                region.set(cache_key, value, ttl=remaining)
+                return value
+
+            return fetch(cache_key, shared_key, args, kwargs)
+
+        def fetch(cache_key: str, shared_key: str, args, kwargs):
+            result = func(*args, **kwargs)
+            region.set(cache_key, result)
+            _backend_set(shared_key, result, ttl)
+            return result
+
+        def refresh(cache_key: str, shared_key: str, args, kwargs):
+            try:
+                # Another worker may have refreshed the shared entry already.
+                # Nobody is waiting for it, so it queues behind user requests.
+                with background_priority():
+                    _FLIGHTS.do(shared_key, load, cache_key, shared_key, args, kwargs)
+            except Exception as e:
+                logger.warning("Background refresh of %s failed, keeping stale value: %s", shared_key, e)
+
+        def keys(args, kwargs) -> tuple[str, str]:
+            # Canonical digest of the arguments; the function name is
+            # implied by the region
+            cache_key = make_cache_key(func, signature, args, kwargs)
+            return cache_key, f"{func.__name__}:{cache_key}"
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            cache_key, shared_key = keys(args, kwargs)
+
+            found, value, is_stale = region.get(cache_key)
+            if found and is_stale:
+                expired_for = -(region.remaining(cache_key) or 0.0)
+                if expired_for > stale_while_revalidate:
+                    return revalidate(cache_key, shared_key, args, kwargs, value, expired_for)
+                if not _FLIGHTS.in_flight(shared_key):
+                    _REFRESH_EXECUTOR.submit(copy_context().run, refresh, cache_key, shared_key, args, kwargs)
+            if found:
+                return value
+
+            return _FLIGHTS.do(shared_key, load, cache_key, shared_key, args, kwargs)
+
+        def revalidate(cache_key: str, shared_key: str, args, kwargs, stale_value, expired_for: float):
+            # Past stale-while-revalidate: wait for a fresh result, keeping
+            # the stale one in case the upstream can't give one
+            try:
+                return _FLIGHTS.do(shared_key, load, cache_key, shared_key, args, kwargs)
+            except Exception as e:
+                region.stale_errors += 1
+                logger.warning("Refreshing %s failed, serving the stale result: %s", shared_key, e)
+                served = _STALE_SERVED.get()
+                if served is not None:
+                    served.append((func.__name__, (ttl or 0.0) + expired_for))
+                return stale_value
+
+        def force_refresh(*args, **kwargs):
+            """Call through to the function and replace the cached result, even if fresh."""
+            cache_key, shared_key = keys(args, kwargs)
+            return _FLIGHTS.do(shared_key, fetch, cache_key, shared_key, args, kwargs)
+
+        def remaining_ttl(*args, **kwargs) -> Optional[float]:
+            """Seconds the cached result for these arguments stays fresh, or None if not cached."""
+            return region.remaining(keys(args, kwargs)[0])
+
+        wrapper.cache = region
+        wrapper.force_refresh = force_refresh
+        wrapper.remaining_ttl = remaining_ttl
+        return wrapper
+    return decorator
+
+
+def _backend_get(key: str) -> tuple[bool, Any, Optional[float]]:
+    # The shared store is an optimization; never let it fail a request
+    backend = _backend()
+    if backend is None:
+        return False, None, None
+    try:
+        return backend.get(key)
+    except Exception as e:
+        logger.warning("Shared cache read failed for %s: %s", key, e)
+        return False, None, None
+
+
+def _backend_set(key: str, value: Any, ttl: Optional[float]) -> None:
+    backend = _backend()
+    if backend is None:
+        return
+    try:
+        backend.set(key, value, ttl)
+    except Exception as e:
+        logger.warning("Shared cache write failed for %s: %s", key, e)
+
+
+def clear_cache():
+    """Clear the entire API cache"""
+    for region in _CACHE.values():
+        region.clear()
+    backend = _backend()
+    if backend is not None:
+        backend.clear()
+
+
+def clear_cache_for_function(function_name: str):
+    """Clear cache entries for a specific function"""
+    region = _CACHE.get(function_name)
+    if region is not None:
+        region.clear()
+    backend = _backend()
+    if backend is not None:
+        backend.delete_prefix(f"{function_name}:")
+
+
+def get_cache_stats() -> Dict[str, dict]:
+    """Hit, miss, eviction and size counters for every memoized function"""
+    return {name: region.stats() for name, region in _CACHE.items()}
+
+
+def get_flight_stats() -> dict:
+    """Upstream executions versus callers that shared another caller's in-flight call"""
+    return _FLIGHTS.stats()
+
+
+def print_cache_status():
+    """Print the current contents of the cache"""
+    print("\n[CACHE STATUS]")
+    print(f"Total cached items: {sum(len(region.entries) for region in _CACHE.values())}")
+    for name, region in _CACHE.items():
+        stats = region.stats()
+        print(f"- {name}: {stats['entries']} entries, {stats['bytes']} bytes, "
+              f"{stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
+        for key in region.entries:
+            print(f"    - {key}")
+
+
+def _cache_samples(field: str):
+    return [({"function": name}, stats[field]) for name, stats in get_cache_stats().items()]
+
+
+# The regions keep their own counters; export them at scrape time instead of
+# counting twice on the hot path
+for _field, _kind, _help in (
+    ("hits", "counter", "Fresh L1 cache hits."),
+    ("misses", "counter", "L1 cache misses."),
+    ("stale_hits", "counter", "Stale results served while revalidating."),
+    ("shared_hits", "counter", "L1 misses answered by the shared cache."),
+    ("stale_errors", "counter", "Expired results served because refreshing them failed."),
+    ("evictions", "counter", "Entries evicted by the LRU bounds."),
+    ("entries", "gauge", "Entries currently cached."),
+    ("bytes", "gauge", "Approximate bytes currently cached."),
+):
+    REGISTRY.register(Gauges(
+        f"movie_cache_{_field}" + ("_total" if _kind == "counter" else ""), _help,
+        lambda field=_field: _cache_samples(field), kind=_kind,
+    ))
+REGISTRY.register(Gauges(
+    "movie_cache_upstream_calls_total", "Upstream calls made versus callers that shared one.",
+    lambda: [({"result": "executed"}, _FLIGHTS.executions), ({"result": "coalesced"}, _FLIGHTS.coalesced)],
+    kind="counter",
+))
@@ -0,0 +1,124 @@
+import hashlib
+import inspect
+import re
+import unicodedata
+from typing import Any, Callable, Dict, Optional
+
+# Registered argument canonicalizers
+# Structure: {
+#   'function_name': {'parameter_name': canonicalizer}
+# }
+_CANONICALIZERS: Dict[str, Dict[str, Callable[[Any], Any]]] = {}
+
+US_STATES = {
+    "alabama": "al", "alaska": "ak", "arizona": "az", "arkansas": "ar",
+    "california": "ca", "colorado": "co", "connecticut": "ct", "delaware": "de",
+    "district of columbia": "dc", "florida": "fl", "georgia": "ga", "hawaii": "hi",
+    "idaho": "id", "illinois": "il", "indiana": "in", "iowa": "ia", "kansas": "ks",
+    "kentucky": "ky", "louisiana": "la", "maine": "me", "maryland": "md",
+    "massachusetts": "ma", "michigan": "mi", "minnesota": "mn", "mississippi": "ms",
+    "missouri": "mo", "montana": "mt", "nebraska": "ne", "nevada": "nv",
+    "new hampshire": "nh", "new jersey": "nj", "new mexico": "nm", "new york": "ny",
+    "north carolina": "nc", "north dakota": "nd", "ohio": "oh", "oklahoma": "ok",
+    "oregon": "or", "pennsylvania": "pa", "rhode island": "ri", "south carolina": "sc",
+    "south dakota": "sd", "tennessee": "tn", "texas": "tx", "utah": "ut",
+    "vermont": "vt", "virginia": "va", "washington": "wa", "west virginia": "wv",
+    "wisconsin": "wi", "wyoming": "wy",
+}
+
+# Longest names first so "west virginia" wins over "virginia"
+_STATE_NAMES = sorted(US_STATES, key=len, reverse=True)
+
+_COUNTRY_SUFFIXES = ("united states of america", "united states", "usa", "us")
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(value: str) -> str:
+    """
+    Case-, accent-, punctuation- and whitespace-insensitive form of a string.
+
+    Example:
+        >>> normalize_text("  Amélie:  The   MOVIE! ")
+        'amelie the movie'
+    """
+    value = unicodedata.normalize("NFKD", value)
+    value = "".join(ch for ch in value if not unicodedata.combining(ch))
+    value = _PUNCTUATION.sub(" ", value.casefold())
+    return _WHITESPACE.sub(" ", value).strip()
+
+
+def normalize_title(title: Any) -> Any:
+    """
+    Canonical form of a movie title.
+
+    Example:
+        >>> normalize_title("Dune: Part Two ") == normalize_title("dune part two")
+        True
+    """
+    if not isinstance(title, str):
+        return title
+    return normalize_text(title.replace("&", " and "))
+
+
+def normalize_location(location: Any) -> Any:
+    """
+    Canonical form of a US "City, State" location.
+
+    Example:
+        >>> normalize_location("Austin, Texas") == normalize_location("austin, TX, USA")
+        True
+    """
+    if not isinstance(location, str):
+        return location
+    value = normalize_text(location)
+    for suffix in _COUNTRY_SUFFIXES:
+        if value.endswith(" " + suffix):
+            value = value[:-len(suffix) - 1]
+            break
+    for name in _STATE_NAMES:
+        if value == name or value.endswith(" " + name):
+            # Keep a bare "New York" distinct from a city in New York state
+            if value != name:
+                value = value[:-len(name)] + US_STATES[name]
+            break
+    return value
+
+
+def register_canonicalizer(function_name: str, parameter: str, canonicalizer: Callable[[Any], Any]) -> None:
+    """Canonicalize parameter of function_name with canonicalizer when building cache keys."""
+    _CANONICALIZERS.setdefault(function_name, {})[parameter] = canonicalizer
+
+
+def _default_canonical(value: Any) -> Any:
+    if isinstance(value, str):
+        return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", value)).strip()
+    return value
+
+
+def make_cache_key(func: Callable, signature: Optional[inspect.Signature], args: tuple, kwargs: dict) -> str:
+    """
+    Fixed-size cache key for a call, independent of how its arguments were spelled.
+
+    Arguments are bound against the function signature, so positional,
+    keyword and defaulted forms of the same call share a key. Each argument
+    then goes through its registered canonicalizer, or through
+    whitespace/Unicode normalization if it is a string with none registered.
+
+    Returns:
+        A 32-character hex digest
+    """
+    canonicalizers = _CANONICALIZERS.get(func.__name__, {})
+    try:
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        parts = [
+            (name, canonicalizers.get(name, _default_canonical)(value))
+            for name, value in bound.arguments.items()
+        ]
+    except (TypeError, ValueError, AttributeError):
+        # Arguments don't fit the signature (or it has none); the call itself
+        # will report the mistake, so any stable key will do
+        parts = [("args", args), ("kwargs", sorted(kwargs.items()))]
+    return hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=16).hexdigest()
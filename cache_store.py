@@ -0,0 +1,163 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Values larger than this are zlib-compressed before being stored
+COMPRESS_THRESHOLD = 1024
+
+_RAW = b"\x00"
+_ZLIB = b"\x01"
+
+
+def serialize(value: Any) -> bytes:
+    """Compact binary form of a cached value: a one-byte header then pickle, zlib-compressed when large."""
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(data) > COMPRESS_THRESHOLD:
+        return _ZLIB + zlib.compress(data, 6)
+    return _RAW + data
+
+
+def deserialize(blob: bytes) -> Any:
+    header, data = blob[:1], blob[1:]
+    if header == _ZLIB:
+        data = zlib.decompress(data)
+    return pickle.loads(data)
+
+
+class CacheBackend:
+    """
+    Shared storage behind the in-process cache.
+
+    Keys are strings that already include the function name. Expiry times
+    are wall-clock (time.time()) so they mean the same thing in every process.
+    """
+
+    def get(self, key: str) -> tuple[bool, Any, Optional[float]]:
+        """Return (found, value, expires_at) for an unexpired key."""
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: Optional[float]) -> None:
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix: str) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    On-disk cache shared by every worker process on a host.
+
+    Uses SQLite in WAL mode, so readers in other processes never block
+    behind a writer. Entries survive restarts. A background thread deletes
+    expired rows every sweep_interval seconds. Reads also skip expired rows,
+    so stale data is never served between sweeps.
+
+    Args:
+        path: Database file path; its directory is created if missing
+        sweep_interval: Seconds between expiry sweeps, or None to disable them
+    """
+
+    def __init__(self, path: str, sweep_interval: Optional[float] = 300.0):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._closed = threading.Event()
+
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            " key TEXT PRIMARY KEY,"
+            " value BLOB NOT NULL,"
+            " expires_at REAL"
+            ") WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_expiry ON cache_entries (expires_at)")
+        conn.commit()
+
+        if sweep_interval:
+            sweeper = threading.Thread(
+                target=self._sweep_loop, args=(sweep_interval,),
+                name="cache-sweep", daemon=True,
+            )
+            sweeper.start()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections are not shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> tuple[bool, Any, Optional[float]]:
+        row = self._connection().execute(
+            "SELECT value, expires_at FROM cache_entries"
+            " WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time()),
+        ).fetchone()
+        if row is None:
+            return False, None, None
+        return True, deserialize(row[0]), row[1]
+
+    def set(self, key: str, value: Any, ttl: Optional[float]) -> None:
+        expires_at = time.time() + ttl if ttl is not None else None
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, serialize(value), expires_at),
+        )
+        conn.commit()
+
+    def delete_prefix(self, prefix: str) -> None:
+        conn = self._connection()
+        # Range scan on the primary key instead of LIKE, which would need escaping
+        conn.execute(
+            "DELETE FROM cache_entries WHERE key >= ? AND key < ?",
+            (prefix, prefix + "\U0010ffff"),
+        )
+        conn.commit()
+
+    def clear(self) -> None:
+        conn = self._connection()
+        conn.execute("DELETE FROM cache_entries")
+        conn.commit()
+
+    def sweep(self) -> int:
+        """Delete expired rows and return how many were removed."""
+        conn = self._connection()
+        cursor = conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),))
+        conn.commit()
+        return cursor.rowcount
+
+    def _sweep_loop(self, interval: float) -> None:
+        while not self._closed.wait(interval):
+            try:
+                removed = self.sweep()
+                if removed:
+                    logger.debug("Cache sweep removed %d expired entries", removed)
+            except sqlite3.Error as e:
+                logger.warning("Cache sweep failed: %s", e)
+
+    def close(self) -> None:
+        self._closed.set()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Callable, List, Optional
+
+import litellm
+
+from cache import cache_region
+from cache_keys import normalize_text
+from metrics import REGISTRY, Gauges, record_usage
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Request parameters that don't change what the model answers
+_IGNORED_KWARGS = frozenset({"stream", "stream_options", "metadata", "timeout", "api_key"})
+
+_FLIGHTS = SingleFlight()
+
+
+def _content(message: dict) -> str:
+    content = message.get("content")
+    if isinstance(content, list):
+        # Content blocks; only their text matters for the key
+        content = " ".join(block.get("text", "") for block in content if isinstance(block, dict))
+    return content or ""
+
+
+class CompletionCache:
+    """
+    Cache of non-streamed litellm completions, for deterministic call sites.
+
+    Keys are a blake2b hash of the model, the messages, the tools and the
+    generation kwargs. Only call sites that run at temperature 0 and accept
+    a repeated answer should use one.
+
+    Args:
+        name: Cache region name, as shown by get_cache_stats()
+        ttl: Seconds a cached completion is reused
+        max_entries: LRU bound on cached completions
+        last_messages: Key on only the last N messages, or None for all of them
+        approximate: Key on the normalized text of the user messages alone,
+            ignoring system, assistant and tool messages. Questions that
+            differ only in case, punctuation or spacing share an answer.
+        validate: Only responses for which this returns True are cached,
+            e.g. responses that parse as the JSON the caller expects
+    """
+
+    def __init__(self, name: str, ttl: float = 60 * 60, max_entries: int = 4096,
+                 last_messages: Optional[int] = None, approximate: bool = False,
+                 validate: Optional[Callable[[Any], bool]] = None):
+        self.name = name
+        self.last_messages = last_messages
+        self.approximate = approximate
+        self.validate = validate
+        self.region = cache_region(name, ttl=ttl, max_entries=max_entries)
+        # Upstream seconds avoided by hits, measured from the call that filled the entry
+        self.saved_seconds = 0.0
+
+    def key(self, model: str, messages: List[dict], tools: Optional[list] = None, **kwargs) -> str:
+        if self.last_messages is not None:
+            messages = messages[-self.last_messages:]
+        if self.approximate:
+            canonical_messages = [normalize_text(_content(m)) for m in messages if m.get("role") == "user"]
+        else:
+            canonical_messages = [
+                {k: v for k, v in message.items() if k in ("role", "content", "name", "tool_calls", "tool_call_id")}
+                for message in messages
+            ]
+        parts = {
+            "model": model,
+            "messages": canonical_messages,
+            "tools": tools,
+            "kwargs": {k: v for k, v in kwargs.items() if k not in _IGNORED_KWARGS},
+        }
+        encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.blake2b(encoded.encode("utf-8"), digest_size=16).hexdigest()
+
+    async def acompletion(self, model: str, messages: List[dict], **kwargs):
+        """
+        litellm.acompletion, answered from the cache when possible.
+
+        Concurrent identical calls share one upstream request. Token usage
+        is recorded for upstream calls only.
+
+        Raises:
+            ValueError: If called with stream=True
+        """
+        if kwargs.get("stream"):
+            raise ValueError("CompletionCache only caches non-streamed completions")
+        key = self.key(model, messages, **kwargs)
+
+        found, entry, _ = self.region.get(key)
+        if found:
+            response, latency = entry
+            self.saved_seconds += latency
+            return response
+
+        async def call():
+            started = time.perf_counter()
+            response = await litellm.acompletion(model=model, messages=messages, **kwargs)
+            latency = time.perf_counter() - started
+            # Hits cost no tokens, so usage is only counted here
+            record_usage(model, getattr(response, "usage", None))
+            if self.validate is None or self.validate(response):
+                self.region.set(key, (response, latency))
+            else:
+                logger.debug("Not caching %s completion that failed validation", self.name)
+            return response
+
+        return await _FLIGHTS.do_async(f"{self.name}:{key}", call)
+
+    def stats(self) -> dict:
+        stats = self.region.stats()
+        stats["saved_seconds"] = self.saved_seconds
+        return stats
+
+
+# Every CompletionCache, for reporting
+_CACHES: List[CompletionCache] = []
+
+
+def completion_cache(name: str, **options) -> CompletionCache:
+    """Create a CompletionCache and include it in the saved-latency metric."""
+    cache = CompletionCache(name, **options)
+    _CACHES.append(cache)
+    return cache
+
+
+def get_completion_cache_stats() -> dict:
+    return {cache.name: cache.stats() for cache in _CACHES}
+
+
+REGISTRY.register(Gauges(
+    "movie_completion_cache_saved_seconds_total", "LLM latency avoided by completion cache hits.",
+    lambda: [({"cache": cache.name}, cache.saved_seconds) for cache in _CACHES],
+    kind="counter",
+))
@@ -0,0 +1,317 @@
+import asyncio
+import json
+import logging
+from typing import List, Optional
+
+import litellm
+
+from metrics import REGISTRY, Counter, record_usage
+from prompts import SUMMARY_PROMPT
+
+logger = logging.getLogger(__name__)
+
+# Prompt-token budgets for the history sent to each model. Models not listed
+# use DEFAULT_HISTORY_BUDGET.
+HISTORY_BUDGETS = {
+    "gpt-4o": 8000,
+    "gpt-4o-mini": 4000,
+    "claude-3-5-sonnet-20241022": 8000,
+    "claude-3-5-haiku-20241022": 4000,
+}
+DEFAULT_HISTORY_BUDGET = 6000
+
+# The review gate only needs the gist of the conversation
+GATE_HISTORY_BUDGET = 800
+GATE_MESSAGE_CHARS = 400
+
+# Turns at the end of the conversation that are always sent verbatim
+RECENT_TURNS = 2
+
+# Tool results and injected context older than RECENT_TURNS are cut to this size
+STALE_TOOL_CHARS = 400
+
+# Summarize older turns once they hold this many tokens
+SUMMARIZE_AFTER_TOKENS = 3000
+
+# When the history outgrows its budget, the older turns are compacted down to
+# this fraction of it, so several more turns fit before the next compaction
+COMPACT_TO = 0.75
+
+# A rebuilt prefix is kept for at least this many turns, even if the history
+# outgrows its budget again sooner (e.g. turns with large tool results), as a
+# prefix rewritten on every turn is never cached. Histories whose recent turns
+# alone don't fit COMPACT_TO of the budget can't be helped by compacting and
+# aren't compacted either. Either way, a history that grows past MAX_OVERFLOW
+# times its budget is compacted.
+MIN_TURNS_BETWEEN_COMPACTIONS = 3
+MAX_OVERFLOW = 2.0
+
+# Message kinds tracked alongside the messages themselves
+KIND_CONTEXT = "context"
+KIND_TURN_CONTEXT = "turn_context"
+
+PROMPT_COMPACTIONS = REGISTRY.register(Counter(
+    "movie_prompt_compactions_total", "Times a history's frozen prompt prefix was rebuilt to fit its budget."))
+
+
+def count_tokens(message: dict, model: str = "gpt-4o") -> int:
+    """Token count of a single message, estimated if litellm cannot count it."""
+    try:
+        return litellm.token_counter(model=model, messages=[message])
+    except Exception:
+        text = message.get("content") or ""
+        if message.get("tool_calls"):
+            text += json.dumps(message["tool_calls"])
+        return len(text) // 4 + 4
+
+
+def _shrink(message: dict, max_chars: int) -> dict:
+    content = message.get("content")
+    if not isinstance(content, str) or len(content) <= max_chars:
+        return message
+    return {**message, "content": content[:max_chars] + " … [truncated]"}
+
+
+class ConversationHistory:
+    """
+    The messages of one chat session, with per-message token counts.
+
+    Messages are only ever appended. Token counts are computed once, when a
+    message is added. view() and gate_view() build budgeted copies for the
+    model calls and leave the stored messages untouched.
+
+    view() keeps the prompt prefix byte-stable, so providers can cache it:
+    the system prompt and the compacted older turns form a frozen prefix that
+    is reused as is, and every message after it is sent verbatim. The prefix
+    is only rebuilt when the history outgrows its budget, and then at most
+    every MIN_TURNS_BETWEEN_COMPACTIONS turns.
+
+    Args:
+        system_prompt: Content of the leading system message
+        model: Model used for token counting
+    """
+
+    def __init__(self, system_prompt: str, model: str = "gpt-4o"):
+        self.model = model
+        self.messages: List[dict] = []
+        self.token_counts: List[int] = []
+        self.kinds: List[Optional[str]] = []
+        self.summary: Optional[str] = None
+        # Messages before this index are covered by summary
+        self.summarized_upto = 1
+        self._summary_task: Optional[asyncio.Task] = None
+        self.append({"role": "system", "content": system_prompt})
+        # Compacted copies of messages[:frozen_upto], the start of every view()
+        self._frozen: List[dict] = [self.messages[0]]
+        self._frozen_tokens = self.token_counts[0]
+        self.frozen_upto = 1
+        # Bumped whenever state() changes, so stores can skip unchanged state
+        self.state_version = 0
+
+    def append(self, message: dict, kind: Optional[str] = None, tokens: Optional[int] = None) -> None:
+        """
+        Add a message to the end of the conversation.
+
+        Args:
+            message: Chat message dict
+            kind: KIND_CONTEXT for injected context (e.g. reviews) and
+                KIND_TURN_CONTEXT for the facts that open a turn. Both are
+                sent with the user role but aren't written by the user.
+            tokens: Token count, if already known (e.g. from a session store)
+        """
+        self.messages.append(message)
+        self.token_counts.append(count_tokens(message, self.model) if tokens is None else tokens)
+        self.kinds.append(kind)
+
+    def extend(self, messages: List[dict]) -> None:
+        for message in messages:
+            self.append(message)
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(self.token_counts)
+
+    def state(self) -> dict:
+        """Everything besides the messages that a copy of this history in another process needs."""
+        return {
+            "summary": self.summary,
+            "summarized_upto": self.summarized_upto,
+            "frozen": self._frozen,
+            "frozen_tokens": self._frozen_tokens,
+            "frozen_upto": self.frozen_upto,
+        }
+
+    def restore_state(self, state: dict) -> None:
+        """Apply a state() taken from a history with the same messages."""
+        self.summary = state["summary"]
+        self.summarized_upto = state["summarized_upto"]
+        self._frozen = state["frozen"]
+        self._frozen_tokens = state["frozen_tokens"]
+        self.frozen_upto = state["frozen_upto"]
+
+    @property
+    def frozen_count(self) -> int:
+        """Number of leading view() messages that form the frozen prefix."""
+        return len(self._frozen)
+
+    def _starts_turn(self, i: int) -> bool:
+        if self.kinds[i] == KIND_TURN_CONTEXT:
+            return True
+        return (self.messages[i].get("role") == "user" and self.kinds[i] is None
+                and self.kinds[i - 1] != KIND_TURN_CONTEXT)
+
+    def _turn_starts(self) -> List[int]:
+        """Indexes of the messages that begin each turn: its turn context, or else its user message."""
+        return [i for i in range(1, len(self.messages)) if self._starts_turn(i)]
+
+    def _recent_start(self) -> int:
+        starts = self._turn_starts()
+        if len(starts) <= RECENT_TURNS:
+            return 1
+        return starts[-RECENT_TURNS]
+
+    def view(self, budget: Optional[int] = None) -> List[dict]:
+        """
+        History for a main completion, fitted to budget tokens.
+
+        The frozen prefix, then every message after it verbatim. When that
+        no longer fits, the prefix is rebuilt with compact() first, at most
+        every MIN_TURNS_BETWEEN_COMPACTIONS turns unless the view grows past
+        MAX_OVERFLOW times budget.
+        """
+        budget = budget or HISTORY_BUDGETS.get(self.model, DEFAULT_HISTORY_BUDGET)
+        total = self._frozen_tokens + sum(self.token_counts[self.frozen_upto:])
+        if total > budget and self._should_compact(budget, total):
+            self.compact(int(budget * COMPACT_TO))
+        return self._frozen + self.messages[self.frozen_upto:]
+
+    def _should_compact(self, budget: int, total: int) -> bool:
+        starts = self._turn_starts()
+        recent_start = starts[-RECENT_TURNS] if len(starts) > RECENT_TURNS else 1
+        if recent_start <= self.frozen_upto:
+            # Nothing older than the recent turns is left to compact
+            return False
+        if total > budget * MAX_OVERFLOW:
+            return True
+        if self.token_counts[0] + sum(self.token_counts[recent_start:]) > budget * COMPACT_TO:
+            return False
+        # compact() froze everything before the recent turns of its time
+        turns_since = sum(1 for i in starts if self.frozen_upto <= i < recent_start)
+        return turns_since >= MIN_TURNS_BETWEEN_COMPACTIONS
+
+    def compact(self, budget: int) -> None:
+        """
+        Rebuild the frozen prefix so the whole view fits budget tokens.
+
+        The system prompt and the last RECENT_TURNS turns are kept verbatim.
+        Older turns are covered by the summary when one exists. Otherwise
+        their tool results are shrunk, and whole turns are dropped, oldest
+        first, until the history fits. This changes the prompt prefix, so
+        providers' prompt caches miss once afterwards.
+        """
+        recent_start = self._recent_start()
+
+        head = [self.messages[0]]
+        used = self.token_counts[0]
+        older_start = 1
+        if self.summary and self.summarized_upto > 1:
+            summary_message = {"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"}
+            head.append(summary_message)
+            used += count_tokens(summary_message, self.model)
+            older_start = min(self.summarized_upto, recent_start)
+        recent_tokens = sum(self.token_counts[recent_start:])
+
+        # Older turns, compacted, grouped so a turn is kept or dropped whole
+        turns: List[List[dict]] = []
+        turn_tokens: List[int] = []
+        for i in range(older_start, recent_start):
+            message = self.messages[i]
+            if self._starts_turn(i) or not turns:
+                turns.append([])
+                turn_tokens.append(0)
+            if message.get("role") == "tool" or self.kinds[i] == KIND_CONTEXT:
+                compacted = _shrink(message, STALE_TOOL_CHARS)
+                tokens = self.token_counts[i] if compacted is message else count_tokens(compacted, self.model)
+            else:
+                compacted, tokens = message, self.token_counts[i]
+            turns[-1].append(compacted)
+            turn_tokens[-1] += tokens
+
+        while turns and used + sum(turn_tokens) + recent_tokens > budget:
+            turns.pop(0)
+            turn_tokens.pop(0)
+
+        self._frozen = head + [message for turn in turns for message in turn]
+        self._frozen_tokens = used + sum(turn_tokens)
+        self.frozen_upto = recent_start
+        self.state_version += 1
+        PROMPT_COMPACTIONS.inc()
+
+    def gate_view(self, budget: int = GATE_HISTORY_BUDGET) -> List[dict]:
+        """
+        A small text-only view of the conversation for the review gate.
+
+        Tool traffic and the system prompt are left out, and each message is
+        cut to GATE_MESSAGE_CHARS. Injected review context keeps its first
+        line, which records which movie's reviews were already provided.
+        """
+        selected: List[dict] = []
+        used = 0
+        for i in range(len(self.messages) - 1, 0, -1):
+            message = self.messages[i]
+            role = message.get("role")
+            if role not in ("user", "assistant") or not message.get("content") or message.get("tool_calls"):
+                continue
+            if self.kinds[i] == KIND_TURN_CONTEXT:
+                continue
+            if self.kinds[i] == KIND_CONTEXT:
+                compact = {"role": role, "content": message["content"].split("\n", 1)[0]}
+            else:
+                compact = {"role": role, "content": _shrink(message, GATE_MESSAGE_CHARS)["content"]}
+            tokens = count_tokens(compact, self.model)
+            if selected and used + tokens > budget:
+                break
+            selected.append(compact)
+            used += tokens
+        selected.reverse()
+        return selected
+
+    def maybe_summarize(self, model: str) -> None:
+        """
+        Start a background summary of older turns if they have grown large.
+
+        The summary is used by view() from the next turn on, so the current
+        turn never waits for it.
+        """
+        if self._summary_task is not None and not self._summary_task.done():
+            return
+        recent_start = self._recent_start()
+        if sum(self.token_counts[self.summarized_upto:recent_start]) < SUMMARIZE_AFTER_TOKENS:
+            return
+        self._summary_task = asyncio.create_task(self._summarize(model, recent_start))
+
+    async def _summarize(self, model: str, upto: int) -> None:
+        older = [
+            _shrink(message, STALE_TOOL_CHARS)
+            for message in self.messages[self.summarized_upto:upto]
+            if message.get("content")
+        ]
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in older)
+        if self.summary:
+            transcript = f"Previous summary:\n{self.summary}\n\n{transcript}"
+        try:
+            response = await litellm.acompletion(
+                model=model,
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": transcript},
+                ],
+                temperature=0,
+                max_tokens=300,
+            )
+            record_usage(model, getattr(response, "usage", None))
+            self.summary = response.choices[0].message.content
+            self.summarized_upto = upto
+            self.state_version += 1
+        except Exception as e:
+            logger.warning("History summarization failed: %s", e)
@@ -0,0 +1,250 @@
+import asyncio
+import random
+import threading
+import time
+import weakref
+from collections import defaultdict
+from typing import Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import UPSTREAM_SECONDS
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT: Tuple[float, float] = (3.05, 10.0)
+
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+Timeout = Union[float, Tuple[float, float]]
+
+
+class UpstreamError(Exception):
+    """An upstream API answered with an error. Raised instead of returned, so the error is never cached."""
+
+
+class HttpStats:
+    """Per-host request, retry and error counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hosts: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {"requests": 0, "retries": 0, "errors": 0, "seconds": 0.0}
+        )
+
+    def record(self, host: str, retries: int, seconds: float, error: bool) -> None:
+        UPSTREAM_SECONDS.observe(seconds, host=host, outcome="error" if error else "ok")
+        with self._lock:
+            counters = self.hosts[host]
+            counters["requests"] += 1
+            counters["retries"] += retries
+            counters["seconds"] += seconds
+            if error:
+                counters["errors"] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {host: dict(counters) for host, counters in self.hosts.items()}
+
+
+class HttpClient:
+    """
+    Shared HTTP client for the upstream APIs (TMDb, SerpAPI, ipapi).
+
+    The sync interface uses one requests.Session. Its urllib3 pool manager
+    keeps a keep-alive connection pool per host, so repeated calls skip the
+    TCP and TLS handshake. The async interface uses an httpx.AsyncClient per
+    event loop, with HTTP/2 when the h2 package is installed. Both retry 429
+    and 5xx responses and connection errors with full-jitter exponential
+    backoff. Retry-After is honoured when it is shorter than max_backoff.
+
+    Args:
+        timeout: Default (connect, read) timeout in seconds
+        max_retries: Retries after the first attempt
+        backoff_base: Base delay in seconds for exponential backoff
+        max_backoff: Upper bound on any single retry delay
+        pool_hosts: Number of per-host pools to keep
+        pool_maxsize: Keep-alive connections per host
+    """
+
+    def __init__(self, timeout: Timeout = DEFAULT_TIMEOUT, max_retries: int = 2,
+                 backoff_base: float = 0.25, max_backoff: float = 4.0,
+                 pool_hosts: int = 8, pool_maxsize: int = 16):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.pool_maxsize = pool_maxsize
+        self.stats = HttpStats()
+
+        self._session = requests.Session()
+        # Retries are handled here so sync and async behave the same
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_maxsize, max_retries=0)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._adapter = adapter
+
+        # httpx clients are bound to the loop they were first used on. Keyed
+        # by the loop itself, so an entry goes when its loop is collected.
+        self._async_lock = threading.Lock()
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Seconds to wait before retry number attempt + 1, honouring a Retry-After header value."""
+        if retry_after:
+            try:
+                return max(0.0, min(float(retry_after), self.max_backoff))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff_base * (2 ** attempt)))
+
+    def get(self, url: str, params: Optional[dict] = None, headers: Optional[dict] = None,
+            timeout: Optional[Timeout] = None, max_retries: Optional[int] = None) -> requests.Response:
+        """
+        GET url with pooled connections and retries.
+
+        Args:
+            max_retries: Overrides the client's, e.g. 0 when the caller
+                retries itself through a rate limiter
+
+        Returns:
+            The final response, which may still carry an error status once
+            retries are exhausted
+
+        Raises:
+            requests.RequestException: If every attempt failed to connect or timed out
+        """
+        host = urlsplit(url).netloc
+        max_retries = self.max_retries if max_retries is None else max_retries
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                response = self._session.get(url, params=params, headers=headers,
+                                             timeout=timeout or self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= max_retries:
+                    self.stats.record(host, attempt, time.perf_counter() - started, error=True)
+                    raise
+                time.sleep(self.retry_delay(attempt))
+                attempt += 1
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < max_retries:
+                delay = self.retry_delay(attempt, response.headers.get("Retry-After"))
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            self.stats.record(host, attempt, time.perf_counter() - started,
+                              error=response.status_code >= 400)
+            return response
+
+    def _async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                # A closed loop can't close its client any more; drop it and
+                # let its connections be collected with it
+                for closed in [other for other in self._async_clients if other.is_closed()]:
+                    del self._async_clients[closed]
+                connect, read = self.timeout if isinstance(self.timeout, tuple) else (self.timeout, self.timeout)
+                client = httpx.AsyncClient(
+                    http2=HTTP2_AVAILABLE,
+                    timeout=httpx.Timeout(read, connect=connect),
+                    limits=httpx.Limits(max_keepalive_connections=self.pool_maxsize,
+                                        max_connections=self.pool_maxsize * 4),
+                )
+                self._async_clients[loop] = client
+            return client
+
+    async def aget(self, url: str, params: Optional[dict] = None, headers: Optional[dict] = None,
+                   timeout: Optional[float] = None, max_retries: Optional[int] = None) -> httpx.Response:
+        """Async version of get(), returning an httpx.Response."""
+        host = urlsplit(url).netloc
+        max_retries = self.max_retries if max_retries is None else max_retries
+        client = self._async_client()
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                response = await client.get(url, params=params, headers=headers,
+                                            timeout=timeout or httpx.USE_CLIENT_DEFAULT)
+            except httpx.TransportError:
+                if attempt >= max_retries:
+                    self.stats.record(host, attempt, time.perf_counter() - started, error=True)
+                    raise
+                await asyncio.sleep(self.retry_delay(attempt))
+                attempt += 1
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < max_retries:
+                delay = self.retry_delay(attempt, response.headers.get("Retry-After"))
+                await response.aclose()
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            self.stats.record(host, attempt, time.perf_counter() - started,
+                              error=response.status_code >= 400)
+            return response
+
+    async def aclose(self) -> None:
+        """Close the running loop's async client, e.g. before the loop shuts down."""
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            client = self._async_clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+    def pool_stats(self) -> Dict[str, dict]:
+        """
+        Request counters per host, plus connection reuse for the sync pools.
+
+        "connections" is the number of connections a host's pool has opened.
+        Compared with "pool_requests", it shows how often a handshake was saved.
+        """
+        stats = self.stats.snapshot()
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = key.key_host if not key.key_port or key.key_port in (80, 443) else f"{key.key_host}:{key.key_port}"
+            entry = stats.setdefault(host, {"requests": 0, "retries": 0, "errors": 0, "seconds": 0.0})
+            entry["connections"] = pool.num_connections
+            entry["pool_requests"] = pool.num_requests
+        return stats
+
+    def close(self) -> None:
+        """Close the sync session. Async clients are closed per loop with aclose()."""
+        self._session.close()
+
+
+# Shared client used by movie_functions
+client = HttpClient()
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return client.get(url, **kwargs)
+
+
+async def aget(url: str, **kwargs) -> httpx.Response:
+    return await client.aget(url, **kwargs)
+
+
+def pool_stats() -> Dict[str, dict]:
+    return client.pool_stats()
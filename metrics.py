@@ -0,0 +1,207 @@
+import bisect
+import logging
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Latency buckets in seconds, from cache hits up to slow LLM completions
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+logger = logging.getLogger(__name__)
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """A monotonically increasing count, per label set."""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_labels(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines += [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in values]
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram, per label set.
+
+    Observing is a bisect over the buckets plus three additions under a lock,
+    so it is cheap enough for every request.
+    """
+
+    def __init__(self, name: str, help: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # label set -> [per-bucket counts..., +Inf count], sum
+        self._series: Dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        # First bucket whose upper bound is >= value; len(buckets) is +Inf
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, **labels) -> int:
+        series = self._series.get(_labels(labels))
+        return sum(series[0]) if series else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        for key, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class Gauges:
+    """
+    Values read from elsewhere at scrape time, e.g. the cache's own counters.
+
+    Args:
+        name: Metric name
+        help: Description
+        collect: Returns [(labels dict, value), ...]
+        kind: "gauge", or "counter" for values that only grow
+    """
+
+    def __init__(self, name: str, help: str, collect: Callable[[], Iterable[Tuple[dict, float]]],
+                 kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            samples = list(self.collect())
+        except Exception:
+            return []
+        for labels, value in samples:
+            if value is None:
+                continue
+            lines.append(f"{self.name}{_format_labels(_labels(labels))} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "movie_stage_seconds", "Time spent in each stage of a chat turn (gate, completions, tools)."))
+UPSTREAM_SECONDS = REGISTRY.register(Histogram(
+    "movie_upstream_request_seconds", "Upstream HTTP requests, including retries, by host and outcome."))
+TOOL_ERRORS = REGISTRY.register(Counter(
+    "movie_tool_errors_total", "Tool calls that failed, by tool and reason."))
+LLM_TOKENS = REGISTRY.register(Counter(
+    "movie_llm_tokens_total",
+    "Tokens reported by the LLM provider, by model and kind. prompt counts every input token; "
+    "prompt_cached and prompt_cache_write are the parts read from and written to the provider's prompt cache."))
+TURN_ERRORS = REGISTRY.register(Counter(
+    "movie_turn_errors_total", "Chat turns that failed with an exception."))
+
+
+def _usage_field(usage, name: str):
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage.get(name)
+    return getattr(usage, name, None)
+
+
+def record_usage(model: Optional[str], usage) -> None:
+    """
+    Count the tokens from a litellm usage object, if present.
+
+    Prompt-cache reads are reported as prompt_tokens_details.cached_tokens by
+    OpenAI and as cache_read_input_tokens by Anthropic; cache writes only by
+    Anthropic, as cache_creation_input_tokens.
+    """
+    if usage is None:
+        return
+    model = model or "unknown"
+    prompt = _usage_field(usage, "prompt_tokens") or 0
+    for kind in ("prompt_tokens", "completion_tokens"):
+        tokens = _usage_field(usage, kind)
+        if tokens:
+            LLM_TOKENS.inc(tokens, model=model, kind=kind.split("_")[0])
+
+    cached = (_usage_field(_usage_field(usage, "prompt_tokens_details"), "cached_tokens")
+              or _usage_field(usage, "cache_read_input_tokens") or 0)
+    written = _usage_field(usage, "cache_creation_input_tokens") or 0
+    if cached:
+        LLM_TOKENS.inc(cached, model=model, kind="prompt_cached")
+    if written:
+        LLM_TOKENS.inc(written, model=model, kind="prompt_cache_write")
+    if prompt:
+        logger.debug("%s prompt: %d tokens, %d cached, %d uncached, %d written to cache",
+                     model, prompt, cached, max(prompt - cached, 0), written)
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,341 @@
+import asyncio
+import logging
+import re
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import review_gate
+from history import ConversationHistory, KIND_CONTEXT
+from metrics import REGISTRY, Counter, Gauges, Histogram
+from title_index import TITLE_INDEX, TitleIndex
+
+logger = logging.getLogger(__name__)
+
+# Routing tiers: the fast tier answers small talk and questions the turn
+# context already answers (the date, the time); everything else goes to
+# the full tier
+FAST = "fast"
+FULL = "full"
+
+# Messages that probably need a movie tool
+TOOL_PATTERN = re.compile(
+    r"\b(movies?|films?|showtimes?|show times|playing|tickets?|seats?|buy|book|purchase|confirm|"
+    r"theaters?|theatres?|cinemas?|near me|tonight|watch|see|pick|random|reviews?)\b"
+)
+
+# Longest user message, and longest conversation in tokens, the fast tier gets
+FAST_MAX_CHARS = 200
+FAST_MAX_HISTORY_TOKENS = 4000
+
+# Time-to-first-chunk samples kept per model, and how many are needed
+# before they are trusted for routing and hedge delays
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+# A hedge is sent when the primary hasn't produced a chunk after its p95
+# time to first chunk, within these bounds. MAX_HEDGE_DELAY is also used
+# until a model has MIN_LATENCY_SAMPLES.
+HEDGE_PERCENTILE = 95
+MIN_HEDGE_DELAY = 0.25
+MAX_HEDGE_DELAY = 4.0
+
+# Most completions that may be hedged, as a fraction of all of them, so a
+# slow provider doesn't get twice the traffic. HEDGE_ALLOWANCE hedges are
+# allowed before the fraction applies.
+HEDGE_BUDGET = 0.1
+HEDGE_ALLOWANCE = 5
+
+MODEL_ROUTES = REGISTRY.register(Counter(
+    "movie_model_routes_total", "Main completions by routing tier, model and reason."))
+FIRST_CHUNK_SECONDS = REGISTRY.register(Histogram(
+    "movie_llm_first_chunk_seconds", "Time from sending a streamed completion to its first chunk, by model."))
+HEDGES = REGISTRY.register(Counter(
+    "movie_llm_hedges_total", "Hedged completions, by which request produced the first chunk (primary or hedge)."))
+
+# Marks a stream that ended before its first chunk
+_END = object()
+
+
+def _percentile(values: Sequence[float], q: float) -> float:
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), round(q / 100 * len(ordered) + 0.5)))
+    return ordered[rank - 1]
+
+
+class LatencyStats:
+    """Recent time-to-first-chunk samples per model."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model: str, q: float) -> Optional[float]:
+        """The q-th percentile for model, or None with fewer than MIN_LATENCY_SAMPLES."""
+        with self._lock:
+            samples = list(self._samples.get(model, ()))
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return None
+        return _percentile(samples, q)
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            samples = {model: list(values) for model, values in self._samples.items()}
+        return {
+            model: {"samples": len(values), "p50": _percentile(values, 50), "p95": _percentile(values, 95)}
+            for model, values in samples.items() if values
+        }
+
+
+@dataclass(slots=True, frozen=True)
+class Route:
+    """
+    Where one main completion goes.
+
+    Attributes:
+        tier: FAST or FULL
+        model: Model the completion is sent to
+        hedge_model: Model a hedge is sent to, or None to not hedge
+        reason: Why the tier was chosen, for metrics and logs
+    """
+    tier: str
+    model: str
+    hedge_model: Optional[str]
+    reason: str
+
+
+class HedgedStream:
+    """
+    The stream that won, starting with the chunk already read from it.
+
+    Args:
+        stream: The completion stream, positioned after its first chunk
+        first: The first chunk, or _END if the stream had none
+        model: Model that produced the stream
+    """
+
+    def __init__(self, stream, first, model: str):
+        self.stream = stream
+        self.model = model
+        self._first = first
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first is not None:
+            first, self._first = self._first, None
+            if first is _END:
+                raise StopAsyncIteration
+            return first
+        return await self.stream.__anext__()
+
+    async def aclose(self) -> None:
+        await _close(self.stream)
+
+
+async def _close(stream) -> None:
+    close = getattr(stream, "aclose", None)
+    if close is not None:
+        try:
+            await close()
+        except Exception as e:
+            logger.debug("Closing a discarded stream failed: %s", e)
+
+
+def _close_loser(task: asyncio.Task) -> None:
+    if task.cancelled() or task.exception() is not None:
+        return
+    asyncio.ensure_future(task.result().aclose())
+
+
+class ModelRouter:
+    """
+    Picks the model for each main completion and hedges slow ones.
+
+    A turn goes to the FAST tier when it is short small talk: no tool
+    results or review context yet, no movie words or known titles in the
+    user's message, and a short conversation. Everything else goes to FULL.
+    Within a tier, models are tried in the configured order until each has
+    MIN_LATENCY_SAMPLES, then ordered by their live median time to first
+    chunk.
+
+    If the chosen model hasn't produced a chunk after its live p95, the same
+    request is sent to the tier's runner-up (or again to the same model,
+    which usually lands on another deployment) and whichever streams first
+    is used. The other request is cancelled. The requests are identical, so
+    at temperature 0 the answer doesn't depend on which one wins.
+
+    Args:
+        tiers: Models per tier, in order of preference
+        hedging: Whether slow completions are hedged
+        index: Titles to recognize in user messages
+    """
+
+    def __init__(self, tiers: Dict[str, Sequence[str]], hedging: bool = True, index: TitleIndex = TITLE_INDEX):
+        self.tiers = {tier: list(models) for tier, models in tiers.items() if models}
+        self.hedging = hedging
+        self.index = index
+        self.latency = LatencyStats()
+        self.completions = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    @property
+    def models(self) -> List[str]:
+        """Every routable model, each once."""
+        return list(dict.fromkeys(model for models in self.tiers.values() for model in models))
+
+    def classify(self, history: ConversationHistory) -> Tuple[str, str]:
+        """(tier, reason) for the next main completion on history."""
+        messages, kinds = history.messages, history.kinds
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i].get("role") == "tool":
+                return FULL, "tool_results"
+            if kinds[i] == KIND_CONTEXT:
+                return FULL, "reviews"
+            if messages[i].get("role") == "user" and kinds[i] is None:
+                break
+
+        if history.total_tokens > FAST_MAX_HISTORY_TOKENS:
+            return FULL, "long_history"
+        text = review_gate.last_user_message(messages, kinds)
+        if len(text) > FAST_MAX_CHARS:
+            return FULL, "long_message"
+        lowered = text.lower()
+        if TOOL_PATTERN.search(lowered) or review_gate.OPINION_PATTERN.search(lowered):
+            return FULL, "movie_question"
+        if self.index.mentions(text):
+            return FULL, "title"
+        return FAST, "small_talk"
+
+    def _ranked(self, tier: str) -> List[str]:
+        models = self.tiers[tier]
+        order = {model: i for i, model in enumerate(models)}
+
+        def key(model: str):
+            median = self.latency.percentile(model, 50)
+            # Models without enough samples first, so every model gets measured
+            return (0, order[model]) if median is None else (1, median)
+        return sorted(models, key=key)
+
+    def route(self, history: ConversationHistory) -> Route:
+        tier, reason = self.classify(history)
+        if tier not in self.tiers:
+            tier = FULL
+        ranked = self._ranked(tier)
+        model = ranked[0]
+        hedge_model = ranked[1] if len(ranked) > 1 else model
+        MODEL_ROUTES.inc(tier=tier, model=model, reason=reason)
+        logger.debug("Routing to %s (%s tier, %s)", model, tier, reason)
+        return Route(tier, model, hedge_model if self.hedging else None, reason)
+
+    def hedge_delay(self, model: str) -> float:
+        p95 = self.latency.percentile(model, HEDGE_PERCENTILE)
+        if p95 is None:
+            return MAX_HEDGE_DELAY
+        return min(MAX_HEDGE_DELAY, max(MIN_HEDGE_DELAY, p95))
+
+    def _may_hedge(self) -> bool:
+        return self.hedged < HEDGE_ALLOWANCE + HEDGE_BUDGET * self.completions
+
+    async def _open(self, model: str, start: Callable[[str], Awaitable[Any]]) -> HedgedStream:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        stream = None
+        try:
+            stream = await start(model)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = _END
+        except asyncio.CancelledError:
+            # Slower than the request that won: still a (lower bound) sample
+            self.latency.record(model, loop.time() - started)
+            if stream is not None:
+                asyncio.ensure_future(_close(stream))
+            raise
+        elapsed = loop.time() - started
+        self.latency.record(model, elapsed)
+        FIRST_CHUNK_SECONDS.observe(elapsed, model=model)
+        return HedgedStream(stream, first, model)
+
+    async def complete(self, route: Route, start: Callable[[str], Awaitable[Any]]) -> HedgedStream:
+        """
+        Open a streamed completion along route.
+
+        Args:
+            route: From route()
+            start: Opens the completion stream for a model, e.g. litellm.acompletion(stream=True)
+
+        Returns:
+            The first stream to produce a chunk, primary or hedge
+
+        Raises:
+            Exception: What the primary raised, if the hedge failed too or wasn't sent
+        """
+        self.completions += 1
+        primary = asyncio.create_task(self._open(route.model, start))
+        attempts = [primary]
+        winner = None
+        try:
+            if route.hedge_model is not None and self._may_hedge():
+                done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay(route.model))
+                if not done or primary.exception() is not None:
+                    # Slow, or failed fast: either way the hedge may still answer in time
+                    self.hedged += 1
+                    logger.debug("Hedging %s with %s", route.model, route.hedge_model)
+                    attempts.append(asyncio.create_task(self._open(route.hedge_model, start)))
+
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in attempts if task in done and task.exception() is None]
+                if succeeded:
+                    winner = succeeded[0]
+                    break
+            if winner is None:
+                raise primary.exception()
+        finally:
+            for task in attempts:
+                if task is winner:
+                    continue
+                # Also retrieves a loser's error, and closes a stream that
+                # opened just as it lost
+                task.cancel()
+                task.add_done_callback(_close_loser)
+
+        if len(attempts) > 1:
+            outcome = "primary" if winner is primary else "hedge"
+            if winner is not primary:
+                self.hedge_wins += 1
+            HEDGES.inc(outcome=outcome)
+        return winner.result()
+
+    def stats(self) -> dict:
+        return {
+            "completions": self.completions,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "latency": self.latency.snapshot(),
+        }
+
+
+def _latency_samples(router: ModelRouter, q: float):
+    return [({"model": model}, router.latency.percentile(model, q)) for model in router.models]
+
+
+def register_latency_gauges(router: ModelRouter) -> None:
+    """Export router's live latency percentiles, the ones routing and hedging use."""
+    REGISTRY.register(Gauges(
+        "movie_llm_first_chunk_p50_seconds", "Live median time to first chunk, by model.",
+        lambda: _latency_samples(router, 50)))
+    REGISTRY.register(Gauges(
+        "movie_llm_first_chunk_p95_seconds", "Live p95 time to first chunk, which sets the hedge delay, by model.",
+        lambda: _latency_samples(router, HEDGE_PERCENTILE)))
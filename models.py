@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+# Compact, immutable records returned by the data layer in movie_functions.
+# They are what the caches hold; turning them into text is left to render.py.
+
+
+@dataclass(slots=True, frozen=True)
+class Movie:
+    id: Optional[int]
+    title: str
+    release_date: str = ""
+    overview: str = ""
+
+    @classmethod
+    def from_tmdb(cls, data: dict) -> "Movie":
+        return cls(
+            id=data.get("id"),
+            title=data.get("title") or "N/A",
+            release_date=data.get("release_date") or "",
+            overview=data.get("overview") or "",
+        )
+
+
+@dataclass(slots=True, frozen=True)
+class Review:
+    author: str
+    rating: Optional[float]
+    content: str
+    created_at: str = ""
+    url: str = ""
+
+    @classmethod
+    def from_tmdb(cls, data: dict) -> "Review":
+        rating = (data.get("author_details") or {}).get("rating")
+        return cls(
+            author=data.get("author") or "N/A",
+            rating=float(rating) if isinstance(rating, (int, float)) else None,
+            content=data.get("content") or "",
+            created_at=data.get("created_at") or "",
+            url=data.get("url") or "",
+        )
+
+
+@dataclass(slots=True, frozen=True)
+class Theater:
+    name: str
+    address: str = ""
+    distance: str = ""
+
+
+@dataclass(slots=True, frozen=True)
+class Showtime:
+    """All the times one theater shows a movie on one day, in one format."""
+    day: str
+    theater: Theater
+    times: Tuple[str, ...]
+    format: str = ""
+
+
+@dataclass(slots=True, frozen=True)
+class ShowtimeLookup:
+    """One (title, location) pair of a bulk showtimes request; error is empty if it succeeded."""
+    title: str
+    location: str
+    showtimes: Tuple[Showtime, ...] = ()
+    error: str = ""
+
+
+def parse_serpapi_showtimes(results: dict) -> Tuple[Showtime, ...]:
+    """Every day, theater and format from a SerpAPI showtimes result."""
+    showtimes = []
+    for day in results.get("showtimes") or []:
+        label = " ".join(part for part in (day.get("day"), day.get("date")) if part) or "Unknown Date"
+        for theater_data in day.get("theaters") or []:
+            theater = Theater(
+                name=theater_data.get("name") or "Unknown Theater",
+                address=theater_data.get("address") or "",
+                distance=theater_data.get("distance") or "",
+            )
+            for showing in theater_data.get("showing") or []:
+                times = tuple(showing.get("time") or ())
+                if times:
+                    showtimes.append(Showtime(label, theater, times, showing.get("type") or ""))
+    return tuple(showtimes)
@@ -1,56 +1,146 @@
+import hashlib
+import logging
 import os
-import requests
-from serpapi import GoogleSearch
-from functools import wraps
-from typing import Dict, Any, Callable
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import copy_context
 from datetime import datetime 
+from functools import wraps
+from typing import Callable, List, Optional, Sequence, Tuple
+import requests
+import http_client
+from http_client import RETRY_STATUSES, UpstreamError
+from cache import memoize_api_call, clear_cache, clear_cache_for_function, get_cache_stats, print_cache_status, track_stale
+from rate_limit import RATE_LIMITS, wait_budget
+from cache_keys import normalize_location, normalize_title
+from title_index import TITLE_INDEX
+from models import Movie, Review, Showtime, ShowtimeLookup, parse_serpapi_showtimes
+from purchases import PURCHASE_ENGINE, PurchaseError, showtime_key
+from session_store import CURRENT_SESSION, get_session_value, set_session_value
+from tool_registry import tool
+from render import TOOL_VERBOSITY, render_movie, render_movies, render_reviews, render_showtime_lookups, render_showtimes, render_stale_note
+
+logger = logging.getLogger(__name__)
+
+# Cache lifetimes in seconds
+NOW_PLAYING_TTL = 6 * 60 * 60
+SHOWTIMES_TTL = 30 * 60
+REVIEWS_TTL = 24 * 60 * 60
+LOCATION_TTL = 60 * 60
+
+# Seconds past their TTL that results are still served, with a note that
+# they are stale, when the upstream is rate limited or failing
+NOW_PLAYING_STALE_IF_ERROR = 24 * 60 * 60
+SHOWTIMES_STALE_IF_ERROR = 3 * 60 * 60
+REVIEWS_STALE_IF_ERROR = 7 * 24 * 60 * 60
+LOCATION_STALE_IF_ERROR = 24 * 60 * 60
+
+# Seconds to stop calling an upstream after a 429 without Retry-After
+THROTTLE_SECONDS = 5.0
+
+# Bulk showtimes: SerpAPI lookups running at once across every request in this
+# worker, lookups per request, and seconds a request waits before answering
+# with what it has. Lookups still running finish in the background and land
+# in the cache, so asking again is fast.
+BULK_SHOWTIMES_CONCURRENCY = 8
+MAX_BULK_LOOKUPS = 12
+BULK_SHOWTIMES_WAIT = 12.0
+
+# Session value holding the id of the session's latest seat hold
+LATEST_HOLD = "latest_hold"
+
+_BULK_EXECUTOR = ThreadPoolExecutor(max_workers=BULK_SHOWTIMES_CONCURRENCY, thread_name_prefix="showtimes")
 
-# Global cache dictionary
-# Structure: {
-#   'function_name:args': response_data
-# }
-_CACHE: Dict[str, Any] = {}
+# Upstream endpoints; overridable so the benchmarks can point them at local stubs
+TMDB_API_BASE = os.getenv("TMDB_API_BASE", "https://api.themoviedb.org/3")
+SERPAPI_SEARCH_URL = os.getenv("SERPAPI_SEARCH_URL", "https://serpapi.com/search.json")
+IPAPI_BASE = os.getenv("IPAPI_BASE", "https://ipapi.co")
 
-def memoize_api_call():
+
+def _upstream_get(upstream: str, url: str, **kwargs):
     """
-    Decorator to memoize API calls
+    GET url once the upstream's rate limiter lets the request start.
+
+    Retries like http_client.get, but each attempt goes through the limiter,
+    so it takes a token and counts against the quota like any request.
+    After a 429 the limiter holds back every request to the upstream, this
+    retry included.
+
+    Raises:
+        RateLimited: If the limiter refused the request
     """
-    def decorator(func: Callable) -> Callable:
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            # Create a cache key from function name and arguments
-            cache_key = f"{func.__name__}:{str(args)}:{str(kwargs)}"
-            print(f"\n[CACHE DEBUG] Looking for key: {cache_key}")
-            
-            # Return cached result if it exists
-            if cache_key in _CACHE:
-                print(f"[CACHE DEBUG] ✓ Cache hit! Returning cached result")
-                return _CACHE[cache_key]
-            
-            # If no cache, call the function and cache result
-            print(f"[CACHE DEBUG] ✗ Cache miss. Calling API and caching result")
+    client = http_client.client
+    limiter = RATE_LIMITS.get(upstream)
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            response = client.get(url, max_retries=0, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= client.max_retries:
+                raise
+            time.sleep(client.retry_delay(attempt))
+            attempt += 1
+            continue
+
+        if response.status_code == 429:
+            try:
+                seconds = float(response.headers.get("Retry-After") or THROTTLE_SECONDS)
+            except ValueError:
+                seconds = THROTTLE_SECONDS
+            limiter.throttle(max(0.0, seconds))
+        if response.status_code in RETRY_STATUSES and attempt < client.max_retries:
+            response.close()
+            if response.status_code != 429:
+                time.sleep(client.retry_delay(attempt))
+            attempt += 1
+            continue
+        return response
+
+def _marks_stale(func: Callable) -> Callable:
+    """Start a tool's answer with a note when any of it came from stale cache."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with track_stale() as stale:
             result = func(*args, **kwargs)
-            _CACHE[cache_key] = result
-            return result
-        return wrapper
-    return decorator
+        if stale and isinstance(result, str):
+            return render_stale_note(max(age for _, age in stale)) + result
+        return result
+    return wrapper
+
+def _tmdb_headers() -> dict:
+    return {
+        "accept": "application/json",
+        "Authorization": f"Bearer {os.getenv('TMDB_API_ACCESS_TOKEN')}"
+    }
 
-@memoize_api_call()
-def get_current_datetime():
+@tool(timeout=1.0)
+@memoize_api_call(enabled=False)
+def get_current_datetime() -> str:
+    """Fetches the current date and time"""
     # format date to Day, Month Day, Year, Hour:Minute:Second
     return datetime.now().strftime("%A, %B %d, %Y %H:%M:%S")
 
-@memoize_api_call()
-def get_location_by_ip(ip: str = None) -> str:
+@tool(description="Fetches the current location based on IP address", hidden=("ip",), timeout=6.0, cacheable=True)
+@memoize_api_call(ttl=LOCATION_TTL, max_entries=1024, stale_if_error=LOCATION_STALE_IF_ERROR)
+def get_location_by_ip(ip: Optional[str] = None) -> str:
     """
     Get approximate location (city, state) using IP address.
     If no IP is provided, gets location for the current machine's public IP.
     Returns location string in format "City, State" or "Location unavailable" on error.
+
+    Raises:
+        UpstreamError: If ipapi can't be called right now (rate limited, 429,
+            5xx or a connection error), so that a transient failure isn't
+            cached as "Location unavailable" for an hour
     """
     try:
         # If no IP provided, this will get location based on the requester's IP
-        url = f"https://ipapi.co/{ip}/json/" if ip else "https://ipapi.co/json/"
-        response = requests.get(url, timeout=5)
+        url = f"{IPAPI_BASE}/{ip}/json/" if ip else f"{IPAPI_BASE}/json/"
+        response = _upstream_get("ipapi", url, timeout=5)
+        if response.status_code in RETRY_STATUSES:
+            raise UpstreamError(f"Error getting location: {response.status_code} - {response.reason}")
         
         if response.status_code == 200:
             data = response.json()
@@ -62,45 +152,70 @@ def get_location_by_ip(ip: str = None) -> str:
             return "Location unavailable"
             
         return "Location unavailable"
+    except UpstreamError:
+        raise
+    except requests.RequestException as e:
+        raise UpstreamError(f"Error getting location: {e}") from e
     except Exception as e:
-        print(f"Error getting location: {str(e)}")
+        logger.warning("Error getting location: %s", e)
         return "Location unavailable"
 
-@memoize_api_call()
-def get_now_playing_movies():
-    url = "https://api.themoviedb.org/3/movie/now_playing?language=en-US&page=1"
-    headers = {
-        "Authorization": f"Bearer {os.getenv('TMDB_API_ACCESS_TOKEN')}"
-    }
-    response = requests.get(url, headers=headers)
+@memoize_api_call(ttl=NOW_PLAYING_TTL, max_entries=4, stale_while_revalidate=NOW_PLAYING_TTL,
+                  stale_if_error=NOW_PLAYING_STALE_IF_ERROR)
+def get_now_playing_results() -> Tuple[Movie, ...]:
+    """
+    Fetch the movies currently in theaters from TMDb.
+
+    Raises:
+        UpstreamError: If TMDb returned an error, so that it is not cached
+    """
+    response = _upstream_get(
+        "tmdb",
+        f"{TMDB_API_BASE}/movie/now_playing",
+        params={"language": "en-US", "page": 1},
+        headers=_tmdb_headers(),
+    )
     
     if response.status_code != 200:
-        return f"Error fetching data: {response.status_code} - {response.reason}"
+        raise UpstreamError(f"Error fetching data: {response.status_code} - {response.reason}")
     
     data = response.json()
+    return tuple(Movie.from_tmdb(movie) for movie in data.get('results') or [])
 
-    movies = data.get('results', [])
+def now_playing() -> Tuple[Movie, ...]:
+    """Movies currently in theaters, with their titles added to TITLE_INDEX."""
+    movies = get_now_playing_results()
+    # Cheap to repeat, and covers results loaded from the shared cache
+    for movie in movies:
+        TITLE_INDEX.add(movie.title, movie.id)
+    return movies
+
+@tool("get_now_playing", hidden=("verbosity",), timeout=10.0, cacheable=True)
+@_marks_stale
+def get_now_playing_movies(verbosity=TOOL_VERBOSITY):
+    """Fetches a list of movies currently playing in theaters"""
+    try:
+        return render_movies(now_playing(), verbosity)
+    except UpstreamError as e:
+        return str(e)
+
+@tool(hidden=("verbosity",), timeout=10.0)
+@_marks_stale
+def pick_random_movie(verbosity=TOOL_VERBOSITY):
+    """Picks a random movie from the list of currently playing movies"""
+    try:
+        movies = now_playing()
+    except UpstreamError as e:
+        return str(e)
     if not movies:
         return "No movies are currently playing."
+    return "Selected movie:\n" + render_movie(random.choice(movies), verbosity)
 
-    formatted_movies = "The TMDb API returned these movies:\n\n"
-
-    for movie in movies:
-        title = movie.get('title', 'N/A')
-        movie_id = movie.get('id', 'N/A')
-        release_date = movie.get('release_date', 'N/A')
-        overview = movie.get('overview', 'N/A')
-        formatted_movies += (
-            f"**Title:** {title}\n"
-            f"**Movie ID:** {movie_id}\n"
-            f"**Release Date:** {release_date}\n"
-            f"**Overview:** {overview}\n\n"
-        )
-
-    return formatted_movies
-
-@memoize_api_call()
-def get_showtimes(title, location):
+@memoize_api_call(ttl=SHOWTIMES_TTL, max_entries=2048, max_bytes=4 * 1024 * 1024,
+                  stale_if_error=SHOWTIMES_STALE_IF_ERROR,
+                  canonicalize={"title": normalize_title, "location": normalize_location})
+def get_showtime_results(title, location) -> Tuple[Showtime, ...]:
+    """Fetch every day, theater and format showing title near location from SerpAPI."""
     params = {
         "api_key": os.getenv('SERP_API_KEY'),
         "engine": "google",
@@ -111,91 +226,243 @@ def get_showtimes(title, location):
         "hl": "en"
     }
 
-    print("params", params)
-    search = GoogleSearch(params)
-    results = search.get_dict()
+    response = _upstream_get("serpapi", SERPAPI_SEARCH_URL, params=params, timeout=(3.05, 20))
+    if response.status_code != 200:
+        raise UpstreamError(f"Error fetching showtimes: {response.status_code} - {response.reason}")
 
-    if 'showtimes' not in results:
-        return f"No showtimes found for {title} in {location}."
+    return parse_serpapi_showtimes(response.json())
 
-    showtimes = results['showtimes'][0]
-    formatted_showtimes = f"Showtimes for {title} in {location}:\n\n"
+@tool(hidden=("verbosity",), timeout=20.0, cacheable=True)
+@_marks_stale
+def get_showtimes(title: str, location: str, verbosity=TOOL_VERBOSITY):
+    """
+    Fetches a list of showtimes for a movie in a specific location
 
-    if showtimes['theaters']:
-        theater = showtimes['theaters'][0]
-        theater_name = theater.get('name', 'Unknown Theater')
-        formatted_showtimes += f"**{theater_name}**\n"
+    Args:
+        title: The title of the movie
+        location: The location of the movie
+    """
+    try:
+        showtimes = get_showtime_results(title, location)
+    except UpstreamError as e:
+        return str(e)
+    return render_showtimes(title, location, showtimes, verbosity)
 
-        date = showtimes.get('day', 'Unknown Date')
-        formatted_showtimes += f"  {date}:\n"
+def lookup_showtimes(titles: Sequence[str], locations: Sequence[str],
+                     timeout: float = BULK_SHOWTIMES_WAIT) -> Tuple[ShowtimeLookup, ...]:
+    """
+    Showtimes for every (title, location) pair, fetched in parallel.
 
-        for showing in theater.get('showing', []):
-            for time in showing.get('time', []):
-                formatted_showtimes += f"    - {time}\n"
+    Pairs that only differ in spelling are looked up once, and at most
+    MAX_BULK_LOOKUPS pairs are looked up. Each pair is cached on its own by
+    get_showtime_results.
 
-    formatted_showtimes += "\n"
+    Returns:
+        One lookup per pair, locations outermost. Pairs that failed or were
+        still running after timeout seconds carry an error instead.
+    """
+    pairs: List[Tuple[str, str]] = []
+    seen = set()
+    for location in locations:
+        for title in titles:
+            key = (normalize_title(title), normalize_location(location))
+            if key not in seen:
+                seen.add(key)
+                pairs.append((title, location))
+    if len(pairs) > MAX_BULK_LOOKUPS:
+        logger.info("Bulk showtimes request for %d pairs cut to %d", len(pairs), MAX_BULK_LOOKUPS)
+        pairs = pairs[:MAX_BULK_LOOKUPS]
 
-    return formatted_showtimes
+    # Each lookup runs in a copy of this context, so stale results it serves
+    # are seen by the caller's track_stale(). More lookups than SerpAPI's
+    # burst queue at its rate limiter, for as long as the answer can wait.
+    with wait_budget(timeout):
+        futures = [_BULK_EXECUTOR.submit(copy_context().run, get_showtime_results, title, location)
+                   for title, location in pairs]
+    done, _ = wait(futures, timeout=timeout)
 
-def buy_ticket(theater, movie, showtime):
-    return f"Ticket purchased for {movie} at {theater} for {showtime}."
+    lookups = []
+    for (title, location), future in zip(pairs, futures):
+        if future not in done:
+            lookups.append(ShowtimeLookup(title, location, error="timed out"))
+        elif future.exception() is not None:
+            lookups.append(ShowtimeLookup(title, location, error=str(future.exception())))
+        else:
+            lookups.append(ShowtimeLookup(title, location, future.result()))
+    return tuple(lookups)
 
-@memoize_api_call()
-def get_reviews(movie_title):
-    # Get the movie ID from the title
-    id_url = f"https://api.themoviedb.org/3/search/movie?query={movie_title}&include_adult=false&language=en-US&page=1"
-    headers = {
-        "accept": "application/json",
-        "Authorization": f"Bearer {os.getenv('TMDB_API_ACCESS_TOKEN')}"
-    }
+# Answers with partial results after BULK_SHOWTIMES_WAIT
+@tool(hidden=("verbosity",), timeout=20.0, cacheable=True)
+@_marks_stale
+def get_showtimes_bulk(titles: Optional[List[str]] = None, locations: Optional[List[str]] = None,
+                       verbosity=TOOL_VERBOSITY):
+    """
+    Fetches showtimes for several movies and/or locations at once. Use it instead of calling get_showtimes repeatedly, e.g. for what is playing tonight near the user
 
-    id_response = requests.get(id_url, headers=headers)
-    id_data = id_response.json()
-    movie_id = id_data.get('results', [{}])[0].get('id', 'N/A')
-    
-    if not movie_id:
+    Args:
+        titles: Movie titles; leave empty for every movie now playing
+        locations: Locations to search; leave empty for the user's location
+    """
+    titles = list(titles or [])
+    locations = list(locations or [])
+    if not locations:
+        try:
+            location = get_location_by_ip()
+        except UpstreamError:
+            location = "Location unavailable"
+        if location == "Location unavailable":
+            return "The user's location is unknown; ask them where they are."
+        locations = [location]
+    if not titles:
+        try:
+            titles = [movie.title for movie in now_playing()][:max(1, MAX_BULK_LOOKUPS // len(locations))]
+        except UpstreamError as e:
+            return str(e)
+    return render_showtime_lookups(lookup_showtimes(titles, locations), verbosity)
+
+@tool(timeout=2.0, parallel_safe=False)
+async def buy_ticket(theater: str, movie: str, showtime: str, quantity: int = 1):
+    """
+    Holds seats for a showtime for a few minutes and returns the seats, price and hold ID, for the user to confirm
+
+    Args:
+        theater: The name of the theater
+        movie: The title of the movie
+        showtime: The day and time of the showing
+        quantity: Number of tickets, 1 if not stated
+    """
+    session_id = CURRENT_SESSION.get()
+    # A retried call in the same session gets the same hold instead of more seats
+    idempotency_key = hashlib.blake2b(
+        f"{session_id}|{showtime_key(theater, movie, showtime)}|{quantity}".encode(), digest_size=16
+    ).hexdigest()
+    try:
+        hold = PURCHASE_ENGINE.hold(theater, movie, showtime, int(quantity), session_id, idempotency_key)
+    except (PurchaseError, ValueError) as e:
+        return str(e)
+    await set_session_value(LATEST_HOLD, hold.hold_id)
+    total = PURCHASE_ENGINE.price_cents * len(hold.seats) / 100
+    minutes = max(1, round((hold.expires_at - time.time()) / 60))
+    return (
+        f"Held {len(hold.seats)} seat(s) {', '.join(hold.seats)} for {movie} at {theater}, {showtime}. "
+        f"Total ${total:.2f}. The hold (ID {hold.hold_id}) expires in {minutes} minutes. "
+        "Ask the user to confirm these details before calling confirm_ticket_purchase."
+    )
+
+# The timeout includes waiting in the payment queue
+@tool(timeout=30.0, parallel_safe=False)
+async def confirm_ticket_purchase(hold_id: Optional[str] = None):
+    """
+    Pays for seats held by buy_ticket. Only call it after the user has confirmed the details
+
+    Args:
+        hold_id: The hold ID returned by buy_ticket; the user's latest hold if omitted
+    """
+    hold_id = hold_id or await get_session_value(LATEST_HOLD)
+    if not hold_id:
+        return "There are no seats on hold; call buy_ticket first."
+    try:
+        purchase = await PURCHASE_ENGINE.confirm(hold_id, CURRENT_SESSION.get())
+    except PurchaseError as e:
+        return str(e)
+    return (
+        f"Purchased {len(purchase.seats)} ticket(s) for {purchase.movie} at {purchase.theater}, {purchase.time}. "
+        f"Seats {', '.join(purchase.seats)}, total ${purchase.amount_cents / 100:.2f}. "
+        f"Confirmation number {purchase.purchase_id}."
+    )
+
+@memoize_api_call(ttl=REVIEWS_TTL, max_entries=2048, stale_if_error=REVIEWS_STALE_IF_ERROR,
+                  canonicalize={"movie_title": normalize_title})
+def search_movie(movie_title) -> Optional[Movie]:
+    """
+    Look a title up with the TMDb search API.
+
+    Returns:
+        The best match, or None if nothing matched
+    """
+    response = _upstream_get(
+        "tmdb",
+        f"{TMDB_API_BASE}/search/movie",
+        params={"query": movie_title, "include_adult": "false", "language": "en-US", "page": 1},
+        headers=_tmdb_headers(),
+    )
+    if response.status_code != 200:
+        raise UpstreamError(f"Error searching for {movie_title}: {response.status_code} - {response.reason}")
+
+    results = response.json().get('results') or []
+    if not results or results[0].get('id') is None:
+        return None
+    return Movie.from_tmdb(results[0])
+
+def resolve_movie_id(movie_title, threshold=None):
+    """
+    Turn a movie title into a TMDb ID.
+
+    Titles already seen in now-playing results or earlier searches are
+    resolved from TITLE_INDEX, exactly, normalized or fuzzily. Only unknown
+    titles fall back to the search API.
+
+    Args:
+        movie_title: Title as written by the user or the model
+        threshold: Minimum fuzzy match score, defaulting to the index's threshold
+
+    Returns:
+        The movie ID, or None if no movie matched
+    """
+    match = TITLE_INDEX.lookup(movie_title, threshold)
+    if match is not None:
+        return match.movie_id
+
+    found = search_movie(movie_title)
+    if found is None:
+        return None
+    TITLE_INDEX.add(movie_title, found.id)
+    TITLE_INDEX.add(found.title, found.id)
+    return found.id
+
+@memoize_api_call(ttl=REVIEWS_TTL, max_entries=512, max_bytes=16 * 1024 * 1024,
+                  stale_while_revalidate=REVIEWS_TTL, stale_if_error=REVIEWS_STALE_IF_ERROR)
+def get_movie_reviews(movie_id) -> Tuple[Review, ...]:
+    """Fetch the TMDb reviews for a movie ID."""
+    response = _upstream_get(
+        "tmdb",
+        f"{TMDB_API_BASE}/movie/{movie_id}/reviews",
+        params={"language": "en-US", "page": 1},
+        headers=_tmdb_headers(),
+    )
+    if response.status_code != 200:
+        raise UpstreamError(f"Error fetching reviews: {response.status_code} - {response.reason}")
+
+    return tuple(Review.from_tmdb(review) for review in response.json().get('results') or [])
+
+def get_review_results(movie_title) -> Optional[Tuple[Review, ...]]:
+    """
+    The TMDb reviews for a movie title.
+
+    Returns:
+        The reviews, or None if no movie ID was found for the title
+    """
+    movie_id = resolve_movie_id(movie_title)
+    if movie_id is None:
+        return None
+    return get_movie_reviews(movie_id)
+
+# Reviews reach the model through the review gate, so the tool isn't listed
+@tool(hidden=("verbosity",), timeout=15.0, cacheable=True, listed=False)
+@_marks_stale
+def get_reviews(movie_title: str, verbosity=TOOL_VERBOSITY):
+    """
+    Fetches critics' reviews of a movie
+
+    Args:
+        movie_title: The title of the movie
+    """
+    try:
+        reviews = get_review_results(movie_title)
+    except UpstreamError as e:
+        return str(e)
+
+    if reviews is None:
         return "No movie ID found for the given title."
-    
-    review_url = f"https://api.themoviedb.org/3/movie/{movie_id}/reviews?language=en-US&page=1"
-
-    response = requests.get(review_url, headers=headers)
-    reviews_data = response.json()
-
-    if 'results' not in reviews_data or not reviews_data['results']:
-        return "No reviews found."
-
-    formatted_reviews = ""
-    for review in reviews_data['results']:
-        author = review.get('author', 'N/A')
-        rating = review.get('author_details', {}).get('rating', 'N/A')
-        content = review.get('content', 'N/A')
-        created_at = review.get('created_at', 'N/A')
-        url = review.get('url', 'N/A')
-
-        formatted_reviews += (
-            f"**Author:** {author}\n"
-            f"**Rating:** {rating}\n"
-            f"**Content:** {content}\n"
-            f"**Created At:** {created_at}\n"
-            f"**URL:** {url}\n"
-            "----------------------------------------\n"
-        )
-
-    return formatted_reviews
-
-def clear_cache():
-    """Clear the entire API cache"""
-    global _CACHE
-    _CACHE = {}
-
-def clear_cache_for_function(function_name: str):
-    """Clear cache entries for a specific function"""
-    global _CACHE
-    _CACHE = {k: v for k, v in _CACHE.items() if not k.startswith(f"{function_name}:")}
-
-def print_cache_status():
-    """Print the current contents of the cache"""
-    print("\n[CACHE STATUS]")
-    print(f"Total cached items: {len(_CACHE)}")
-    for key in _CACHE:
-        print(f"- {key}")
+
+    return render_reviews(reviews, verbosity)
@@ -0,0 +1,375 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, List, Optional, Sequence
+
+from cache_keys import normalize_location, normalize_title
+from metrics import REGISTRY, Gauges
+from models import Movie
+from rate_limit import RATE_LIMITS, background_priority
+from movie_functions import get_movie_reviews, get_now_playing_results, get_showtime_results, now_playing
+from review_index import get_review_index
+
+logger = logging.getLogger(__name__)
+
+# Seconds between prefetch cycles
+PREFETCH_INTERVAL = 10 * 60
+
+# Entries with less than this fraction of their TTL left, or that would
+# expire before the next cycle ends, are refreshed ahead of expiry, so user
+# turns never see them go stale
+REFRESH_AHEAD = 0.25
+
+# Locations whose showtimes are kept warm: the configured ones plus the most
+# requested ones that were asked for at least MIN_LOCATION_REQUESTS times
+MAX_HOT_LOCATIONS = 3
+MIN_LOCATION_REQUESTS = 2
+
+# Most requested titles whose showtimes are warmed for each hot location,
+# if they are now playing and were asked for at least MIN_TITLE_REQUESTS times
+SHOWTIME_TITLES = 10
+MIN_TITLE_REQUESTS = 2
+
+# SerpAPI bills every search against its quota, so showtime warming gets at
+# most this share of it, spread evenly over the quota period. Unspent budget
+# carries over for up to SHOWTIME_BUDGET_CARRYOVER seconds' worth.
+SHOWTIME_QUOTA_SHARE = 0.3
+SHOWTIME_BUDGET_CARRYOVER = 60 * 60
+
+# Approximate length of a quota period, for spreading the budget
+_QUOTA_PERIOD_SECONDS = {"day": 24 * 60 * 60, "month": 30 * 24 * 60 * 60}
+
+# Per-upstream pacing for prefetch traffic:
+#   (requests running at once, minimum seconds between request starts)
+UPSTREAM_LIMITS: Dict[str, tuple] = {
+    "tmdb": (4, 0.1),
+    "serpapi": (1, 2.0),
+}
+
+# Prefetch gets its own small pool so it never queues ahead of user tool calls
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+
+
+class Pacer:
+    """Caps concurrency and spaces out request starts for one upstream."""
+
+    def __init__(self, concurrency: int, interval: float):
+        self.interval = interval
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lock = asyncio.Lock()
+        self._next_start = 0.0
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        async with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def __aexit__(self, *exc_info):
+        self._semaphore.release()
+
+
+class Traffic:
+    """
+    Counts the locations (or titles) users ask showtimes for.
+
+    Counts are halved every prefetch cycle, so the hot set follows shifts in
+    traffic instead of remembering yesterday's.
+
+    Args:
+        normalize: Maps spellings of the same value to one key
+    """
+
+    def __init__(self, normalize: Callable[[str], str] = normalize_location):
+        self.normalize = normalize
+        self._counts: Counter = Counter()
+        # normalized value -> last spelling seen, which is what SerpAPI gets
+        self._spellings: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def record(self, value: str) -> None:
+        key = self.normalize(value) if value else ""
+        if not key:
+            return
+        with self._lock:
+            self._counts[key] += 1
+            self._spellings[key] = value
+
+    def hot(self, limit: int = MAX_HOT_LOCATIONS, min_requests: int = MIN_LOCATION_REQUESTS) -> List[str]:
+        with self._lock:
+            return [self._spellings[key] for key, count in self._counts.most_common(limit)
+                    if count >= min_requests]
+
+    def decay(self) -> None:
+        with self._lock:
+            self._counts = Counter({key: count // 2 for key, count in self._counts.items() if count > 1})
+            self._spellings = {key: self._spellings[key] for key in self._counts}
+
+
+class Prefetcher:
+    """
+    Keeps the caches behind the movie tools warm.
+
+    Each cycle refreshes now-playing, then fans out over its movies to
+    refresh their reviews (and review indexes), and warms showtimes of the
+    most requested titles now playing for the hot locations, within the
+    showtime budget (SHOWTIME_QUOTA_SHARE of the SerpAPI quota).
+
+    Missing entries are loaded through the memoized functions, so one
+    another worker already stored is read from the shared cache. Entries
+    that are cached but would go stale before the next cycle (see
+    REFRESH_AHEAD) are fetched again; the rest are skipped. All fetches
+    share single-flight and the shared cache with user turns.
+
+    Args:
+        interval: Seconds between cycles
+        locations: Locations whose showtimes are always warmed
+        showtime_titles: Requested titles warmed per hot location
+    """
+
+    def __init__(self, interval: float = PREFETCH_INTERVAL, locations: Sequence[str] = (),
+                 showtime_titles: int = SHOWTIME_TITLES):
+        self.interval = interval
+        self.locations = list(locations)
+        self.showtime_titles = showtime_titles
+        self.traffic = Traffic(normalize_location)
+        self.titles = Traffic(normalize_title)
+        # SerpAPI searches showtime warming may still make
+        self.showtime_budget = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._pacers: Dict[str, Pacer] = {}
+
+        self._movies: tuple = ()
+        self._hot_locations: List[str] = []
+        self.cycles = 0
+        self.last_cycle_at: Optional[float] = None
+        self.last_cycle_seconds = 0.0
+        self.counters = Counter()
+
+    def start(self) -> bool:
+        """Start the cycle loop on the running event loop; returns False if already running."""
+        if self._task is not None and not self._task.done():
+            return False
+        self._pacers = {name: Pacer(*limits) for name, limits in UPSTREAM_LIMITS.items()}
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return True
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_cycle()
+            except Exception as e:
+                logger.warning("Prefetch cycle failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def run_cycle(self) -> None:
+        started = time.monotonic()
+
+        movies = await self._warm("tmdb", get_now_playing_results)
+        if movies is not None:
+            # Adds the titles and IDs to TITLE_INDEX, so reviews resolve without a search
+            self._movies = await _run(now_playing)
+
+        await asyncio.gather(*(self._warm_reviews(movie) for movie in self._movies))
+
+        self._hot_locations = self.hot_locations()
+        self._add_showtime_budget()
+        await asyncio.gather(*(
+            self._warm_showtimes(title, location) for title, location in self.showtime_pairs()
+        ))
+        self.traffic.decay()
+        self.titles.decay()
+
+        self.cycles += 1
+        self.last_cycle_at = time.monotonic()
+        self.last_cycle_seconds = self.last_cycle_at - started
+
+    async def _warm_reviews(self, movie: Movie) -> None:
+        if movie.id is None:
+            return
+        reviews = await self._warm("tmdb", get_movie_reviews, movie.id)
+        if reviews is not None:
+            await _run(get_review_index, movie.title)
+
+    def _add_showtime_budget(self) -> None:
+        limiter = RATE_LIMITS.get("serpapi")
+        if limiter.quota is None:
+            self.showtime_budget = float("inf")
+            return
+        per_second = limiter.quota * SHOWTIME_QUOTA_SHARE / _QUOTA_PERIOD_SECONDS[limiter.limit.quota_period]
+        self.showtime_budget = min(self.showtime_budget + per_second * self.interval,
+                                   max(1.0, per_second * SHOWTIME_BUDGET_CARRYOVER))
+
+    def showtime_pairs(self) -> List[tuple]:
+        """(title, location) pairs whose showtimes are warmed, most requested title first."""
+        playing = {normalize_title(movie.title): movie.title for movie in self._movies}
+        titles = [playing[normalize_title(title)] for title in self.titles.hot(len(playing), MIN_TITLE_REQUESTS)
+                  if normalize_title(title) in playing][:self.showtime_titles]
+        return [(title, location) for title in titles for location in self._hot_locations]
+
+    async def _warm_showtimes(self, title: str, location: str) -> None:
+        if self._due(get_showtime_results, title, location):
+            if self.showtime_budget < 1:
+                self.counters["serpapi_over_budget"] += 1
+                return
+            self.showtime_budget -= 1
+        await self._warm("serpapi", get_showtime_results, title, location)
+
+    def _due(self, func: Callable, *args) -> bool:
+        """Whether func(*args) is missing, or would go stale before the next cycle ends."""
+        remaining = func.remaining_ttl(*args)
+        ttl = func.cache.ttl
+        if remaining is None:
+            return True
+        if ttl is None:
+            return False
+        return remaining <= max(ttl * REFRESH_AHEAD, self.interval + self.last_cycle_seconds)
+
+    async def _warm(self, upstream: str, func: Callable, *args):
+        """Load func(*args) if it is missing, refresh it if close to expiry; returns the result or None on error."""
+        if not self._due(func, *args):
+            self.counters[f"{upstream}_fresh"] += 1
+            return await _run(func, *args)
+
+        # Missing: load it, from the shared cache if another worker stored it
+        # already. Close to expiry: fetch it again, as the shared copy is as old.
+        call = func if func.remaining_ttl(*args) is None else func.force_refresh
+        async with self._pacers[upstream]:
+            try:
+                result = await _run(call, *args)
+            except Exception as e:
+                self.counters[f"{upstream}_errors"] += 1
+                logger.warning("Prefetch of %s%s failed: %s", func.__name__, args, e)
+                return None
+        self.counters[f"{upstream}_fetched"] += 1
+        return result
+
+    def hot_locations(self) -> List[str]:
+        locations = list(self.locations)
+        seen = {normalize_location(location) for location in locations}
+        for location in self.traffic.hot():
+            if normalize_location(location) not in seen:
+                locations.append(location)
+                seen.add(normalize_location(location))
+        return locations
+
+    def stats(self) -> dict:
+        """
+        Freshness and coverage of the warmed caches.
+
+        Coverage is the fraction of the prefetch targets from the last cycle
+        that are cached and fresh right now.
+        """
+        movies = [movie for movie in self._movies if movie.id is not None]
+        reviews_warm = sum(_is_fresh(get_movie_reviews, movie.id) for movie in movies)
+        pairs = self.showtime_pairs()
+        showtimes_warm = sum(_is_fresh(get_showtime_results, *pair) for pair in pairs)
+
+        now_playing_left = get_now_playing_results.remaining_ttl()
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "cycles": self.cycles,
+            "last_cycle_age": time.monotonic() - self.last_cycle_at if self.last_cycle_at else None,
+            "last_cycle_seconds": round(self.last_cycle_seconds, 2),
+            "now_playing_fresh_for": now_playing_left,
+            "movies": len(movies),
+            "hot_locations": list(self._hot_locations),
+            "reviews_coverage": reviews_warm / len(movies) if movies else 0.0,
+            "showtimes_coverage": showtimes_warm / len(pairs) if pairs else 0.0,
+            "showtime_budget": round(self.showtime_budget, 2),
+            **self.counters,
+        }
+
+
+def _is_fresh(func: Callable, *args) -> bool:
+    remaining = func.remaining_ttl(*args)
+    return remaining is not None and remaining > 0
+
+
+def _in_background(func: Callable, *args):
+    # Queues behind user turns at the upstream rate limiters
+    with background_priority():
+        return func(*args)
+
+
+async def _run(func: Callable, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_EXECUTOR, partial(_in_background, func, *args))
+
+
+# Shared prefetcher, started with the first chat session
+PREFETCHER = Prefetcher()
+
+
+def start_prefetcher() -> bool:
+    """
+    Start PREFETCHER unless PREFETCH_ENABLED is "0".
+
+    PREFETCH_LOCATIONS lists locations that are always warmed, separated by
+    semicolons, e.g. "Austin, TX; Seattle, WA".
+    """
+    if os.getenv("PREFETCH_ENABLED", "1") == "0":
+        return False
+    configured = os.getenv("PREFETCH_LOCATIONS", "")
+    PREFETCHER.locations = [location.strip() for location in configured.split(";") if location.strip()]
+    return PREFETCHER.start()
+
+
+def observe_tool_calls(tool_calls: List[dict]) -> None:
+    """Count the locations and titles in showtimes calls towards the hot sets."""
+    for tool_call in tool_calls:
+        name = tool_call["function"]["name"]
+        if name not in ("get_showtimes", "get_showtimes_bulk"):
+            continue
+        try:
+            arguments = json.loads(tool_call["function"]["arguments"] or "{}")
+        except json.JSONDecodeError:
+            continue
+        # Not validated yet: the model may send null, a list or a string
+        if not isinstance(arguments, dict):
+            continue
+        if name == "get_showtimes_bulk":
+            locations, titles = arguments.get("locations"), arguments.get("titles")
+        else:
+            locations, titles = [arguments.get("location")], [arguments.get("title")]
+        for location in locations if isinstance(locations, list) else []:
+            if isinstance(location, str):
+                PREFETCHER.traffic.record(location)
+        for title in titles if isinstance(titles, list) else []:
+            if isinstance(title, str):
+                PREFETCHER.titles.record(title)
+
+
+def _prefetch_samples(field: str):
+    return [({}, PREFETCHER.stats()[field])]
+
+
+# Fields that are None (before the first cycle) are left out of the scrape
+for _name, _field, _help in [
+    ("movie_prefetch_reviews_coverage", "reviews_coverage",
+     "Fraction of now playing movies whose reviews are cached and fresh."),
+    ("movie_prefetch_showtimes_coverage", "showtimes_coverage",
+     "Fraction of hot location and title pairs whose showtimes are cached and fresh."),
+    ("movie_prefetch_last_cycle_age_seconds", "last_cycle_age", "Seconds since the last prefetch cycle finished."),
+    ("movie_prefetch_now_playing_fresh_for_seconds", "now_playing_fresh_for",
+     "Seconds until the cached now playing list expires."),
+]:
+    REGISTRY.register(Gauges(_name, _help, lambda field=_field: _prefetch_samples(field)))
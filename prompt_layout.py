@@ -0,0 +1,93 @@
+import copy
+import json
+from typing import List, Optional, Tuple
+
+import litellm
+
+from history import ConversationHistory
+
+# Providers that need explicit cache_control breakpoints. OpenAI caches
+# prompt prefixes automatically and needs nothing but a stable prefix.
+CACHE_CONTROL_PROVIDERS = frozenset({"anthropic"})
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def supports_cache_control(model: str) -> bool:
+    try:
+        _, provider, _, _ = litellm.get_llm_provider(model)
+    except Exception:
+        return False
+    return provider in CACHE_CONTROL_PROVIDERS
+
+
+def _with_breakpoint(message: dict) -> dict:
+    """A copy of message whose text content is a single block marked for caching."""
+    return {
+        **message,
+        "content": [{"type": "text", "text": message["content"], "cache_control": CACHE_CONTROL}],
+    }
+
+
+def _cacheable(message: dict) -> bool:
+    return message.get("role") in ("system", "user", "assistant") and isinstance(message.get("content"), str) \
+        and bool(message["content"])
+
+
+class PromptLayout:
+    """
+    Lays out main completion requests for provider-side prompt caching.
+
+    The request is the tools, then the history from ConversationHistory.view():
+    system prompt, frozen older turns, then the rest of the conversation, all
+    append-only. The system prompt is the only system message. Each turn
+    opens with its "Turn context" (date, time, location), sent as a user
+    message just before the user's own (see KIND_TURN_CONTEXT), because
+    Anthropic and Gemini only take system content at the start and litellm
+    would move a later system message there, changing the cached prefix
+    every turn. For providers in CACHE_CONTROL_PROVIDERS, cache breakpoints
+    mark the end of the tools, the system prompt, the frozen prefix and the
+    last cacheable message (Anthropic allows four). Stored messages are never
+    modified; breakpoints go on copies.
+
+    Args:
+        model: Model the requests are for
+        tools: Tool schemas, sent in the same order every time
+    """
+
+    def __init__(self, model: str, tools: List[dict]):
+        self.model = model
+        self.cache_control = supports_cache_control(model)
+        if self.cache_control and tools:
+            tools = copy.deepcopy(tools)
+            tools[-1]["cache_control"] = CACHE_CONTROL
+        self.tools = tools
+
+    def request(self, history: ConversationHistory) -> Tuple[List[dict], Optional[List[dict]]]:
+        """
+        Returns:
+            The messages and tools for a main completion on history
+        """
+        messages = history.view()
+        if not self.cache_control:
+            return messages, self.tools
+
+        breakpoints = {0, history.frozen_count - 1}
+        last = next((i for i in range(len(messages) - 1, -1, -1) if _cacheable(messages[i])), None)
+        if last is not None:
+            breakpoints.add(last)
+        messages = [
+            _with_breakpoint(message) if i in breakpoints and _cacheable(message) else message
+            for i, message in enumerate(messages)
+        ]
+        return messages, self.tools
+
+
+def shared_prefix(previous: List[dict], current: List[dict]) -> int:
+    """Number of leading messages that serialize to the same bytes in both prompts."""
+    count = 0
+    for before, after in zip(previous, current):
+        if json.dumps(before) != json.dumps(after):
+            break
+        count += 1
+    return count
@@ -0,0 +1,471 @@
+import asyncio
+import hashlib
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from cache_keys import normalize_text, normalize_title
+from metrics import REGISTRY, Counter, Histogram
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Auditorium layout for showtimes we know nothing else about
+DEFAULT_ROWS = 12
+DEFAULT_SEATS_PER_ROW = 20
+
+TICKET_PRICE_CENTS = 1500
+MAX_TICKETS_PER_HOLD = 10
+
+# Seconds a hold keeps its seats before they go back on sale
+HOLD_TTL = 5 * 60
+
+# Seconds a charge may wait in the payment queue before it is dropped unsent
+# and the seats are released. A charge already sent always runs to the end;
+# a hold still PAYING PAYMENT_GRACE seconds after that (its charge never
+# landed) is reclaimed like an expired one.
+PAYMENT_TIMEOUT = 60.0
+PAYMENT_GRACE = 30.0
+
+# Showtimes are spread over this many locks, so purchases for different
+# showtimes rarely wait on each other
+LOCK_SHARDS = 64
+
+# Payment requests charged at once, and how many may queue behind them
+PAYMENT_WORKERS = 8
+MAX_PENDING_PAYMENTS = 1000
+
+HELD = "held"
+PAYING = "paying"
+CONFIRMED = "confirmed"
+RELEASED = "released"
+
+PURCHASES = REGISTRY.register(Counter(
+    "movie_purchases_total", "Ticket holds and purchases, by step and outcome."))
+PAYMENT_SECONDS = REGISTRY.register(Histogram(
+    "movie_payment_seconds", "Payment requests, including time queued, by outcome."))
+
+
+class PurchaseError(Exception):
+    """A hold or purchase could not be made; the message is meant for the user."""
+
+
+class PaymentError(Exception):
+    """The payment service declined or failed a charge."""
+
+
+def showtime_key(theater: str, movie: str, showtime: str) -> str:
+    return "|".join((normalize_text(theater), normalize_title(movie), normalize_text(showtime)))
+
+
+def seat_label(seat: int, seats_per_row: int) -> str:
+    row, number = divmod(seat, seats_per_row)
+    return f"{chr(ord('A') + row)}{number + 1}"
+
+
+class SeatMap:
+    """
+    Seat inventory of one showtime, as two bitmaps over the auditorium.
+
+    Bit n is seat n, counted row by row from the front. A seat is free when
+    its bit is clear in both sold and held. Not thread-safe; the engine
+    guards each SeatMap with its shard lock.
+    """
+
+    __slots__ = ("rows", "seats_per_row", "sold", "held", "holds", "_row_order")
+
+    def __init__(self, rows: int = DEFAULT_ROWS, seats_per_row: int = DEFAULT_SEATS_PER_ROW):
+        self.rows = rows
+        self.seats_per_row = seats_per_row
+        self.sold = 0
+        self.held = 0
+        # hold_id -> Hold, for the holds on this showtime
+        self.holds: Dict[str, "Hold"] = {}
+        # Rows about two thirds back are filled first
+        preferred = rows * 2 // 3
+        self._row_order = sorted(range(rows), key=lambda row: (abs(row - preferred), row))
+
+    @property
+    def capacity(self) -> int:
+        return self.rows * self.seats_per_row
+
+    def available(self) -> int:
+        return self.capacity - bin(self.sold | self.held).count("1")
+
+    def find(self, quantity: int) -> Optional[int]:
+        """Mask of quantity adjacent free seats in the best row, or None if no row has them."""
+        taken = self.sold | self.held
+        run = (1 << quantity) - 1
+        # Start near the middle of the row and work outwards
+        middle = (self.seats_per_row - quantity) // 2
+        offsets = sorted(range(self.seats_per_row - quantity + 1), key=lambda offset: (abs(offset - middle), offset))
+        for row in self._row_order:
+            row_taken = (taken >> (row * self.seats_per_row)) & ((1 << self.seats_per_row) - 1)
+            for offset in offsets:
+                if not row_taken & (run << offset):
+                    return run << (row * self.seats_per_row + offset)
+        return None
+
+    def seats(self, mask: int) -> List[str]:
+        labels = []
+        seat = 0
+        while mask:
+            if mask & 1:
+                labels.append(seat_label(seat, self.seats_per_row))
+            mask >>= 1
+            seat += 1
+        return labels
+
+
+@dataclass(slots=True)
+class Hold:
+    hold_id: str
+    showtime: str
+    theater: str
+    movie: str
+    time: str
+    mask: int
+    seats: Tuple[str, ...]
+    expires_at: float
+    session_id: Optional[str] = None
+    idempotency_key: Optional[str] = None
+    state: str = HELD
+
+
+@dataclass(slots=True, frozen=True)
+class Purchase:
+    purchase_id: str
+    hold_id: str
+    theater: str
+    movie: str
+    time: str
+    seats: Tuple[str, ...]
+    amount_cents: int
+    receipt: str
+    session_id: Optional[str] = None
+
+
+class LocalPaymentService:
+    """
+    Stand-in for a payment provider: fixed latency, optional random declines.
+
+    Charges are idempotent on their reference, as with real providers, so a
+    retried charge never bills twice.
+
+    Args:
+        latency: Seconds each charge takes
+        failure_rate: Fraction of charges declined
+    """
+
+    def __init__(self, latency: float = 0.05, failure_rate: float = 0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._receipts: Dict[str, str] = {}
+        self.charges = 0
+
+    async def charge(self, reference: str, amount_cents: int) -> str:
+        """Returns a receipt ID; raises PaymentError if declined."""
+        if reference in self._receipts:
+            return self._receipts[reference]
+        await asyncio.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise PaymentError("card declined")
+        self.charges += 1
+        receipt = self._receipts[reference] = f"rcpt_{hashlib.blake2b(reference.encode(), digest_size=6).hexdigest()}"
+        return receipt
+
+
+class PaymentQueue:
+    """
+    Bounded queue in front of the payment service, drained by a fixed number of workers.
+
+    Caps the charges in flight, so an on-sale rush queues here instead of
+    overwhelming the provider. Workers start on the first charge, on the
+    running event loop.
+    """
+
+    def __init__(self, service, workers: int = PAYMENT_WORKERS, max_pending: int = MAX_PENDING_PAYMENTS):
+        self.service = service
+        self.workers = workers
+        self.max_pending = max_pending
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def _start(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_pending)
+            self._tasks = [asyncio.get_running_loop().create_task(self._work()) for _ in range(self.workers)]
+        return self._queue
+
+    async def charge(self, reference: str, amount_cents: int, deadline: Optional[float] = None) -> str:
+        """
+        Charge through the queue.
+
+        Args:
+            reference: What the charge is for, passed to the payment service
+            amount_cents: Amount to charge
+            deadline: time.time() after which the charge is dropped if it hasn't been sent yet
+
+        Raises:
+            PaymentError: The charge was declined, failed, or dropped
+        """
+        queue = self._start()
+        if queue.full():
+            raise PaymentError("too many payments in progress, try again shortly")
+        future = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        queue.put_nowait((reference, amount_cents, deadline, future))
+        try:
+            receipt = await future
+        except PaymentError:
+            PAYMENT_SECONDS.observe(time.perf_counter() - started, outcome="declined")
+            raise
+        PAYMENT_SECONDS.observe(time.perf_counter() - started, outcome="ok")
+        return receipt
+
+    async def _work(self) -> None:
+        while True:
+            reference, amount_cents, deadline, future = await self._queue.get()
+            if future.done() or (deadline is not None and time.time() > deadline):
+                # Nothing was charged yet, so the caller can be told so
+                if not future.done():
+                    future.set_exception(PaymentError("timed out waiting for the payment service"))
+                self._queue.task_done()
+                continue
+            try:
+                result = await self.service.charge(reference, amount_cents)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e if isinstance(e, PaymentError) else PaymentError(str(e)))
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._queue.task_done()
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+
+def _unknown_hold(hold_id: str) -> PurchaseError:
+    PURCHASES.inc(step="confirm", outcome="unknown_hold")
+    return PurchaseError(f"There is no open hold {hold_id}; it may have expired. Hold the seats again.")
+
+
+def _retrieve(task: asyncio.Future) -> None:
+    # A payment nobody waits for anymore: its outcome is already recorded
+    if not task.cancelled():
+        task.exception()
+
+
+class PurchaseEngine:
+    """
+    Seat holds and purchases for every showtime, safe under concurrent use.
+
+    A purchase is two steps: hold() reserves adjacent seats for HOLD_TTL
+    seconds, and confirm() charges for them and marks them sold. Expired
+    holds are released the next time their showtime is touched.
+
+    Each showtime's SeatMap is guarded by one of LOCK_SHARDS locks, picked
+    by its key, so there is no global lock. Payment runs outside the lock,
+    and once started it settles the hold even if confirm() is cancelled; a
+    hold whose payment never lands is reclaimed PAYMENT_GRACE seconds after
+    PAYMENT_TIMEOUT.
+
+    Retries are safe: hold() with the same idempotency key returns the hold
+    it made while that hold is still open, and confirm() of a hold returns
+    the same purchase however often it is called.
+
+    Args:
+        payments: Charges for confirmed holds
+        hold_ttl: Seconds a hold lasts
+        shards: Number of locks the showtimes are spread over
+    """
+
+    def __init__(self, payments: Optional[PaymentQueue] = None, hold_ttl: float = HOLD_TTL,
+                 shards: int = LOCK_SHARDS, price_cents: int = TICKET_PRICE_CENTS):
+        self.payments = payments or PaymentQueue(LocalPaymentService())
+        self.hold_ttl = hold_ttl
+        self.price_cents = price_cents
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._seatmaps: Dict[str, SeatMap] = {}
+        self._holds: Dict[str, Hold] = {}
+        # idempotency key -> hold_id
+        self._hold_keys: Dict[str, str] = {}
+        self._purchases: Dict[str, Purchase] = {}
+        # hold_id -> its payment, while it runs
+        self._payments: Dict[str, asyncio.Future] = {}
+        self._flights = SingleFlight()
+        self._ids = 0
+        self._ids_lock = threading.Lock()
+
+    def _lock(self, key: str) -> threading.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+    def _next_id(self, prefix: str) -> str:
+        with self._ids_lock:
+            self._ids += 1
+            return f"{prefix}{self._ids:06d}"
+
+    def _seatmap(self, key: str) -> SeatMap:
+        # Called with the key's shard lock held
+        seatmap = self._seatmaps.get(key)
+        if seatmap is None:
+            seatmap = self._seatmaps[key] = SeatMap()
+        return seatmap
+
+    def _release(self, seatmap: SeatMap, hold: Hold, state: str = RELEASED) -> None:
+        # Called with the showtime's shard lock held
+        seatmap.held &= ~hold.mask
+        seatmap.holds.pop(hold.hold_id, None)
+        self._holds.pop(hold.hold_id, None)
+        if hold.idempotency_key is not None and self._hold_keys.get(hold.idempotency_key) == hold.hold_id:
+            del self._hold_keys[hold.idempotency_key]
+        hold.state = state
+
+    def _expire(self, seatmap: SeatMap, now: float) -> None:
+        for hold in list(seatmap.holds.values()):
+            if hold.state in (HELD, PAYING) and hold.expires_at <= now:
+                if hold.state == PAYING:
+                    logger.error("Reclaiming hold %s, whose payment never completed", hold.hold_id)
+                self._release(seatmap, hold)
+                PURCHASES.inc(step="hold", outcome="expired")
+
+    def hold(self, theater: str, movie: str, showtime: str, quantity: int = 1,
+             session_id: Optional[str] = None, idempotency_key: Optional[str] = None) -> Hold:
+        """
+        Hold quantity adjacent seats for a showtime.
+
+        Raises:
+            PurchaseError: If the quantity is invalid or no row has enough adjacent free seats
+        """
+        if not 1 <= quantity <= MAX_TICKETS_PER_HOLD:
+            raise PurchaseError(f"Tickets can be bought {MAX_TICKETS_PER_HOLD} at a time at most.")
+        key = showtime_key(theater, movie, showtime)
+        now = time.time()
+        with self._lock(key):
+            if idempotency_key is not None:
+                previous = self._holds.get(self._hold_keys.get(idempotency_key, ""))
+                if previous is not None and previous.state in (HELD, PAYING) and previous.expires_at > now:
+                    PURCHASES.inc(step="hold", outcome="replayed")
+                    return previous
+
+            seatmap = self._seatmap(key)
+            self._expire(seatmap, now)
+            mask = seatmap.find(quantity)
+            if mask is None:
+                PURCHASES.inc(step="hold", outcome="sold_out")
+                raise PurchaseError(
+                    f"Not enough adjacent seats left for {movie} at {theater}, {showtime} "
+                    f"({seatmap.available()} seats available).")
+            seatmap.held |= mask
+            hold = Hold(self._next_id("H"), key, theater, movie, showtime, mask, tuple(seatmap.seats(mask)),
+                        now + self.hold_ttl, session_id, idempotency_key)
+            seatmap.holds[hold.hold_id] = hold
+            self._holds[hold.hold_id] = hold
+            if idempotency_key is not None:
+                self._hold_keys[idempotency_key] = hold.hold_id
+        PURCHASES.inc(step="hold", outcome="ok")
+        return hold
+
+    async def confirm(self, hold_id: str, session_id: Optional[str] = None) -> Purchase:
+        """
+        Pay for a hold and mark its seats sold.
+
+        Concurrent confirms of one hold share a single payment.
+
+        Args:
+            hold_id: From hold()
+            session_id: The caller's session; only the session that made the
+                hold may confirm it
+
+        Raises:
+            PurchaseError: If the hold is unknown, belongs to another session,
+                is expired or released, or payment failed
+        """
+        purchase = self._purchases.get(hold_id)
+        if purchase is not None and purchase.session_id == session_id:
+            PURCHASES.inc(step="confirm", outcome="replayed")
+            return purchase
+        hold = self._holds.get(hold_id)
+        if purchase is not None or (hold is not None and hold.session_id != session_id):
+            # Hold IDs are sequential, so another session's look like unknown ones
+            raise _unknown_hold(hold_id)
+        return await self._flights.do_async(f"confirm:{hold_id}", self._confirm, hold_id)
+
+    async def _confirm(self, hold_id: str) -> Purchase:
+        purchase = self._purchases.get(hold_id)
+        if purchase is not None:
+            return purchase
+        payment = self._payments.get(hold_id)
+        if payment is not None:
+            # Started by a confirm that was cancelled while it ran
+            return await asyncio.shield(payment)
+        hold = self._holds.get(hold_id)
+        if hold is None:
+            raise _unknown_hold(hold_id)
+
+        with self._lock(hold.showtime):
+            seatmap = self._seatmaps[hold.showtime]
+            if hold.state == HELD and hold.expires_at <= time.time():
+                self._release(seatmap, hold)
+                PURCHASES.inc(step="hold", outcome="expired")
+            if hold.state != HELD:
+                PURCHASES.inc(step="confirm", outcome="expired")
+                raise PurchaseError(f"The hold on seats {', '.join(hold.seats)} has expired; hold them again.")
+            # Keeps the seats from expiring while payment is in progress
+            hold.state = PAYING
+            hold.expires_at = time.time() + PAYMENT_TIMEOUT + PAYMENT_GRACE
+
+        # Once queued, the customer may be billed, so the payment runs to the
+        # end and settles the hold even if this call is cancelled (a tool
+        # timeout, or the confirm flight's leader going away)
+        payment = asyncio.ensure_future(self._pay(hold, seatmap))
+        self._payments[hold_id] = payment
+        payment.add_done_callback(lambda task: self._payments.pop(hold_id, None))
+        payment.add_done_callback(_retrieve)
+        return await asyncio.shield(payment)
+
+    async def _pay(self, hold: Hold, seatmap: SeatMap) -> Purchase:
+        amount = self.price_cents * len(hold.seats)
+        try:
+            receipt = await self.payments.charge(hold.hold_id, amount, time.time() + PAYMENT_TIMEOUT)
+        except PaymentError as e:
+            with self._lock(hold.showtime):
+                if hold.state == PAYING:
+                    self._release(seatmap, hold)
+            PURCHASES.inc(step="confirm", outcome="payment_failed")
+            raise PurchaseError(f"Payment failed ({e}); the seats were released.") from e
+
+        with self._lock(hold.showtime):
+            if hold.state != PAYING:
+                # Reclaimed by _expire before the charge landed
+                logger.error("Charge %s for hold %s landed after its seats were released; refund it",
+                             receipt, hold.hold_id)
+                PURCHASES.inc(step="confirm", outcome="charged_after_release")
+                raise PurchaseError("Payment completed too late and the seats were released; "
+                                    "the charge will be refunded.")
+            seatmap.sold |= hold.mask
+            self._release(seatmap, hold, CONFIRMED)
+            purchase = Purchase(self._next_id("P"), hold.hold_id, hold.theater, hold.movie, hold.time,
+                                hold.seats, amount, receipt, hold.session_id)
+            self._purchases[hold.hold_id] = purchase
+        PURCHASES.inc(step="confirm", outcome="ok")
+        return purchase
+
+    def stats(self) -> dict:
+        seatmaps = list(self._seatmaps.values())
+        return {
+            "showtimes": len(seatmaps),
+            "seats_sold": sum(bin(seatmap.sold).count("1") for seatmap in seatmaps),
+            "seats_held": sum(bin(seatmap.held).count("1") for seatmap in seatmaps),
+            "purchases": len(self._purchases),
+            "payments_pending": self.payments.pending(),
+        }
+
+
+# Shared by every chat session in this worker
+PURCHASE_ENGINE = PurchaseEngine()
@@ -0,0 +1,416 @@
+import heapq
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from http_client import UpstreamError
+from metrics import REGISTRY, Counter, Gauges, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Request priorities, lowest value first. User turns are interactive;
+# the prefetcher runs its fetches as background.
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+# Longest a request waits for its turn before it is refused. Interactive
+# requests give up quickly, so the tool can answer from stale cache while
+# the user is still waiting; prefetch can afford to queue.
+MAX_WAIT: Dict[int, float] = {INTERACTIVE: 2.0, BACKGROUND: 30.0}
+
+# Share of a metered quota that only interactive requests may use, so
+# prefetch never spends the calls users need at the end of a period
+INTERACTIVE_RESERVE = 0.2
+
+
+@dataclass(slots=True, frozen=True)
+class UpstreamLimit:
+    """
+    Pacing for one upstream API.
+
+    Attributes:
+        rate: Requests per second, on average
+        burst: Requests that may start at once after a quiet period
+        quota: Requests allowed per quota_period, or None if unmetered
+        quota_period: "day" or "month", in UTC
+        quota_env: Environment variable that overrides quota
+    """
+    rate: float
+    burst: int
+    quota: Optional[int] = None
+    quota_period: str = "month"
+    quota_env: Optional[str] = None
+
+
+# TMDb allows around 50 requests per second per IP; SerpAPI bills every
+# search against a monthly plan; ipapi's free tier allows 1,000 a day.
+UPSTREAM_LIMITS: Dict[str, UpstreamLimit] = {
+    "tmdb": UpstreamLimit(rate=20.0, burst=40),
+    "serpapi": UpstreamLimit(rate=1.0, burst=5, quota=5000, quota_period="month", quota_env="SERPAPI_MONTHLY_QUOTA"),
+    "ipapi": UpstreamLimit(rate=1.0, burst=10, quota=1000, quota_period="day", quota_env="IPAPI_DAILY_QUOTA"),
+}
+
+# Priority of upstream requests made from the current context
+PRIORITY: ContextVar[int] = ContextVar("upstream_priority", default=INTERACTIVE)
+
+# time.monotonic() until which requests from the current context may wait
+# for their turn, when later than MAX_WAIT allows; see wait_budget()
+WAIT_UNTIL: ContextVar[Optional[float]] = ContextVar("upstream_wait_until", default=None)
+
+UPSTREAM_QUEUE_SECONDS = REGISTRY.register(Histogram(
+    "movie_upstream_queue_seconds", "Time upstream requests waited for the rate limiter, by upstream and priority."))
+UPSTREAM_REJECTIONS = REGISTRY.register(Counter(
+    "movie_upstream_rejections_total",
+    "Upstream requests refused by the rate limiter, by upstream, priority and reason (rate or quota)."))
+
+
+class RateLimited(UpstreamError):
+    """The limiter refused an upstream request. Like any UpstreamError, the result is never cached."""
+
+
+class QuotaExhausted(RateLimited):
+    """The upstream's quota for the current period is used up."""
+
+
+@contextmanager
+def background_priority() -> Iterator[None]:
+    """Make upstream requests in this block at BACKGROUND priority."""
+    token = PRIORITY.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        PRIORITY.reset(token)
+
+
+@contextmanager
+def wait_budget(seconds: float) -> Iterator[None]:
+    """
+    Let upstream requests in this block wait up to seconds from now for their turn.
+
+    For tools that fan out over more requests than an upstream's burst, and
+    answer with what they have after seconds anyway.
+    """
+    token = WAIT_UNTIL.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        WAIT_UNTIL.reset(token)
+
+
+class TokenBucket:
+    """
+    Refills rate tokens per second up to burst; each request takes one.
+
+    Not thread-safe; UpstreamLimiter guards it with its own lock.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Take a token and return 0, or return the seconds until one is available."""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self, seconds: float, now: float) -> None:
+        """Hand out no tokens for the next seconds, e.g. after a 429's Retry-After."""
+        self._refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class QuotaStore:
+    """Requests counted against metered quotas, per upstream and period, in memory."""
+
+    def __init__(self):
+        self._used: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def used(self, upstream: str, period: str) -> int:
+        with self._lock:
+            return self._used.get((upstream, period), 0)
+
+    def add(self, upstream: str, period: str, count: int = 1) -> int:
+        """Add count requests and return the new total for the period."""
+        with self._lock:
+            total = self._used.get((upstream, period), 0) + count
+            self._used[(upstream, period)] = total
+            return total
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteQuotaStore(QuotaStore):
+    """
+    Quota counts on disk, shared by every worker process on a host and kept
+    across restarts. Each add is a single upsert, so workers never lose
+    each other's counts.
+
+    Args:
+        path: Database file path; its directory is created if missing
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS upstream_quota ("
+            " upstream TEXT NOT NULL,"
+            " period TEXT NOT NULL,"
+            " used INTEGER NOT NULL,"
+            " PRIMARY KEY (upstream, period)"
+            ") WITHOUT ROWID"
+        )
+        conn.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections are not shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def used(self, upstream: str, period: str) -> int:
+        row = self._connection().execute(
+            "SELECT used FROM upstream_quota WHERE upstream = ? AND period = ?", (upstream, period),
+        ).fetchone()
+        return row[0] if row else 0
+
+    def add(self, upstream: str, period: str, count: int = 1) -> int:
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT INTO upstream_quota (upstream, period, used) VALUES (?, ?, ?)"
+                " ON CONFLICT (upstream, period) DO UPDATE SET used = used + excluded.used",
+                (upstream, period, count),
+            )
+            row = conn.execute(
+                "SELECT used FROM upstream_quota WHERE upstream = ? AND period = ?", (upstream, period),
+            ).fetchone()
+        return row[0]
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def quota_store_from_env() -> QuotaStore:
+    """
+    The quota store configured by RATE_LIMIT_DB.
+
+    Defaults to .cache/rate_limits.sqlite3. Set RATE_LIMIT_DB to an empty
+    string to count in memory only, starting from zero on every restart.
+    """
+    path = os.getenv("RATE_LIMIT_DB", ".cache/rate_limits.sqlite3")
+    if path:
+        try:
+            return SQLiteQuotaStore(path)
+        except Exception as e:
+            logger.warning("Quota store unavailable, counting in memory only: %s", e)
+    return QuotaStore()
+
+
+def _period(kind: str, now: Optional[datetime] = None) -> str:
+    now = now or datetime.now(timezone.utc)
+    return now.strftime("%Y-%m-%d" if kind == "day" else "%Y-%m")
+
+
+class UpstreamLimiter:
+    """
+    Token bucket plus a priority queue in front of one upstream.
+
+    Waiting requests are served lowest priority value first, then in
+    arrival order, so a user turn arriving during a prefetch burst goes
+    ahead of every queued prefetch request. A request that can't start
+    within MAX_WAIT for its priority (or its wait_budget()) is refused
+    with RateLimited, and callers fall back to stale cached data. Metered
+    upstreams also count each request against the period's quota in store.
+
+    Args:
+        name: Upstream name used in metrics and errors
+        limit: Rate, burst and quota
+        store: Where quota counts are kept
+    """
+
+    def __init__(self, name: str, limit: UpstreamLimit, store: QuotaStore):
+        self.name = name
+        self.limit = limit
+        self.store = store
+        self.quota = limit.quota
+        if limit.quota_env and os.getenv(limit.quota_env):
+            self.quota = int(os.environ[limit.quota_env])
+        self._bucket = TokenBucket(limit.rate, limit.burst)
+        self._cond = threading.Condition()
+        self._waiters: List[Tuple[int, int]] = []
+        self._sequence = itertools.count()
+        # Last count seen, so refusing an exhausted quota needs no I/O
+        self._quota_period = ""
+        self._quota_used = 0
+
+    def _quota_allowed(self, priority: int) -> Optional[int]:
+        if self.quota is None:
+            return None
+        if priority == INTERACTIVE:
+            return self.quota
+        return int(self.quota * (1 - INTERACTIVE_RESERVE))
+
+    def _refuse(self, error: RateLimited, priority: int, reason: str) -> RateLimited:
+        UPSTREAM_REJECTIONS.inc(upstream=self.name, priority=PRIORITY_NAMES[priority], reason=reason)
+        logger.info("%s (%s)", error, PRIORITY_NAMES[priority])
+        return error
+
+    def _check_quota(self, priority: int) -> None:
+        allowed = self._quota_allowed(priority)
+        if allowed is None:
+            return
+        period = _period(self.limit.quota_period)
+        if period != self._quota_period:
+            self._quota_period = period
+            self._quota_used = self.store.used(self.name, period)
+        if self._quota_used >= allowed:
+            raise self._refuse(QuotaExhausted(f"The {self.name} quota for {period} is used up"), priority, "quota")
+
+    def _charge_quota(self, priority: int) -> None:
+        allowed = self._quota_allowed(priority)
+        if allowed is None:
+            return
+        period = _period(self.limit.quota_period)
+        self._quota_period = period
+        self._quota_used = self.store.add(self.name, period)
+        if self._quota_used > allowed:
+            # Another worker took the last request first
+            self._quota_used = self.store.add(self.name, period, -1)
+            raise self._refuse(QuotaExhausted(f"The {self.name} quota for {period} is used up"), priority, "quota")
+
+    def acquire(self, priority: Optional[int] = None) -> float:
+        """
+        Wait until a request to the upstream may start.
+
+        Args:
+            priority: INTERACTIVE or BACKGROUND; defaults to PRIORITY in the current context
+
+        Returns:
+            Seconds spent waiting
+
+        Raises:
+            RateLimited: If the request couldn't start within MAX_WAIT or the wait_budget()
+            QuotaExhausted: If the period's quota is used up
+        """
+        priority = PRIORITY.get() if priority is None else priority
+        self._check_quota(priority)
+
+        started = time.monotonic()
+        deadline = max(started + MAX_WAIT[priority], WAIT_UNTIL.get() or 0.0)
+        with self._cond:
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    # Only the head of the queue may take a token
+                    wait = self._bucket.take(now) if self._waiters[0] == entry else None
+                    if wait == 0:
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        raise self._refuse(
+                            RateLimited(f"{self.name} is busy; try again in a few seconds"), priority, "rate")
+                    self._cond.wait(remaining if wait is None else wait)
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+        waited = time.monotonic() - started
+        UPSTREAM_QUEUE_SECONDS.observe(waited, upstream=self.name, priority=PRIORITY_NAMES[priority])
+        self._charge_quota(priority)
+        return waited
+
+    def throttle(self, seconds: float) -> None:
+        """Start no requests for the next seconds, after the upstream answered 429."""
+        with self._cond:
+            self._bucket.drain(seconds, time.monotonic())
+
+    def stats(self) -> dict:
+        with self._cond:
+            queued = len(self._waiters)
+        stats = {"queued": queued, "rate": self.limit.rate, "burst": self.limit.burst}
+        if self.quota is not None:
+            stats.update(quota=self.quota, quota_period=self._quota_period, quota_used=self._quota_used)
+        return stats
+
+
+class RateLimits:
+    """
+    The limiters for every upstream in UPSTREAM_LIMITS, created on first use
+    so that RATE_LIMIT_DB and quota overrides from a .env loaded after
+    import are honoured.
+    """
+
+    def __init__(self, limits: Dict[str, UpstreamLimit]):
+        self.limits = limits
+        self._limiters: Dict[str, UpstreamLimiter] = {}
+        self._store: Optional[QuotaStore] = None
+        self._lock = threading.Lock()
+
+    def get(self, upstream: str) -> UpstreamLimiter:
+        limiter = self._limiters.get(upstream)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(upstream)
+                if limiter is None:
+                    if self._store is None:
+                        self._store = quota_store_from_env()
+                    limiter = UpstreamLimiter(upstream, self.limits[upstream], self._store)
+                    self._limiters[upstream] = limiter
+        return limiter
+
+    def acquire(self, upstream: str) -> float:
+        return self.get(upstream).acquire()
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: limiter.stats() for name, limiter in list(self._limiters.items())}
+
+
+RATE_LIMITS = RateLimits(UPSTREAM_LIMITS)
+
+
+def _limiter_samples(field: str):
+    return [({"upstream": name}, stats.get(field)) for name, stats in RATE_LIMITS.stats().items()]
+
+
+REGISTRY.register(Gauges(
+    "movie_upstream_queued", "Requests waiting for the rate limiter.", lambda: _limiter_samples("queued")))
+REGISTRY.register(Gauges(
+    "movie_upstream_quota_used", "Requests counted against the current quota period.",
+    lambda: _limiter_samples("quota_used")))
+REGISTRY.register(Gauges(
+    "movie_upstream_quota", "Requests allowed per quota period.", lambda: _limiter_samples("quota")))
@@ -0,0 +1,127 @@
+from typing import Iterable, Optional, Sequence
+
+from models import Movie, Review, Showtime, ShowtimeLookup
+
+# How much detail the renderers include:
+#   "full"  - the labelled markdown the tools originally returned
+#   "terse" - one compact line per record, to save prompt tokens
+FULL = "full"
+TERSE = "terse"
+
+# What the tools send the model unless told otherwise
+TOOL_VERBOSITY = TERSE
+
+# Caps that keep a single tool result from flooding the prompt
+MAX_THEATERS = 5
+BULK_MAX_THEATERS = 3
+TERSE_OVERVIEW_CHARS = 160
+TERSE_REVIEW_CHARS = 600
+
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+def render_movie(movie: Movie, verbosity: str = TOOL_VERBOSITY) -> str:
+    if verbosity == TERSE:
+        line = f"- {movie.title} (id {movie.id}, released {movie.release_date or 'N/A'})"
+        if movie.overview:
+            line += f": {_clip(movie.overview, TERSE_OVERVIEW_CHARS)}"
+        return line
+    return (
+        f"**Title:** {movie.title}\n"
+        f"**Movie ID:** {movie.id if movie.id is not None else 'N/A'}\n"
+        f"**Release Date:** {movie.release_date or 'N/A'}\n"
+        f"**Overview:** {movie.overview or 'N/A'}\n"
+    )
+
+
+def render_movies(movies: Sequence[Movie], verbosity: str = TOOL_VERBOSITY) -> str:
+    if not movies:
+        return "No movies are currently playing."
+    if verbosity == TERSE:
+        return "Now playing:\n" + "\n".join(render_movie(movie, TERSE) for movie in movies)
+    return "The TMDb API returned these movies:\n\n" + "\n".join(render_movie(movie, FULL) for movie in movies) + "\n"
+
+
+def render_showtimes(title: str, location: str, showtimes: Sequence[Showtime],
+                     verbosity: str = TOOL_VERBOSITY, max_theaters: Optional[int] = MAX_THEATERS) -> str:
+    if not showtimes:
+        return f"No showtimes found for {title} in {location}."
+
+    # Group by day, then theater, keeping SerpAPI's order (nearest first)
+    days: dict = {}
+    for showtime in showtimes:
+        days.setdefault(showtime.day, {}).setdefault(showtime.theater, []).append(showtime)
+
+    lines = [f"Showtimes for {title} in {location}:"]
+    for day, theaters in days.items():
+        shown = list(theaters.items())[:max_theaters] if max_theaters else list(theaters.items())
+        if verbosity == TERSE:
+            lines.append(f"{day}:")
+            for theater, entries in shown:
+                times = "; ".join(
+                    (f"{entry.format} " if entry.format else "") + ", ".join(entry.times)
+                    for entry in entries
+                )
+                lines.append(f"- {theater.name}: {times}")
+        else:
+            lines.append("")
+            for theater, entries in shown:
+                lines.append(f"**{theater.name}**")
+                if theater.address:
+                    lines.append(f"  {theater.address}")
+                lines.append(f"  {day}:")
+                for entry in entries:
+                    for time in entry.times:
+                        lines.append(f"    - {time}" + (f" ({entry.format})" if entry.format else ""))
+        if len(theaters) > len(shown):
+            lines.append(f"(+{len(theaters) - len(shown)} more theaters)")
+    return "\n".join(lines) + "\n"
+
+
+def render_showtime_lookups(lookups: Sequence[ShowtimeLookup], verbosity: str = TOOL_VERBOSITY,
+                            max_theaters: Optional[int] = BULK_MAX_THEATERS) -> str:
+    """Every lookup of a bulk request, with fewer theaters each than a single lookup shows."""
+    if not lookups:
+        return "No showtimes were requested."
+    sections = []
+    for lookup in lookups:
+        if lookup.error:
+            sections.append(f"Showtimes for {lookup.title} in {lookup.location}: unavailable ({lookup.error}).\n")
+        else:
+            sections.append(render_showtimes(lookup.title, lookup.location, lookup.showtimes, verbosity, max_theaters))
+    return "\n".join(sections)
+
+
+def render_review(review: Review, verbosity: str = TOOL_VERBOSITY) -> str:
+    rating = f"{review.rating:g}/10" if review.rating is not None else "N/A"
+    if verbosity == TERSE:
+        return f"- [{review.author}, {rating}] {_clip(review.content, TERSE_REVIEW_CHARS)}"
+    return (
+        f"**Author:** {review.author}\n"
+        f"**Rating:** {rating}\n"
+        f"**Content:** {review.content}\n"
+        f"**Created At:** {review.created_at or 'N/A'}\n"
+        f"**URL:** {review.url or 'N/A'}\n"
+        "----------------------------------------\n"
+    )
+
+
+def render_reviews(reviews: Iterable[Review], verbosity: str = TOOL_VERBOSITY) -> str:
+    reviews = list(reviews)
+    if not reviews:
+        return "No reviews found."
+    separator = "\n" if verbosity == TERSE else ""
+    return separator.join(render_review(review, verbosity) for review in reviews)
+
+
+def render_stale_note(age_seconds: float) -> str:
+    """A line telling the model the results below are older cached data."""
+    if age_seconds < 2 * 60 * 60:
+        age = f"{max(1, round(age_seconds / 60))} minutes"
+    else:
+        age = f"{round(age_seconds / 3600)} hours"
+    return (f"Note: live data is unavailable right now, so these results are from about {age} ago "
+            "and may be out of date. Tell the user.\n")
@@ -0,0 +1,167 @@
+import json
+import re
+from typing import List, Optional, Set
+
+from cache_keys import normalize_title
+from metrics import REGISTRY, Counter
+from title_index import TITLE_INDEX, TitleIndex
+
+# Questions that critics' opinions help answer
+OPINION_PATTERN = re.compile(
+    r"\b(worth|any good|good|great|bad|review|reviews|reviewed|critic|critics|rating|ratings|rated|"
+    r"score|rotten|tomatoes|recommend|opinion|opinions|think of|thoughts on|people say|people think|"
+    r"overrated|underrated|liked|enjoy|should i (see|watch)|how was|how is|scary|funny)\b"
+)
+
+# Questions about facts and logistics, which reviews don't help with
+LOGISTICS_PATTERN = re.compile(
+    r"\b(showtime|showtimes|show times|playing|tickets?|buy|book|purchase|when|where|what time|"
+    r"theater|theaters|theatre|cinema|near me|now playing|runtime|how long|cast|starring|director|"
+    r"directed|release|released|trailer|date|today|tonight|tomorrow|location)\b"
+)
+
+# First line of the review context message injected by app.get_review_context
+_CONTEXT_TITLE = re.compile(r"Reviews for (.+?):\s*$", re.MULTILINE)
+
+GATE_DECISIONS = REGISTRY.register(Counter(
+    "movie_review_gate_decisions_total", "Review gate decisions, by tier and outcome."))
+
+
+def decision(movie: Optional[str], fetch_reviews: bool, rationale: str) -> dict:
+    return {"movie": movie, "fetch_reviews": fetch_reviews, "rationale": rationale}
+
+
+def last_user_message(messages: List[dict], kinds: Optional[List[Optional[str]]] = None) -> str:
+    for i in range(len(messages) - 1, -1, -1):
+        message = messages[i]
+        if message.get("role") != "user":
+            continue
+        if kinds is not None and kinds[i] is not None:
+            # Injected context, not something the user wrote
+            continue
+        if str(message.get("content") or "").startswith("Function call return for"):
+            continue
+        return str(message.get("content") or "")
+    return ""
+
+
+def reviewed_titles(messages: List[dict]) -> Set[str]:
+    """Normalized titles whose reviews are already in the conversation."""
+    titles: Set[str] = set()
+    for message in messages:
+        content = str(message.get("content") or "")
+        if content.startswith("Function call return for get_reviews"):
+            titles.update(normalize_title(title) for title in _CONTEXT_TITLE.findall(content.split("\n", 1)[0]))
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function") or {}
+            if function.get("name") != "get_reviews":
+                continue
+            try:
+                title = json.loads(function.get("arguments") or "{}").get("movie_title")
+            except (ValueError, AttributeError):
+                continue
+            if isinstance(title, str):
+                titles.add(normalize_title(title))
+    return titles
+
+
+def classify(messages: List[dict], kinds: Optional[List[Optional[str]]] = None,
+             index: TitleIndex = TITLE_INDEX) -> Optional[dict]:
+    """
+    Decide the obvious cases without a model call.
+
+    Titles are recognized against the title index, which holds the
+    now-playing titles and every title resolved so far.
+
+    Returns:
+        A gate decision dict, or None when the message is ambiguous and
+        should go to the model
+    """
+    text = last_user_message(messages, kinds)
+    if not text:
+        return decision(None, False, "no user message")
+    lowered = text.lower()
+    wants_opinion = OPINION_PATTERN.search(lowered) is not None
+    logistics = LOGISTICS_PATTERN.search(lowered) is not None
+    mentioned = {normalize_title(match.title): match.title for match in index.mentions(text)}
+
+    if not wants_opinion:
+        if logistics or not mentioned:
+            return decision(None, False, "no opinion asked for")
+        # "Tell me about X" may or may not want reviews
+        return None
+
+    if len(mentioned) != 1:
+        # No title we know (an older film, or "it"), or a comparison
+        return None
+    key, title = next(iter(mentioned.items()))
+    if key in reviewed_titles(messages):
+        return decision(title, False, "reviews already provided")
+    return decision(title, True, "opinion asked about a known movie")
+
+
+def parse_reply(text: Optional[str]) -> Optional[dict]:
+    """
+    Gate decision from a model reply, tolerating code fences and extra prose.
+
+    Returns:
+        The decision, or None if no decision could be read from the reply
+
+    Example:
+        >>> parse_reply('Sure!\\n```json\\n{"movie": "Wicked", "fetch_reviews": "true"}\\n```')["fetch_reviews"]
+        True
+    """
+    if not text:
+        return None
+    parsed = None
+    for candidate in (text, *_json_objects(text)):
+        try:
+            value = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            parsed = value
+            break
+    if parsed is None:
+        # Last resort: pick the fields out of malformed JSON
+        fetch = re.search(r'"?fetch_reviews"?\s*:\s*"?(true|false)', text, re.IGNORECASE)
+        if fetch is None:
+            return None
+        movie = re.search(r'"?movie"?\s*:\s*"([^"]*)"', text)
+        parsed = {"movie": movie.group(1) if movie else None, "fetch_reviews": fetch.group(1)}
+
+    fetch_reviews = parsed.get("fetch_reviews")
+    if isinstance(fetch_reviews, str):
+        fetch_reviews = fetch_reviews.strip().lower() == "true"
+    movie = parsed.get("movie")
+    return decision(movie if isinstance(movie, str) and movie else None, bool(fetch_reviews),
+                    str(parsed.get("rationale") or ""))
+
+
+def _json_objects(text: str) -> List[str]:
+    """Balanced {...} spans in text, outermost first."""
+    spans = []
+    depth = 0
+    start = None
+    in_string = False
+    escaped = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif char == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                spans.append(text[start:i + 1])
+    return spans
@@ -0,0 +1,188 @@
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+from cache_keys import normalize_text, normalize_title
+from models import Review
+from movie_functions import get_review_results
+
+# Passages are cut to roughly this many words
+PASSAGE_WORDS = 80
+
+# Passages injected into the prompt for a review-augmented turn
+DEFAULT_TOP_K = 4
+
+# Movies whose indexes are kept in memory
+MAX_INDEXES = 128
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have he her his i if in into is it its
+me my of on or our she so than that the their them then there these they this to
+was we were what when which who will with would you your about how
+""".split())
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def tokenize(text: str) -> List[str]:
+    return [term for term in normalize_text(text).split() if term not in STOPWORDS]
+
+
+def split_passages(text: str, max_words: int = PASSAGE_WORDS) -> List[str]:
+    """
+    Split review text into passages of about max_words words.
+
+    Paragraphs are kept together where they fit. Longer paragraphs are split
+    on sentence boundaries.
+    """
+    passages: List[str] = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = " ".join(paragraph.split())
+        if not paragraph:
+            continue
+        current: List[str] = []
+        count = 0
+        for sentence in _SENTENCE_END.split(paragraph):
+            words = len(sentence.split())
+            if current and count + words > max_words:
+                passages.append(" ".join(current))
+                current, count = [], 0
+            current.append(sentence)
+            count += words
+        if current:
+            passages.append(" ".join(current))
+    return passages
+
+
+class Passage:
+    __slots__ = ("review", "text", "author", "rating")
+
+    def __init__(self, review: int, text: str, author: str, rating):
+        self.review = review
+        self.text = text
+        self.author = author
+        self.rating = rating
+
+
+class ReviewIndex:
+    """
+    BM25 index over the review passages of one movie.
+
+    The inverted index maps each term to a compact list of
+    (passage number, term frequency) postings. A query only touches the
+    postings of its own terms.
+    """
+
+    def __init__(self, reviews: Sequence[Review]):
+        self.reviews = reviews
+        self.passages: List[Passage] = []
+        self.postings: Dict[str, List[tuple]] = {}
+        lengths: List[int] = []
+
+        for review_number, review in enumerate(reviews):
+            for text in split_passages(review.content):
+                terms = Counter(tokenize(text))
+                passage_id = len(self.passages)
+                self.passages.append(Passage(review_number, text, review.author, review.rating))
+                lengths.append(sum(terms.values()))
+                for term, frequency in terms.items():
+                    self.postings.setdefault(term, []).append((passage_id, frequency))
+
+        self.lengths = lengths
+        self.average_length = sum(lengths) / len(lengths) if lengths else 0.0
+
+    def search(self, query: str, k: int = DEFAULT_TOP_K) -> List[Passage]:
+        """The k passages most relevant to query, best first."""
+        scores: Dict[int, float] = {}
+        total = len(self.passages)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for passage_id, frequency in postings:
+                norm = K1 * (1 - B + B * self.lengths[passage_id] / self.average_length)
+                scores[passage_id] = scores.get(passage_id, 0.0) + idf * frequency * (K1 + 1) / (frequency + norm)
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[:k]
+        if len(ranked) < k:
+            # Nothing (or too little) matched; fill with each review's opening passage
+            seen = set(ranked)
+            openings = [i for i, p in enumerate(self.passages) if i == 0 or p.review != self.passages[i - 1].review]
+            ranked += [i for i in openings if i not in seen][:k - len(ranked)]
+        return [self.passages[i] for i in ranked]
+
+    def rating_stats(self) -> dict:
+        ratings = [review.rating for review in self.reviews if review.rating is not None]
+        return {
+            "reviews": len(self.reviews),
+            "rated": len(ratings),
+            "average": round(sum(ratings) / len(ratings), 1) if ratings else None,
+            "min": min(ratings) if ratings else None,
+            "max": max(ratings) if ratings else None,
+        }
+
+
+# Structure: {
+#   'normalized title': (review results the index was built from, ReviewIndex)
+# }
+_INDEXES: "OrderedDict[str, tuple]" = OrderedDict()
+_INDEX_LOCK = threading.Lock()
+
+
+def get_review_index(movie_title: str) -> Optional[ReviewIndex]:
+    """
+    The review index for a movie, or None if the movie could not be found.
+
+    Indexes are rebuilt whenever the cached review results they were built
+    from are replaced, so they expire with the reviews cache.
+    """
+    reviews = get_review_results(movie_title)
+    if reviews is None:
+        return None
+    key = normalize_title(movie_title)
+    with _INDEX_LOCK:
+        cached = _INDEXES.get(key)
+        if cached is not None and cached[0] is reviews:
+            _INDEXES.move_to_end(key)
+            return cached[1]
+    index = ReviewIndex(reviews)
+    with _INDEX_LOCK:
+        _INDEXES[key] = (reviews, index)
+        _INDEXES.move_to_end(key)
+        while len(_INDEXES) > MAX_INDEXES:
+            _INDEXES.popitem(last=False)
+    return index
+
+
+def retrieve_review_context(movie_title: str, question: str, k: int = DEFAULT_TOP_K) -> str:
+    """
+    Rating statistics and the k review passages most relevant to question.
+
+    Example output:
+        8 reviews (6 rated, average 7.2/10, range 4-9)
+        - [Jane, 8/10] The desert photography is ...
+    """
+    index = get_review_index(movie_title)
+    if index is None:
+        return "No movie ID found for the given title."
+    if not index.passages:
+        return "No reviews found."
+
+    stats = index.rating_stats()
+    summary = f"{stats['reviews']} reviews"
+    if stats["rated"]:
+        summary += (f" ({stats['rated']} rated, average {stats['average']}/10, "
+                    f"range {stats['min']:g}-{stats['max']:g})")
+
+    lines = [summary]
+    for passage in index.search(question, k):
+        rating = f", {passage.rating:g}/10" if passage.rating is not None else ""
+        lines.append(f"- [{passage.author}{rating}] {passage.text}")
+    return "\n".join(lines)
@@ -0,0 +1,459 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from history import ConversationHistory
+from tool_executor import run_in_pool
+
+logger = logging.getLogger(__name__)
+
+# Records larger than this are zlib-compressed before being stored
+COMPRESS_THRESHOLD = 512
+
+# Histories kept decoded in this process; others are reloaded on their next turn
+MAX_LOCAL_SESSIONS = 1000
+
+# The writer waits this long for more writes to join a batch
+FLUSH_INTERVAL = 0.02
+MAX_BATCH = 256
+
+# Sessions idle for longer than this are deleted by the SQLite sweeper
+SESSION_TTL = 7 * 24 * 60 * 60
+
+_RAW = b"\x00"
+_ZLIB = b"\x01"
+
+# One appended message: (session_id, seq, record)
+Row = Tuple[str, int, bytes]
+
+# The chat session the current turn belongs to, for tools that act on its behalf
+CURRENT_SESSION: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_session", default=None)
+# The store CURRENT_SESSION lives in
+CURRENT_STORE: contextvars.ContextVar[Optional["SessionStore"]] = contextvars.ContextVar("current_store", default=None)
+
+
+def encode(value: Any) -> bytes:
+    """Compact JSON with a one-byte header, zlib-compressed when large."""
+    data = json.dumps(value, separators=(",", ":"), default=str).encode("utf-8")
+    if len(data) > COMPRESS_THRESHOLD:
+        return _ZLIB + zlib.compress(data, 6)
+    return _RAW + data
+
+
+def decode(blob: bytes) -> Any:
+    header, data = blob[:1], blob[1:]
+    if header == _ZLIB:
+        data = zlib.decompress(data)
+    return json.loads(data)
+
+
+class SessionBackend:
+    """
+    Storage for chat sessions, shared by every worker that can serve them.
+
+    A session is an append-only list of message records, numbered from 0,
+    plus named values (the history's state(), a pending purchase, ...).
+    """
+
+    def append(self, rows: List[Row]) -> None:
+        """Store message records, possibly for several sessions at once."""
+        raise NotImplementedError
+
+    def load(self, session_id: str, start: int = 0) -> List[bytes]:
+        """Records from seq start on, in order."""
+        raise NotImplementedError
+
+    def length(self, session_id: str) -> int:
+        """Number of records stored for a session."""
+        raise NotImplementedError
+
+    def get_value(self, session_id: str, name: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set_values(self, values: List[Tuple[str, str, Optional[bytes]]]) -> None:
+        """Store (session_id, name, value) triples; a None value deletes the name."""
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemorySessionBackend(SessionBackend):
+    """Sessions in this process only, for a single worker and for local runs."""
+
+    def __init__(self):
+        self._records: Dict[str, List[bytes]] = {}
+        self._values: Dict[Tuple[str, str], bytes] = {}
+        self._lock = threading.Lock()
+
+    def append(self, rows: List[Row]) -> None:
+        with self._lock:
+            for session_id, seq, record in rows:
+                records = self._records.setdefault(session_id, [])
+                if seq == len(records):
+                    records.append(record)
+                elif seq < len(records):
+                    records[seq] = record
+                else:
+                    raise ValueError(f"Gap in session {session_id}: got seq {seq}, have {len(records)}")
+
+    def load(self, session_id: str, start: int = 0) -> List[bytes]:
+        with self._lock:
+            return list(self._records.get(session_id, [])[start:])
+
+    def length(self, session_id: str) -> int:
+        with self._lock:
+            return len(self._records.get(session_id, []))
+
+    def get_value(self, session_id: str, name: str) -> Optional[bytes]:
+        with self._lock:
+            return self._values.get((session_id, name))
+
+    def set_values(self, values: List[Tuple[str, str, Optional[bytes]]]) -> None:
+        with self._lock:
+            for session_id, name, value in values:
+                if value is None:
+                    self._values.pop((session_id, name), None)
+                else:
+                    self._values[(session_id, name)] = value
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._records.pop(session_id, None)
+            for key in [key for key in self._values if key[0] == session_id]:
+                del self._values[key]
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    Sessions in a SQLite database, shared by every worker process on a host.
+
+    WAL mode, one connection per thread, like SQLiteCacheBackend. Sessions
+    survive restarts; a background thread deletes sessions idle for longer
+    than max_idle seconds.
+
+    Args:
+        path: Database file path; its directory is created if missing
+        max_idle: Seconds of inactivity before a session is deleted, or None to keep them
+        sweep_interval: Seconds between idle-session sweeps
+    """
+
+    def __init__(self, path: str, max_idle: Optional[float] = SESSION_TTL, sweep_interval: float = 3600.0):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._closed = threading.Event()
+
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_messages ("
+            " session_id TEXT NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " record BLOB NOT NULL,"
+            " PRIMARY KEY (session_id, seq)"
+            ") WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_values ("
+            " session_id TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " value BLOB NOT NULL,"
+            " PRIMARY KEY (session_id, name)"
+            ") WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY,"
+            " updated_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at)")
+        conn.commit()
+
+        if max_idle:
+            sweeper = threading.Thread(
+                target=self._sweep_loop, args=(max_idle, sweep_interval),
+                name="session-sweep", daemon=True,
+            )
+            sweeper.start()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _touch(self, conn: sqlite3.Connection, session_ids) -> None:
+        now = time.time()
+        conn.executemany(
+            "INSERT OR REPLACE INTO sessions (session_id, updated_at) VALUES (?, ?)",
+            [(session_id, now) for session_id in set(session_ids)],
+        )
+
+    def append(self, rows: List[Row]) -> None:
+        conn = self._connection()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO session_messages (session_id, seq, record) VALUES (?, ?, ?)", rows)
+            self._touch(conn, (session_id for session_id, _, _ in rows))
+
+    def load(self, session_id: str, start: int = 0) -> List[bytes]:
+        rows = self._connection().execute(
+            "SELECT record FROM session_messages WHERE session_id = ? AND seq >= ? ORDER BY seq",
+            (session_id, start),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def length(self, session_id: str) -> int:
+        row = self._connection().execute(
+            "SELECT MAX(seq) FROM session_messages WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def get_value(self, session_id: str, name: str) -> Optional[bytes]:
+        row = self._connection().execute(
+            "SELECT value FROM session_values WHERE session_id = ? AND name = ?", (session_id, name)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_values(self, values: List[Tuple[str, str, Optional[bytes]]]) -> None:
+        conn = self._connection()
+        with conn:
+            for session_id, name, value in values:
+                if value is None:
+                    conn.execute("DELETE FROM session_values WHERE session_id = ? AND name = ?", (session_id, name))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO session_values (session_id, name, value) VALUES (?, ?, ?)",
+                        (session_id, name, value),
+                    )
+            self._touch(conn, (session_id for session_id, _, _ in values))
+
+    def delete(self, session_id: str) -> None:
+        conn = self._connection()
+        with conn:
+            for table in ("session_messages", "session_values", "sessions"):
+                conn.execute(f"DELETE FROM {table} WHERE session_id = ?", (session_id,))
+
+    def sweep(self, max_idle: float) -> int:
+        """Delete sessions idle for longer than max_idle seconds and return how many were removed."""
+        conn = self._connection()
+        idle = [row[0] for row in conn.execute(
+            "SELECT session_id FROM sessions WHERE updated_at <= ?", (time.time() - max_idle,)
+        ).fetchall()]
+        for session_id in idle:
+            self.delete(session_id)
+        return len(idle)
+
+    def _sweep_loop(self, max_idle: float, interval: float) -> None:
+        while not self._closed.wait(interval):
+            try:
+                removed = self.sweep(max_idle)
+                if removed:
+                    logger.debug("Session sweep removed %d idle sessions", removed)
+            except sqlite3.Error as e:
+                logger.warning("Session sweep failed: %s", e)
+
+    def close(self) -> None:
+        self._closed.set()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class _Write:
+    def __init__(self, rows: List[Row], values: List[Tuple[str, str, Optional[bytes]]]):
+        self.rows = rows
+        self.values = values
+        self.done: Future = Future()
+
+
+class SessionStore:
+    """
+    Chat sessions read and written through a SessionBackend.
+
+    Histories stay decoded in a local LRU. A turn only loads the records
+    another worker added since this one last saw the session, and only the
+    messages added since the last save are encoded and written. Writes go
+    to a background thread that batches them across sessions into one
+    backend transaction; save() resolves once its batch is stored.
+
+    Args:
+        backend: Where sessions live
+        max_local: Histories kept decoded in this process
+    """
+
+    def __init__(self, backend: SessionBackend, max_local: int = MAX_LOCAL_SESSIONS):
+        self.backend = backend
+        self.max_local = max_local
+        self._local: "OrderedDict[str, ConversationHistory]" = OrderedDict()
+        # session_id -> (messages stored, state_version stored)
+        self._saved: Dict[str, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[_Write]" = queue.Queue()
+        self.batches = 0
+        self.writes = 0
+        self._writer = threading.Thread(target=self._write_loop, name="session-writer", daemon=True)
+        self._writer.start()
+
+    async def load(self, session_id: str, create: Callable[[], ConversationHistory]) -> ConversationHistory:
+        """
+        The session's history, brought up to date with the backend.
+
+        Args:
+            session_id: Chat session ID
+            create: Builds an empty history for a session the backend has never seen
+        """
+        return await run_in_pool(self._load, session_id, create)
+
+    def _load(self, session_id: str, create: Callable[[], ConversationHistory]) -> ConversationHistory:
+        with self._lock:
+            history = self._local.get(session_id)
+            if history is not None:
+                self._local.move_to_end(session_id)
+        stored = self.backend.length(session_id)
+        if history is not None and stored == len(history.messages):
+            return history
+
+        if history is None or stored < len(history.messages):
+            history = create()
+        records = self.backend.load(session_id, len(history.messages))
+        for record in records:
+            message, kind, tokens = decode(record)
+            history.append(message, kind, tokens)
+        state = self.backend.get_value(session_id, "history_state")
+        if state is not None:
+            history.restore_state(decode(state))
+        self._remember(session_id, history)
+        return history
+
+    def _remember(self, session_id: str, history: ConversationHistory) -> None:
+        with self._lock:
+            self._local[session_id] = history
+            self._local.move_to_end(session_id)
+            self._saved[session_id] = (len(history.messages), history.state_version)
+            while len(self._local) > self.max_local:
+                evicted, _ = self._local.popitem(last=False)
+                self._saved.pop(evicted, None)
+
+    async def save(self, session_id: str, history: ConversationHistory) -> None:
+        """Store the messages added since the last save, and the history's state if it changed."""
+        with self._lock:
+            stored, stored_version = self._saved.get(session_id, (0, -1))
+        rows = [
+            (session_id, seq, encode([history.messages[seq], history.kinds[seq], history.token_counts[seq]]))
+            for seq in range(stored, len(history.messages))
+        ]
+        values = []
+        if history.state_version != stored_version:
+            values.append((session_id, "history_state", encode(history.state())))
+        if rows or values:
+            await self._submit(rows, values)
+        self._remember(session_id, history)
+
+    async def get_value(self, session_id: str, name: str, default: Any = None) -> Any:
+        value = await run_in_pool(self.backend.get_value, session_id, name)
+        return default if value is None else decode(value)
+
+    async def set_value(self, session_id: str, name: str, value: Any) -> None:
+        """Store a JSON-serializable session value; None removes it."""
+        await self._submit([], [(session_id, name, None if value is None else encode(value))])
+
+    async def _submit(self, rows: List[Row], values: List[Tuple[str, str, Optional[bytes]]]) -> None:
+        write = _Write(rows, values)
+        self._queue.put(write)
+        await asyncio.wrap_future(write.done)
+
+    def _write_loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < MAX_BATCH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                rows = [row for write in batch for row in write.rows]
+                values = [value for write in batch for value in write.values]
+                if rows:
+                    self.backend.append(rows)
+                if values:
+                    self.backend.set_values(values)
+            except Exception as e:
+                logger.warning("Session write of %d records failed: %s", len(batch), e)
+                for write in batch:
+                    write.done.set_exception(e)
+                continue
+            self.batches += 1
+            self.writes += len(batch)
+            for write in batch:
+                write.done.set_result(None)
+
+    def forget(self, session_id: str) -> None:
+        """Drop the local copy, so the next load reads the backend."""
+        with self._lock:
+            self._local.pop(session_id, None)
+            self._saved.pop(session_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "local_sessions": len(self._local),
+            "batches": self.batches,
+            "writes": self.writes,
+            "writes_per_batch": self.writes / self.batches if self.batches else 0.0,
+            "pending": self._queue.qsize(),
+        }
+
+
+def session_store_from_env() -> SessionStore:
+    """
+    A SessionStore on the SQLite database at SESSION_DB.
+
+    Defaults to .cache/sessions.sqlite3. Set SESSION_DB to an empty string to
+    keep sessions in this process only.
+    """
+    path = os.getenv("SESSION_DB", ".cache/sessions.sqlite3")
+    backend: SessionBackend = MemorySessionBackend()
+    if path:
+        try:
+            backend = SQLiteSessionBackend(path)
+        except Exception as e:
+            logger.warning("Session database unavailable, keeping sessions in memory: %s", e)
+    return SessionStore(backend)
+
+
+async def get_session_value(name: str, default: Any = None) -> Any:
+    """A value of the current session (CURRENT_SESSION), or default outside one."""
+    session_id, store = CURRENT_SESSION.get(), CURRENT_STORE.get()
+    if session_id is None or store is None:
+        return default
+    return await store.get_value(session_id, name, default)
+
+
+async def set_session_value(name: str, value: Any) -> None:
+    """Store a value of the current session (CURRENT_SESSION); a no-op outside one."""
+    session_id, store = CURRENT_SESSION.get(), CURRENT_STORE.get()
+    if session_id is not None and store is not None:
+        await store.set_value(session_id, name, value)
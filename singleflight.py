@@ -0,0 +1,84 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one execution.
+
+    The first caller for a key runs the function. Callers that arrive while it
+    is running wait for that run and share its result, or its exception.
+    Threads and asyncio tasks can wait on the same flight, because both are
+    backed by a concurrent.futures.Future.
+
+    Example:
+        >>> flights = SingleFlight()
+        >>> flights.do("now_playing", lambda: "fetched once")
+        'fetched once'
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[str, Future] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    def in_flight(self, key: str) -> bool:
+        with self._lock:
+            return key in self._flights
+
+    def _join(self, key: str) -> tuple[Future, bool]:
+        """Return the flight for key and whether the caller leads it."""
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = Future()
+            self._flights[key] = future
+            self.executions += 1
+            return future, True
+
+    def _land(self, key: str, future: Future) -> None:
+        with self._lock:
+            if self._flights.get(key) is future:
+                del self._flights[key]
+
+    def do(self, key: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run func once for all concurrent callers with this key (blocking)."""
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._land(key, future)
+
+    async def do_async(self, key: str, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Run the coroutine function once for all concurrent callers with this key."""
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._land(key, future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            in_flight = len(self._flights)
+        return {"executions": self.executions, "coalesced": self.coalesced, "in_flight": in_flight}
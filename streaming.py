@@ -0,0 +1,172 @@
+import time
+from typing import Callable, Dict, List, Optional
+
+from metrics import record_usage
+
+THOUGHT_OPEN = "<thought_process>"
+THOUGHT_CLOSE = "</thought_process>"
+
+
+def _partial_tag_length(text: str, tag: str) -> int:
+    """Length of the longest suffix of text that could be the start of tag."""
+    for size in range(min(len(text), len(tag) - 1), 0, -1):
+        if tag.startswith(text[-size:]):
+            return size
+    return 0
+
+
+class ThoughtProcessFilter:
+    """
+    Incrementally hides <thought_process>...</thought_process> blocks from streamed text.
+
+    Chunks may split a tag anywhere, so a possible partial tag at the end of a
+    chunk is held back until the next chunk shows whether it is a tag.
+
+    Example:
+        >>> f = ThoughtProcessFilter()
+        >>> f.feed("<thought_pr") + f.feed("ocess>hmm</thought_") + f.feed("process>Hi") + f.flush()
+        'Hi'
+    """
+
+    def __init__(self):
+        self.is_suppressing = False
+        self._pending = ""
+        self._strip_leading = False
+
+    def feed(self, text: str) -> str:
+        """Add a chunk of model output and return the part that is safe to show."""
+        buffer = self._pending + text
+        visible = []
+
+        while buffer:
+            if self.is_suppressing:
+                end = buffer.find(THOUGHT_CLOSE)
+                if end == -1:
+                    keep = _partial_tag_length(buffer, THOUGHT_CLOSE)
+                    buffer = buffer[len(buffer) - keep:] if keep else ""
+                    break
+                buffer = buffer[end + len(THOUGHT_CLOSE):]
+                self.is_suppressing = False
+                self._strip_leading = True
+            else:
+                if self._strip_leading:
+                    buffer = buffer.lstrip()
+                    if not buffer:
+                        break
+                    self._strip_leading = False
+                start = buffer.find(THOUGHT_OPEN)
+                if start == -1:
+                    keep = _partial_tag_length(buffer, THOUGHT_OPEN)
+                    visible.append(buffer[:len(buffer) - keep])
+                    buffer = buffer[len(buffer) - keep:]
+                    break
+                visible.append(buffer[:start])
+                buffer = buffer[start + len(THOUGHT_OPEN):]
+                self.is_suppressing = True
+
+        self._pending = buffer
+        return "".join(visible)
+
+    def flush(self) -> str:
+        """Return any held-back text once the stream has ended."""
+        pending, self._pending = self._pending, ""
+        return "" if self.is_suppressing else pending
+
+
+class ToolCallAccumulator:
+    """Reassembles streamed tool-call deltas into complete tool calls."""
+
+    def __init__(self):
+        self._calls: Dict[int, dict] = {}
+
+    def add(self, deltas) -> None:
+        for delta in deltas:
+            index = getattr(delta, "index", None)
+            if index is None:
+                index = len(self._calls)
+            call = self._calls.setdefault(index, {
+                "id": None,
+                "type": "function",
+                "function": {"name": "", "arguments": ""},
+            })
+            if getattr(delta, "id", None):
+                call["id"] = delta.id
+            function = getattr(delta, "function", None)
+            if function is not None:
+                if getattr(function, "name", None):
+                    call["function"]["name"] += function.name
+                if getattr(function, "arguments", None):
+                    call["function"]["arguments"] += function.arguments
+
+    def tool_calls(self) -> List[dict]:
+        """Completed tool calls in the order the model emitted them."""
+        return [self._calls[index] for index in sorted(self._calls)]
+
+
+class VisibleOutput:
+    """
+    The user-visible side of one turn.
+
+    Raw model text is passed through a ThoughtProcessFilter before being sent
+    to on_token. The filter is shared by every completion in the turn, and
+    the time to the first visible token is recorded.
+    """
+
+    def __init__(self, on_token: Callable, turn_started: Optional[float] = None):
+        self.on_token = on_token
+        self.turn_started = turn_started if turn_started is not None else time.perf_counter()
+        self.thought_filter = ThoughtProcessFilter()
+        self.first_token_latency: Optional[float] = None
+        self._visible: List[str] = []
+
+    @property
+    def text(self) -> str:
+        """Everything sent to on_token so far."""
+        return "".join(self._visible)
+
+    async def write(self, text: str) -> None:
+        await self._emit(self.thought_filter.feed(text))
+
+    async def close(self) -> None:
+        await self._emit(self.thought_filter.flush())
+
+    async def _emit(self, visible: str) -> None:
+        if not visible:
+            return
+        if self.first_token_latency is None:
+            self.first_token_latency = time.perf_counter() - self.turn_started
+        self._visible.append(visible)
+        await self.on_token(visible)
+
+
+async def stream_completion(stream, output: VisibleOutput) -> tuple[str, List[dict]]:
+    """
+    Consume a streamed litellm completion.
+
+    Text is forwarded to output as it arrives. Tool-call deltas are collected
+    and returned once the stream ends.
+
+    Args:
+        stream: Async iterator of completion chunks (litellm stream=True)
+        output: Where visible text for this turn is written
+
+    Returns:
+        Tuple of (raw content, tool calls)
+    """
+    accumulator = ToolCallAccumulator()
+    content = []
+
+    async for chunk in stream:
+        # Sent on the last chunk when the provider reports streamed usage
+        record_usage(getattr(chunk, "model", None), getattr(chunk, "usage", None))
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if getattr(delta, "tool_calls", None):
+            accumulator.add(delta.tool_calls)
+        text = getattr(delta, "content", None)
+        if text:
+            content.append(text)
+            await output.write(text)
+
+    return "".join(content), accumulator.tool_calls()
@@ -0,0 +1,90 @@
+import json
+
+import history
+from history import KIND_TURN_CONTEXT, ConversationHistory
+
+BUDGET = 2000
+
+
+def _serialize(messages):
+    # The bytes a provider's prompt cache sees, message by message
+    return "".join(json.dumps(message, sort_keys=True) for message in messages).encode()
+
+
+def _play(conversation, turns, tool_chars, budget=BUDGET):
+    """
+    Play turns the way app.run_turn does and collect every prompt sent.
+
+    Returns:
+        (prompt bytes, whether compact() ran for it) per main completion
+    """
+    prompts = []
+
+    def complete():
+        version = conversation.state_version
+        prompt = _serialize(conversation.view(budget))
+        prompts.append((prompt, conversation.state_version != version))
+
+    for turn in range(turns):
+        conversation.append({"role": "user", "content": f"Today is day {turn}."}, kind=KIND_TURN_CONTEXT)
+        conversation.append({"role": "user", "content": f"What is playing, take {turn}?"})
+        complete()
+        call = {"id": f"call_{turn}", "type": "function",
+                "function": {"name": "get_now_playing", "arguments": "{}"}}
+        conversation.append({"role": "assistant", "content": None, "tool_calls": [call]})
+        conversation.append({"role": "tool", "tool_call_id": call["id"], "name": "get_now_playing",
+                             "content": f"result {turn} " + "x" * tool_chars})
+        complete()
+        conversation.append({"role": "assistant", "content": f"Here is what is playing, take {turn}."})
+    return prompts
+
+
+def _compactions(prompts):
+    compacted_at = []
+    for i, ((previous, _), (prompt, compacted)) in enumerate(zip(prompts, prompts[1:]), 1):
+        if compacted:
+            compacted_at.append(i)
+        else:
+            assert prompt.startswith(previous), f"prompt {i} rewrote the prefix of prompt {i - 1}"
+    return compacted_at
+
+
+def _compacted_turns(prompts):
+    # _play makes two completions per turn
+    return [i // 2 for i in _compactions(prompts)]
+
+
+def test_prompts_extend_each_other_between_compactions():
+    prompts = _play(ConversationHistory("You are a movie assistant."), turns=30, tool_chars=1000)
+
+    turns = _compacted_turns(prompts)
+    assert turns
+    assert all(b - a >= history.MIN_TURNS_BETWEEN_COMPACTIONS for a, b in zip(turns, turns[1:]))
+
+
+def test_history_within_budget_is_never_compacted():
+    prompts = _play(ConversationHistory("You are a movie assistant."), turns=10, tool_chars=1000,
+                    budget=100_000)
+
+    assert _compactions(prompts) == []
+
+
+def test_oversized_recent_turns_do_not_compact_every_turn():
+    # Each turn is about half the budget, so the recent turns alone don't fit
+    # and every turn outgrows the budget again
+    prompts = _play(ConversationHistory("You are a movie assistant."), turns=20, tool_chars=BUDGET * 2)
+
+    turns = _compacted_turns(prompts)
+    assert turns
+    # Only when MAX_OVERFLOW forces it
+    assert all(b - a >= 2 for a, b in zip(turns, turns[1:]))
+
+
+def test_view_stays_within_overflow_limit():
+    conversation = ConversationHistory("You are a movie assistant.")
+    tool_chars = BUDGET * 2
+    for turn in range(1, 21):
+        _play(conversation, turns=1, tool_chars=tool_chars)
+        tokens = sum(history.count_tokens(message) for message in conversation.view(BUDGET))
+        # Plus at most the turn that pushed it over
+        assert tokens <= BUDGET * history.MAX_OVERFLOW + tool_chars // 2
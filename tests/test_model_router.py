@@ -0,0 +1,253 @@
+import asyncio
+
+import pytest
+
+import model_router
+from history import KIND_CONTEXT, KIND_TURN_CONTEXT, ConversationHistory
+from model_router import FAST, FULL, ModelRouter, Route
+from title_index import TitleIndex
+
+TIERS = {FAST: ["fast-a", "fast-b"], FULL: ["full-a", "full-b"]}
+
+
+class FakeStream:
+    """A completion stream yielding chunks after first_delay seconds."""
+
+    def __init__(self, chunks, first_delay=0.0):
+        self.chunks = list(chunks)
+        self.first_delay = first_delay
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.first_delay:
+            await asyncio.sleep(self.first_delay)
+            self.first_delay = 0.0
+        if not self.chunks:
+            raise StopAsyncIteration
+        return self.chunks.pop(0)
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeStarts:
+    """
+    A start callable for ModelRouter.complete, scripted per call.
+
+    Each step is (open delay, stream or exception). Calls after the last
+    step repeat it.
+    """
+
+    def __init__(self, *steps):
+        self.steps = list(steps)
+        self.models = []
+        self.streams = []
+
+    async def __call__(self, model):
+        delay, outcome = self.steps[min(len(self.models), len(self.steps) - 1)]
+        self.models.append(model)
+        await asyncio.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        self.streams.append(outcome)
+        return outcome
+
+
+@pytest.fixture(autouse=True)
+def short_hedge_delay(monkeypatch):
+    monkeypatch.setattr(model_router, "MIN_HEDGE_DELAY", 0.01)
+    monkeypatch.setattr(model_router, "MAX_HEDGE_DELAY", 0.05)
+
+
+def _router(**kwargs):
+    return ModelRouter(TIERS, index=TitleIndex(), **kwargs)
+
+
+async def _collect(stream):
+    return [chunk async for chunk in stream]
+
+
+def _history(*messages):
+    conversation = ConversationHistory("You are a movie assistant.")
+    for message, kind in messages:
+        conversation.append(message, kind=kind)
+    return conversation
+
+
+def _turn(text):
+    return _history(({"role": "user", "content": "Today is Friday."}, KIND_TURN_CONTEXT),
+                    ({"role": "user", "content": text}, None))
+
+
+def test_fast_primary_is_not_hedged():
+    router = _router()
+    start = FakeStarts((0.0, FakeStream(["Hi", "!"])))
+
+    stream = asyncio.run(router.complete(Route(FULL, "full-a", "full-b", "test"), start))
+
+    assert asyncio.run(_collect(stream)) == ["Hi", "!"]
+    assert start.models == ["full-a"]
+    assert router.hedged == 0
+
+
+def test_slow_primary_is_hedged_and_loser_closed():
+    router = _router()
+    slow, fast = FakeStream(["slow"], first_delay=1.0), FakeStream(["fast"])
+    start = FakeStarts((0.0, slow), (0.0, fast))
+
+    async def run():
+        stream = await router.complete(Route(FULL, "full-a", "full-b", "test"), start)
+        chunks = await _collect(stream)
+        # Let the cancelled primary's close run
+        await asyncio.sleep(0.01)
+        return stream, chunks
+
+    stream, chunks = asyncio.run(run())
+
+    assert start.models == ["full-a", "full-b"]
+    assert (stream.model, chunks) == ("full-b", ["fast"])
+    assert slow.closed and not fast.closed
+    assert (router.hedged, router.hedge_wins) == (1, 1)
+
+
+def test_primary_winning_after_hedge_closes_hedge():
+    router = _router()
+    primary, hedge = FakeStream(["primary"], first_delay=0.07), FakeStream(["hedge"], first_delay=1.0)
+    start = FakeStarts((0.0, primary), (0.0, hedge))
+
+    async def run():
+        stream = await router.complete(Route(FULL, "full-a", "full-b", "test"), start)
+        await asyncio.sleep(0.01)
+        return stream
+
+    stream = asyncio.run(run())
+
+    assert stream.model == "full-a"
+    assert hedge.closed and not primary.closed
+    assert (router.hedged, router.hedge_wins) == (1, 0)
+
+
+def test_primary_failing_fast_is_hedged_without_waiting():
+    router = _router()
+    start = FakeStarts((0.0, RuntimeError("overloaded")), (0.0, FakeStream(["ok"])))
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        stream = await router.complete(Route(FULL, "full-a", "full-b", "test"), start)
+        return stream, loop.time() - started
+
+    stream, elapsed = asyncio.run(run())
+
+    assert stream.model == "full-b"
+    assert elapsed < model_router.MAX_HEDGE_DELAY
+
+
+def test_primary_error_raised_when_hedge_fails_too():
+    router = _router()
+    start = FakeStarts((0.0, RuntimeError("primary down")), (0.0, ValueError("hedge down")))
+
+    with pytest.raises(RuntimeError, match="primary down"):
+        asyncio.run(router.complete(Route(FULL, "full-a", "full-b", "test"), start))
+
+
+def test_primary_error_raised_when_not_hedging():
+    router = _router(hedging=False)
+    start = FakeStarts((0.0, RuntimeError("primary down")))
+
+    route = router.route(_turn("hello there"))
+    with pytest.raises(RuntimeError, match="primary down"):
+        asyncio.run(router.complete(route, start))
+    assert len(start.models) == 1
+
+
+def test_empty_stream_wins_and_yields_nothing():
+    router = _router()
+    start = FakeStarts((0.0, FakeStream([])))
+
+    async def run():
+        stream = await router.complete(Route(FULL, "full-a", "full-b", "test"), start)
+        return await _collect(stream)
+
+    assert asyncio.run(run()) == []
+    assert router.hedged == 0
+
+
+def test_hedges_stay_within_budget():
+    router = _router()
+    start = FakeStarts()
+    route = Route(FULL, "full-a", "full-b", "test")
+
+    async def run():
+        # Every primary is slower than the hedge delay
+        for _ in range(30):
+            start.models = []
+            start.steps = [(0.0, FakeStream(["late"], first_delay=0.06)), (0.0, FakeStream(["hedge"]))]
+            await router.complete(route, start)
+
+    asyncio.run(run())
+
+    assert router.completions == 30
+    assert model_router.HEDGE_ALLOWANCE <= router.hedged < router.completions
+    assert router.hedged <= model_router.HEDGE_ALLOWANCE + model_router.HEDGE_BUDGET * router.completions
+
+
+@pytest.mark.parametrize("text, tier, reason", [
+    ("hello, how are you?", FAST, "small_talk"),
+    ("what movies are playing tonight?", FULL, "movie_question"),
+    ("is it any good?", FULL, "movie_question"),
+    ("tell me a story " * 20, FULL, "long_message"),
+])
+def test_classify_by_user_message(text, tier, reason):
+    assert _router().classify(_turn(text)) == (tier, reason)
+
+
+def test_classify_known_title():
+    index = TitleIndex()
+    index.add("Oppenheimer", 872585)
+    router = ModelRouter(TIERS, index=index)
+
+    assert router.classify(_turn("Oppenheimer")) == (FULL, "title")
+
+
+def test_classify_tool_results_and_reviews():
+    conversation = _turn("hello")
+    conversation.append({"role": "assistant", "content": None, "tool_calls": []})
+    conversation.append({"role": "tool", "tool_call_id": "call_1", "content": "[]"})
+    assert _router().classify(conversation) == (FULL, "tool_results")
+
+    conversation = _turn("hello")
+    conversation.append({"role": "user", "content": "Reviews of Dune: ..."}, kind=KIND_CONTEXT)
+    assert _router().classify(conversation) == (FULL, "reviews")
+
+
+def test_classify_long_history():
+    conversation = _turn("hello")
+    # Token counts vary by tokenizer, so the long answer states its own
+    conversation.append({"role": "assistant", "content": "A long answer."},
+                        tokens=model_router.FAST_MAX_HISTORY_TOKENS + 1)
+    conversation.append({"role": "user", "content": "thanks"})
+    assert _router().classify(conversation) == (FULL, "long_history")
+
+
+def test_route_prefers_faster_model_once_measured():
+    router = _router()
+    for _ in range(model_router.MIN_LATENCY_SAMPLES):
+        router.latency.record("full-a", 2.0)
+        router.latency.record("full-b", 0.5)
+
+    route = router.route(_turn("what is playing?"))
+
+    assert (route.tier, route.model, route.hedge_model) == (FULL, "full-b", "full-a")
+
+
+def test_route_hedges_single_model_tier_with_itself():
+    router = ModelRouter({FULL: ["only"]}, index=TitleIndex())
+
+    route = router.route(_turn("hello"))
+
+    # No FAST tier configured
+    assert (route.tier, route.model, route.hedge_model) == (FULL, "only", "only")
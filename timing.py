@@ -0,0 +1,56 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from metrics import STAGE_SECONDS
+
+
+class TurnTimings:
+    """
+    Wall-clock seconds spent in each stage of one chat turn.
+
+    Stages are named e.g. "gate", "first_completion", "tool:get_showtimes",
+    "followup_completion". A stage entered more than once in a turn (two
+    calls to the same tool, or several rounds of tool calls) keeps every
+    duration.
+
+    Example:
+        >>> timings = TurnTimings()
+        >>> with timings.stage("gate"):
+        ...     pass
+        >>> list(timings.as_dict())
+        ['gate']
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, List[float]] = {}
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.stages.setdefault(stage, []).append(seconds)
+
+    @contextmanager
+    def stage(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def as_dict(self) -> Dict[str, List[float]]:
+        return {stage: list(durations) for stage, durations in self.stages.items()}
+
+
+@contextmanager
+def timed(timings: Optional[TurnTimings], stage: str):
+    """
+    Time a stage into the movie_stage_seconds histogram, and into timings
+    when the caller is collecting them.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        if timings is not None:
+            timings.record(stage, seconds)
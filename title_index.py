@@ -0,0 +1,217 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+from cache_keys import normalize_title
+
+# Minimum trigram similarity (Dice coefficient, 0-1) for a fuzzy match
+FUZZY_THRESHOLD = 0.8
+
+# Titles kept in the index; least recently used titles are dropped first
+MAX_TITLES = 5000
+
+
+# Sequel numbers are spelled many ways; compare them as digits
+_NUMERALS = {
+    "two": "2", "three": "3", "four": "4", "five": "5",
+    "ii": "2", "iii": "3", "iv": "4", "v": "5", "vi": "6", "vii": "7",
+}
+
+
+def fuzzy_key(normalized: str) -> str:
+    """
+    Normalized title with sequel numbers as digits and no leading article.
+
+    Example:
+        >>> fuzzy_key("dune part two") == fuzzy_key("dune part 2")
+        True
+    """
+    words = normalized.split()
+    if len(words) > 1 and words[0] in ("the", "a", "an"):
+        words = words[1:]
+    return " ".join(_NUMERALS.get(word, word) for word in words)
+
+
+def _numbers(key: str) -> frozenset:
+    return frozenset(word for word in key.split() if word.isdigit())
+
+
+def trigrams(text: str) -> Set[str]:
+    """
+    Character trigrams of a normalized title, padded so short words still count.
+
+    Example:
+        >>> sorted(trigrams("up"))
+        ['  u', ' up', 'up ']
+    """
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class TitleMatch:
+    __slots__ = ("movie_id", "title", "score", "method")
+
+    def __init__(self, movie_id: int, title: str, score: float, method: str):
+        self.movie_id = movie_id
+        self.title = title
+        self.score = score
+        self.method = method
+
+    def __repr__(self):
+        return f"TitleMatch({self.movie_id}, {self.title!r}, {self.score:.2f}, {self.method})"
+
+
+class TitleIndex:
+    """
+    Maps movie titles to TMDb IDs without a search request.
+
+    Fed from now-playing results and from earlier searches. Lookups try an
+    exact match, then the normalized title, then trigram similarity against
+    every indexed title that shares a trigram with the query. A fuzzy match
+    must contain the same numbers, so "Gladiator" never resolves to
+    "Gladiator II".
+
+    Example:
+        >>> index = TitleIndex()
+        >>> index.add("Dune: Part Two", 693134)
+        >>> index.lookup("dune part 2").movie_id
+        693134
+    """
+
+    def __init__(self, threshold: float = FUZZY_THRESHOLD, max_titles: int = MAX_TITLES):
+        self.threshold = threshold
+        self.max_titles = max_titles
+        self._exact: Dict[str, str] = {}
+        # normalized title -> (movie_id, display title)
+        self._titles: "OrderedDict[str, tuple]" = OrderedDict()
+        self._grams: Dict[str, Set[str]] = {}
+        self._postings: Dict[str, Set[str]] = {}
+        # First word of each title's fuzzy key -> titles, for finding titles in free text
+        self._words: Dict[str, tuple] = {}
+        self._first_words: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._titles)
+
+    def add(self, title: str, movie_id: int) -> None:
+        if not title or movie_id is None:
+            return
+        key = normalize_title(title)
+        if not key:
+            return
+        with self._lock:
+            self._exact[title] = key
+            if key in self._titles:
+                self._titles[key] = (movie_id, self._titles[key][1])
+                self._titles.move_to_end(key)
+                return
+            self._titles[key] = (movie_id, title)
+            grams = trigrams(fuzzy_key(key))
+            self._grams[key] = grams
+            for gram in grams:
+                self._postings.setdefault(gram, set()).add(key)
+            words = tuple(fuzzy_key(key).split())
+            if words:
+                self._words[key] = words
+                self._first_words.setdefault(words[0], set()).add(key)
+            while len(self._titles) > self.max_titles:
+                self._drop(next(iter(self._titles)))
+            if len(self._exact) > 2 * self.max_titles:
+                # Forget spellings whose titles were dropped
+                self._exact = {t: k for t, k in self._exact.items() if k in self._titles}
+
+    def _drop(self, key: str) -> None:
+        del self._titles[key]
+        for gram in self._grams.pop(key, ()):
+            keys = self._postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[gram]
+        words = self._words.pop(key, None)
+        if words:
+            keys = self._first_words.get(words[0])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._first_words[words[0]]
+
+    def lookup(self, title: str, threshold: Optional[float] = None) -> Optional[TitleMatch]:
+        """Best match for title, or None if nothing reaches the threshold."""
+        if not title:
+            return None
+        threshold = self.threshold if threshold is None else threshold
+        with self._lock:
+            key = self._exact.get(title)
+            method = "exact"
+            if key is None or key not in self._titles:
+                key = normalize_title(title)
+                method = "normalized"
+            entry = self._titles.get(key)
+            if entry is not None:
+                self._titles.move_to_end(key)
+                return TitleMatch(entry[0], entry[1], 1.0, method)
+
+            query_key = fuzzy_key(key)
+            query = trigrams(query_key)
+            numbers = _numbers(query_key)
+            candidates: Set[str] = set()
+            for gram in query:
+                candidates |= self._postings.get(gram, set())
+            best_key, best_score = None, 0.0
+            for candidate in candidates:
+                if _numbers(fuzzy_key(candidate)) != numbers:
+                    continue
+                score = similarity(query, self._grams[candidate])
+                if score > best_score:
+                    best_key, best_score = candidate, score
+            if best_key is None or best_score < threshold:
+                return None
+            movie_id, display = self._titles[best_key]
+            return TitleMatch(movie_id, display, best_score, "fuzzy")
+
+    def mentions(self, text: str) -> List[TitleMatch]:
+        """
+        Indexed titles that appear word for word in text, longest first.
+
+        Overlapping mentions keep only the longest, so "Dune: Part Two"
+        does not also count as "Dune". Single-word titles shorter than four
+        letters are ignored; "Up" or "Us" in a sentence is rarely the movie.
+
+        Example:
+            >>> index = TitleIndex()
+            >>> index.add("Dune: Part Two", 693134)
+            >>> [m.title for m in index.mentions("is dune part 2 any good?")]
+            ['Dune: Part Two']
+        """
+        words = fuzzy_key(normalize_title(text) or "").split()
+        found = []
+        with self._lock:
+            for start, word in enumerate(words):
+                for key in self._first_words.get(word, ()):
+                    title_words = self._words[key]
+                    if len(title_words) == 1 and len(title_words[0]) < 4:
+                        continue
+                    if tuple(words[start:start + len(title_words)]) == title_words:
+                        found.append((start, start + len(title_words), key))
+            found.sort(key=lambda match: match[0] - match[1])
+            taken: Set[int] = set()
+            matches = []
+            for start, end, key in found:
+                if taken.intersection(range(start, end)):
+                    continue
+                taken.update(range(start, end))
+                movie_id, display = self._titles[key]
+                matches.append(TitleMatch(movie_id, display, 1.0, "mention"))
+            return matches
+
+
+# Shared index used by movie_functions
+TITLE_INDEX = TitleIndex()
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import TOOL_ERRORS
+from timing import TurnTimings, timed
+from tool_registry import ToolRegistry, ToolSpec
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on tool calls running at once across every chat session in this
+# worker. The movie functions block on HTTP, so they run here instead of on the
+# event loop.
+MAX_TOOL_WORKERS = 16
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_TOOL_WORKERS, thread_name_prefix="tool")
+
+
+async def run_in_pool(func: Callable, *args, **kwargs) -> Any:
+    """
+    Run a blocking function on the shared tool thread pool.
+
+    It runs in a copy of the caller's context, so context variables such as
+    the current session and the upstream request priority carry over.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_EXECUTOR, partial(copy_context().run, func, *args, **kwargs))
+
+
+def _stringify(result: Any) -> str:
+    if isinstance(result, str):
+        return result
+    return json.dumps(result, default=str)
+
+
+async def _call(spec: ToolSpec, arguments: Dict[str, Any]) -> Any:
+    if spec.is_async:
+        return await spec.func(**arguments)
+    return await run_in_pool(spec.func, **arguments)
+
+
+async def run_tool_call(tool_call, registry: ToolRegistry, timings: Optional[TurnTimings] = None) -> dict:
+    """
+    Run a single tool call: on the shared thread pool, or on the event loop
+    for coroutine functions.
+
+    Arguments are checked against the tool's signature first, so a malformed
+    call is answered without touching the network. Errors, timeouts and
+    unknown tools are reported back to the model as the tool's content, so
+    every tool_call_id always gets a matching message. Idempotent tools are
+    retried once after an unexpected error, within the same timeout.
+
+    Args:
+        tool_call: A tool call dict from the assistant message
+        registry: The tools that can be called
+        timings: Collects the call's duration as stage "tool:<name>"
+
+    Returns:
+        A "tool" role message for the conversation history
+    """
+    function_name = tool_call["function"]["name"]
+    spec = registry.get(function_name)
+
+    if spec is None:
+        content = f"Error: unknown function '{function_name}'"
+        TOOL_ERRORS.inc(tool=function_name, reason="unknown")
+        logger.warning(content)
+    else:
+        try:
+            arguments = spec.validate(json.loads(tool_call["function"]["arguments"] or "{}"))
+        except ValueError as e:
+            # ToolArgumentError, or json.JSONDecodeError
+            arguments = None
+            content = f"Error: invalid arguments for {function_name}: {e}"
+            TOOL_ERRORS.inc(tool=function_name, reason="invalid_arguments")
+            logger.warning(content)
+        if arguments is not None:
+            content = await _run_validated(spec, arguments, timings)
+
+    return {
+        "role": "tool",
+        "name": function_name,
+        "content": content,
+        "tool_call_id": tool_call["id"],
+    }
+
+
+async def _run_validated(spec: ToolSpec, arguments: Dict[str, Any], timings: Optional[TurnTimings]) -> str:
+    logger.debug("Calling function '%s' with arguments: %s", spec.name, arguments)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + spec.timeout
+    attempts = 2 if spec.idempotent else 1
+    with timed(timings, f"tool:{spec.name}"):
+        for attempt in range(attempts):
+            try:
+                result = await asyncio.wait_for(_call(spec, arguments), timeout=max(0.0, deadline - loop.time()))
+                content = _stringify(result)
+                logger.debug("Function '%s' returned: %s", spec.name, content)
+                return content
+            except asyncio.TimeoutError:
+                # The worker thread keeps running until the upstream call
+                # returns; only the conversation stops waiting for it.
+                content = f"Error: {spec.name} timed out after {spec.timeout:g} seconds"
+                TOOL_ERRORS.inc(tool=spec.name, reason="timeout")
+                logger.warning(content)
+                return content
+            except Exception as e:
+                content = f"Error calling {spec.name}: {e}"
+                TOOL_ERRORS.inc(tool=spec.name, reason="error")
+                if attempt + 1 < attempts:
+                    logger.info("%s; retrying", content)
+                else:
+                    logger.warning(content)
+    return content
+
+
+def _call_key(tool_call) -> tuple:
+    return tool_call["function"]["name"], tool_call["function"]["arguments"] or "{}"
+
+
+async def execute_tool_calls(tool_calls, registry: ToolRegistry,
+                             timings: Optional[TurnTimings] = None) -> List[dict]:
+    """
+    Run all tool calls from one assistant turn.
+
+    Calls to parallel-safe tools run concurrently; identical calls to a
+    cacheable tool run once and share the result. Calls to other tools
+    (e.g. buy_ticket) then run one at a time, in the order the model made
+    them.
+
+    Returns:
+        Tool messages in the same order as tool_calls
+    """
+    results: List[Optional[dict]] = [None] * len(tool_calls)
+    concurrent: Dict[Any, List[int]] = {}
+    sequential: List[int] = []
+    for i, tool_call in enumerate(tool_calls):
+        spec = registry.get(tool_call["function"]["name"])
+        if spec is not None and not spec.parallel_safe:
+            sequential.append(i)
+        elif spec is not None and spec.cacheable:
+            concurrent.setdefault(_call_key(tool_call), []).append(i)
+        else:
+            concurrent[i] = [i]
+
+    groups = list(concurrent.values())
+    messages = await asyncio.gather(*(run_tool_call(tool_calls[group[0]], registry, timings) for group in groups))
+    for group, message in zip(groups, messages):
+        for i in group:
+            results[i] = {**message, "tool_call_id": tool_calls[i]["id"]}
+    for i in sequential:
+        results[i] = await run_tool_call(tool_calls[i], registry, timings)
+    return results
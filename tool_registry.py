@@ -0,0 +1,270 @@
+import asyncio
+import collections.abc
+import inspect
+import logging
+import re
+import typing
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOOL_TIMEOUT = 15.0
+
+_JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean"}
+
+_ARGS_SECTION = re.compile(r"^\s*Args:\s*$")
+_ARG_LINE = re.compile(r"^\s*(\w+)(?:\s*\([^)]*\))?:\s*(.*)$")
+
+
+class ToolArgumentError(ValueError):
+    """Tool call arguments that don't match the tool's signature."""
+
+
+def _docstring_parts(func: Callable) -> Tuple[str, Dict[str, str]]:
+    """The summary paragraph and the Google-style Args descriptions of a docstring."""
+    doc = inspect.getdoc(func) or ""
+    summary_lines: List[str] = []
+    args: Dict[str, str] = {}
+    lines = doc.splitlines()
+    i = 0
+    while i < len(lines) and lines[i].strip():
+        summary_lines.append(lines[i].strip())
+        i += 1
+    current = None
+    in_args = False
+    for line in lines[i:]:
+        if _ARGS_SECTION.match(line):
+            in_args = True
+            continue
+        if not in_args:
+            continue
+        if line and not line[0].isspace():
+            # The next section, e.g. Returns:
+            break
+        match = _ARG_LINE.match(line)
+        if match and len(line) - len(line.lstrip()) <= 4:
+            current = match.group(1)
+            args[current] = match.group(2).strip()
+        elif current and line.strip():
+            args[current] += " " + line.strip()
+    return " ".join(summary_lines), args
+
+
+def _unwrap_optional(annotation) -> Tuple[Any, bool]:
+    """(inner type, whether None is allowed) for Optional[X] and X."""
+    if typing.get_origin(annotation) is typing.Union:
+        members = [member for member in typing.get_args(annotation) if member is not type(None)]
+        if len(members) == 1:
+            return members[0], len(members) < len(typing.get_args(annotation))
+    return annotation, False
+
+
+def _schema_and_coercer(name: str, annotation) -> Tuple[dict, Callable[[Any], Any]]:
+    """JSON schema for a parameter type, and a function that coerces a value to it."""
+    annotation, _ = _unwrap_optional(annotation)
+    origin = typing.get_origin(annotation)
+    if origin in (list, tuple, collections.abc.Sequence):
+        item_type = (typing.get_args(annotation) or (str,))[0]
+        item_schema, coerce_item = _schema_and_coercer(name, item_type)
+
+        def coerce_list(value):
+            if isinstance(value, (str, int, float)):
+                # A single value where a list was expected
+                value = [value]
+            if not isinstance(value, list):
+                raise ToolArgumentError(f"{name} must be a list")
+            return [coerce_item(item) for item in value]
+        return {"type": "array", "items": item_schema}, coerce_list
+
+    json_type = _JSON_TYPES.get(annotation, "string")
+
+    if json_type == "integer":
+        def coerce(value):
+            if isinstance(value, bool):
+                raise ToolArgumentError(f"{name} must be an integer")
+            if isinstance(value, int):
+                return value
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+            if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+                return int(value)
+            raise ToolArgumentError(f"{name} must be an integer, got {value!r}")
+    elif json_type == "number":
+        def coerce(value):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return float(value)
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                raise ToolArgumentError(f"{name} must be a number, got {value!r}") from None
+    elif json_type == "boolean":
+        def coerce(value):
+            if isinstance(value, bool):
+                return value
+            if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+                return value.strip().lower() == "true"
+            raise ToolArgumentError(f"{name} must be true or false, got {value!r}")
+    else:
+        def coerce(value):
+            if isinstance(value, str):
+                value = value.strip()
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = str(value)
+            else:
+                raise ToolArgumentError(f"{name} must be a string, got {value!r}")
+            return value
+    return {"type": json_type}, coerce
+
+
+@dataclass(slots=True, frozen=True)
+class ToolSpec:
+    """
+    A registered tool: its function, schema, argument validator and metadata.
+
+    Attributes:
+        cacheable: The result depends only on the arguments, so identical
+            calls in one batch share a single execution
+        idempotent: Running it again has no further effect, so the executor
+            may retry it once after an unexpected error
+        parallel_safe: It may run at the same time as the other calls in
+            its batch; tools that aren't run one at a time, in order, after
+            the rest
+        listed: Its schema is sent to the model. Unlisted tools can still be
+            called by name, e.g. by a model that remembers an older tool list
+    """
+    name: str
+    func: Callable
+    schema: dict
+    is_async: bool
+    timeout: float
+    cacheable: bool
+    idempotent: bool
+    parallel_safe: bool
+    listed: bool
+    # (name, coerce, required, nullable) per visible parameter
+    _coercers: Tuple[Tuple[str, Callable[[Any], Any], bool, bool], ...]
+    _names: frozenset
+
+    def validate(self, arguments: Any) -> Dict[str, Any]:
+        """
+        Coerce the model's arguments to the function's parameter types.
+
+        Raises:
+            ToolArgumentError: For a non-object, unknown or missing argument, or a value of the wrong type
+        """
+        if arguments is None:
+            arguments = {}
+        if not isinstance(arguments, dict):
+            raise ToolArgumentError("arguments must be a JSON object")
+        unknown = arguments.keys() - self._names
+        if unknown:
+            raise ToolArgumentError(f"unexpected argument(s): {', '.join(sorted(unknown))}")
+        coerced = {}
+        for name, coerce, required, nullable in self._coercers:
+            value = arguments.get(name)
+            if value is None or value == "":
+                if required:
+                    raise ToolArgumentError(f"missing required argument {name}")
+                if name in arguments and nullable:
+                    coerced[name] = None
+                continue
+            coerced[name] = coerce(value)
+        return coerced
+
+
+class ToolRegistry:
+    """
+    Tools the model can call, built once at import from decorated functions.
+
+    Lookup by name is a dict access. schemas() is computed once and returns
+    the same list every time, in registration order, so the tools part of
+    the prompt never changes between requests.
+    """
+
+    def __init__(self):
+        self._tools: Dict[str, ToolSpec] = {}
+        self._schemas: Optional[List[dict]] = None
+
+    def register(self, func: Callable, name: Optional[str] = None, description: Optional[str] = None,
+                 hidden: Sequence[str] = (), timeout: float = DEFAULT_TOOL_TIMEOUT, cacheable: bool = False,
+                 idempotent: bool = True, parallel_safe: bool = True, listed: bool = True) -> ToolSpec:
+        name = name or func.__name__
+        if name in self._tools:
+            raise ValueError(f"Tool {name!r} is already registered")
+
+        target = inspect.unwrap(func)
+        summary, arg_docs = _docstring_parts(target)
+        hints = typing.get_type_hints(target)
+        properties = {}
+        required = []
+        coercers = []
+        for parameter in inspect.signature(target).parameters.values():
+            if parameter.name in hidden or parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+                continue
+            annotation = hints.get(parameter.name, str)
+            schema, coerce = _schema_and_coercer(parameter.name, annotation)
+            if parameter.name in arg_docs:
+                schema["description"] = arg_docs[parameter.name]
+            properties[parameter.name] = schema
+            is_required = parameter.default is inspect.Parameter.empty
+            if is_required:
+                required.append(parameter.name)
+            nullable = _unwrap_optional(annotation)[1] or parameter.default is None
+            coercers.append((parameter.name, coerce, is_required, nullable))
+
+        spec = ToolSpec(
+            name=name,
+            func=func,
+            schema={
+                "type": "function",
+                "function": {
+                    "name": name,
+                    "description": description or summary,
+                    "parameters": {"type": "object", "properties": properties, "required": required},
+                },
+            },
+            is_async=asyncio.iscoroutinefunction(target),
+            timeout=timeout,
+            cacheable=cacheable,
+            idempotent=idempotent,
+            parallel_safe=parallel_safe,
+            listed=listed,
+            _coercers=tuple(coercers),
+            _names=frozenset(name for name, _, _, _ in coercers),
+        )
+        self._tools[name] = spec
+        self._schemas = None
+        return spec
+
+    def tool(self, name: Optional[str] = None, **options) -> Callable[[Callable], Callable]:
+        """
+        Decorator that registers a function as a tool and returns it unchanged.
+
+        The description comes from the docstring's summary and the parameter
+        descriptions from its Args section, unless given here. Parameters
+        listed in hidden (e.g. verbosity) are not shown to the model.
+        """
+        def decorator(func: Callable) -> Callable:
+            self.register(func, name, **options)
+            return func
+        return decorator
+
+    def get(self, name: str) -> Optional[ToolSpec]:
+        return self._tools.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tools
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._tools)
+
+    def schemas(self) -> List[dict]:
+        """Tool schemas in the format litellm's tools= expects."""
+        if self._schemas is None:
+            self._schemas = [spec.schema for spec in self._tools.values() if spec.listed]
+        return self._schemas
+
+
+TOOL_REGISTRY = ToolRegistry()
+tool = TOOL_REGISTRY.tool